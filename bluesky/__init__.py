@@ -4,7 +4,7 @@ import importlib
 from bluesky.pathfinder import resource
 
 
-__all__ = ['settings', 'stack', 'tools', 'cmdargs']
+__all__ = ['settings', 'stack', 'tools', 'cmdargs', 'sweep']
 
 # Constants
 BS_OK = 0
@@ -1,7 +1,13 @@
 import numpy as np
 
+import bluesky as bs
 from bluesky.core import Base
-from bluesky.network.sharedstate import ActData
+from bluesky.network import sharedstate
+from bluesky.network.sharedstate import ActData, KeyedStore
+
+
+# Aircraft data is stored with a persistent lookup of aircraft ids
+sharedstate.addtopic('ACDATA', KeyedStore())
 
 
 class TrafficProxy(Base):
@@ -49,19 +55,26 @@ class TrafficProxy(Base):
     def ntraf(self):
         return len(self.id)
 
+    @property
+    def acdata(self):
+        ''' The ACDATA store of the active node. '''
+        act_id = getattr(bs.net, 'act_id', None)
+        return sharedstate.get(act_id, 'acdata') if act_id else sharedstate.defaults.acdata
+
     def id2idx(self, acid):
-        """Find index of aircraft id"""
-        if not isinstance(acid, str):
-            # id2idx is called for multiple id's
-            # Fast way of finding indices of all ACID's in a given list
-            tmp = dict((v, i) for i, v in enumerate(self.id))
-            return [tmp.get(acidi, -1) for acidi in acid]
-        else:
-             # Catch last created id (* or # symbol)
+        """Find index of aircraft id. For a list of ids an array of indices is returned."""
+        if isinstance(acid, str):
+            # Catch last created id (* or # symbol)
             if acid in ('#', '*'):
                 return self.ntraf - 1
+            acid = acid.upper()
+        return self.acdata.id2idx(acid)
+
+    def id2handle(self, acid):
+        """Find the handle of aircraft id. Handles of aircraft stay the same
+           across updates, also when the index of an aircraft changes."""
+        return self.acdata.id2handle(acid.upper() if isinstance(acid, str) else acid)
 
-            try:
-                return self.id.index(acid.upper())
-            except:
-                return -1
+    def handle2idx(self, handle):
+        """Find the current index of the aircraft with handle(s)."""
+        return self.acdata.handle2idx(handle)
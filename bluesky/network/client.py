@@ -1,21 +1,36 @@
 ''' BlueSky Client class. '''
 from collections import defaultdict
 
+import bluesky as bs
+
 from bluesky.core.signal import Signal
 from bluesky.stack.clientstack import process
 from bluesky.network.node import Node
-from bluesky.network.common import genid, GROUPID_CLIENT, GROUPID_SIM, GROUPID_DEFAULT
+from bluesky.network.common import genid, islocal, GROUPID_CLIENT, GROUPID_SIM, GROUPID_DEFAULT, GROUPID_SHM
+
+
+# Register settings defaults
+bs.settings.set_variable_defaults(shm_transport=False)
+
 
 class Client(Node):
     def __init__(self, group_id=GROUPID_CLIENT):
         super().__init__(group_id)
         self.acttopics = defaultdict(set)
         self.discovery = None
+        # Viewport registered with the active node
+        self.acviewport = ()
 
         # Signals
         self.actnode_changed = Signal('actnode-changed')
         self.node_added.connect(self.actnode)
 
+    def connect(self, hostname=None, recv_port=None, send_port=None, protocol='tcp'):
+        super().connect(hostname, recv_port, send_port, protocol)
+        # Receive large published data through shared memory from a server on this host
+        if bs.settings.shm_transport and islocal(hostname, protocol):
+            self.sharedmemory()
+
     def update(self):
         ''' Client periodic update function.
 
@@ -44,6 +59,11 @@ class Client(Node):
                         if self.act_id:
                             self._unsubscribe(topic, self.act_id, to_group)
                         self._subscribe(topic, newact, to_group)
+                if self.acviewport:
+                    # Move the registered viewport to the new active node
+                    if self.act_id:
+                        self.send('VIEWPORT', [], self.act_id)
+                    self.send('VIEWPORT', list(self.acviewport), newact)
                 self.act_id = newact
                 self.actnode_changed.emit(newact)
 
@@ -71,6 +91,26 @@ class Client(Node):
                     return
         return super()._unsubscribe(topic, from_group, to_group)
 
+    def viewport(self, *bounds):
+        ''' Register a viewport with the active node, to only receive the
+            aircraft data of aircraft within this viewport.
+
+            Arguments:
+            - bounds: (south lat, north lat, west lon, east lon, zoom). The
+              viewport is removed when no bounds are given.
+
+            Aircraft data for a viewport is sent directly to this client,
+            so the broadcast aircraft data is unsubscribed while a viewport
+            is registered.
+        '''
+        if bounds and not self.acviewport:
+            self._setbcgroup('ACDATA', self.node_id)
+        elif not bounds and self.acviewport:
+            self._setbcgroup('ACDATA', GROUPID_SHM if self.shm else '')
+        self.acviewport = tuple(bounds)
+        if self.act_id:
+            self.send('VIEWPORT', list(bounds), self.act_id)
+
     def addnodes(self, count=1, *node_ids, server_id=None):
         ''' Tell the specified server to add 'count' nodes. 
         
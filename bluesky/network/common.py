@@ -13,6 +13,8 @@ GROUPID_DEFAULT = 0
 GROUPID_CLIENT = ord('C')
 GROUPID_SIM = ord('S')
 GROUPID_NOGROUP = ord('N')
+# Group mask of broadcasts that are received through shared memory
+GROUPID_SHM = ord('M')
 # Connection identifier string length
 IDLEN = 5
 
@@ -112,3 +114,15 @@ def get_ownip():
     except:
         pass
     return '127.0.0.1'
+
+
+def islocal(hostname=None, protocol='tcp'):
+    ''' Returns True if hostname refers to this machine. '''
+    if protocol in ('ipc', 'inproc') or hostname in (None, '', 'localhost', '::1'):
+        return True
+    try:
+        return hostname == socket.gethostname() or \
+            socket.gethostbyname(hostname).startswith('127') or \
+            socket.gethostbyname(hostname) == get_ownip()
+    except OSError:
+        return False
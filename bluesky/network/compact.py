@@ -0,0 +1,233 @@
+''' Compact encoding of aircraft state messages.
+
+    Floating point fields are quantized to integers with a fixed resolution
+    per field. A frame contains either the absolute (quantized) values of a
+    field, or the difference with a reference frame, stored in the smallest
+    integer type that fits. Fields that didn't change are left out, and
+    string fields (the aircraft ids) are only sent when the set of aircraft
+    changes.
+
+    Receivers acknowledge each frame they decode. The encoder uses the most
+    recent frame that all active receivers acknowledged as reference frame,
+    and sends a keyframe (without reference) when there is no such frame.
+    A receiver that doesn't have the reference frame of a message requests
+    a full state, to which the encoder responds with a keyframe that is
+    sent to that receiver only. Such a keyframe is never used as reference,
+    because the other receivers don't have it.
+'''
+import time
+import numpy as np
+
+import bluesky as bs
+from bluesky.network import shmem
+
+
+# Resolution per quantized field
+RESOLUTION = dict(
+    lat=1e-6, lon=1e-6,                             # [deg]
+    alt=0.1,                                        # [m]
+    tas=0.01, cas=0.01, gs=0.01, vs=0.01,           # [m/s]
+    trk=0.01,                                       # [deg]
+    tcpamax=0.1,                                    # [s]
+    rpz=1.0,                                        # [m]
+    vmin=0.01, vmax=0.01, asastas=0.01,             # [m/s]
+    asastrk=0.01                                    # [deg]
+)
+
+# Per-aircraft fields that are sent only when they change
+EXACT = ('ingroup', 'inconf')
+
+# Number of frames that encoder and decoder keep as possible reference
+HISTORY = 32
+
+# Receivers that haven't acknowledged a frame for this long are considered inactive [s]
+ACK_TIMEOUT = 2.0
+
+# Minimum interval between keyframe requests of a receiver [s]
+REQUEST_INTERVAL = 1.0
+
+# Integer types for quantized values and differences, smallest first
+INTTYPES = (np.int8, np.int16, np.int32, np.int64)
+
+
+def quantize(values, resolution):
+    ''' Return values as integer multiples of resolution, or None
+        when values contains non-finite numbers. '''
+    values = np.asarray(values, dtype=np.float64)
+    if not np.isfinite(values).all():
+        return None
+    return np.rint(values / resolution).astype(np.int64)
+
+
+def narrow(values):
+    ''' Store integer values in the smallest integer type that fits. '''
+    if values.size == 0:
+        return values.astype(np.int8)
+    vmin, vmax = values.min(), values.max()
+    for inttype in INTTYPES:
+        info = np.iinfo(inttype)
+        if info.min <= vmin and vmax <= info.max:
+            return values.astype(inttype)
+    return values
+
+
+class Frame:
+    ''' Quantized state of one encoded frame. '''
+    __slots__ = ('ids', 'quantized', 'exact')
+
+    def __init__(self, ids, quantized, exact):
+        self.ids = ids
+        self.quantized = quantized
+        self.exact = exact
+
+
+class Encoder:
+    ''' Encoder for a stream of aircraft state messages. '''
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.nframe = 0
+        self.history = dict()
+        # Last acknowledged frame and time of acknowledgement per receiver
+        self.acks = dict()
+
+    def ack(self, receiver_id, nframe):
+        ''' Register that receiver_id has decoded frame nframe. '''
+        prev, _ = self.acks.get(receiver_id, (-1, 0.0))
+        self.acks[receiver_id] = (max(prev, nframe), self.clock())
+
+    def reference(self):
+        ''' Return the number of the frame that all active receivers
+            have acknowledged, or None if there isn't one. '''
+        now = self.clock()
+        for receiver_id, (_, tack) in list(self.acks.items()):
+            if now - tack > ACK_TIMEOUT:
+                del self.acks[receiver_id]
+        if not self.acks:
+            return None
+        nref = min(nframe for nframe, _ in self.acks.values())
+        return nref if nref in self.history else None
+
+    def encode(self, data, keyframe=False):
+        ''' Encode message data. Returns the compact message.
+
+            Arguments:
+            - data: The message data
+            - keyframe: Encode a keyframe for a single receiver, which is
+              not kept as reference for later frames
+        '''
+        self.nframe += 1
+        nref = None if keyframe else self.reference()
+        ref = self.history.get(nref)
+        ids = list(data.get('id', ()))
+        if ref is not None and ids != ref.ids:
+            # The set of aircraft changed: differences can't be used
+            ref, nref = None, None
+
+        msg = dict(compact=self.nframe, ref=nref, fields=dict())
+        frame = Frame(ids, dict(), dict())
+        if ref is None:
+            msg['id'] = ids
+        for name, value in data.items():
+            if name == 'id':
+                continue
+            if name in RESOLUTION and isinstance(value, np.ndarray):
+                quantized = quantize(value, RESOLUTION[name])
+                if quantized is None:
+                    # Non-finite values are sent as single precision floats
+                    msg['fields'][name] = ('f', value.astype(np.float32))
+                    continue
+                frame.quantized[name] = quantized
+                refvalue = ref.quantized.get(name) if ref else None
+                if refvalue is None:
+                    msg['fields'][name] = ('a', narrow(quantized))
+                elif (quantized != refvalue).any():
+                    msg['fields'][name] = ('d', narrow(quantized - refvalue))
+            elif name in EXACT and isinstance(value, np.ndarray):
+                frame.exact[name] = value = value.copy()
+                refvalue = ref.exact.get(name) if ref else None
+                if refvalue is None or not np.array_equal(value, refvalue):
+                    msg['fields'][name] = ('a', value)
+            else:
+                msg[name] = value
+
+        if not keyframe:
+            self.history[self.nframe] = frame
+        self.history.pop(self.nframe - HISTORY, None)
+        return msg
+
+
+class Decoder:
+    ''' Decoder for a stream of compact aircraft state messages from one sender.
+
+        Arguments:
+        - reply: Function called as reply(topic, data) to acknowledge
+          frames, and to request a keyframe.
+    '''
+    def __init__(self, reply, clock=time.time):
+        self.reply = reply
+        self.clock = clock
+        self.history = dict()
+        self.trequest = -REQUEST_INTERVAL
+
+    def decode(self, topic, msg):
+        ''' Decode a compact message. Returns the message data, or None
+            when the reference frame of the message is unknown. '''
+        nframe, nref = msg['compact'], msg['ref']
+        ref = None if nref is None else self.history.get(nref)
+        if nref is not None and ref is None:
+            # Missed the reference frame: request a keyframe
+            if self.clock() - self.trequest >= REQUEST_INTERVAL:
+                self.trequest = self.clock()
+                self.reply('REQUEST', [topic])
+            return None
+
+        frame = Frame(msg['id'] if ref is None else ref.ids, dict(), dict())
+        data = {name: value for name, value in msg.items()
+                if name not in ('compact', 'ref', 'fields')}
+        data['id'] = frame.ids
+        for name, (kind, value) in msg['fields'].items():
+            if kind == 'f':
+                data[name] = value.astype(np.float64)
+            elif name in EXACT:
+                # Kept as reference for later frames: not on shared memory
+                frame.exact[name] = data[name] = shmem.keep(value)
+            elif kind == 'a':
+                frame.quantized[name] = value.astype(np.int64)
+            else:
+                frame.quantized[name] = ref.quantized[name] + value
+
+        # Unchanged fields are taken from the reference frame
+        if ref is not None:
+            for name, value in ref.quantized.items():
+                if name not in msg['fields']:
+                    frame.quantized[name] = value
+            for name, value in ref.exact.items():
+                if name not in msg['fields']:
+                    frame.exact[name] = data[name] = value
+        for name, value in frame.quantized.items():
+            data[name] = value * RESOLUTION[name]
+
+        self.history[nframe] = frame
+        self.history.pop(nframe - HISTORY, None)
+        self.reply('ACKFRAME', [topic, nframe])
+        return data
+
+
+# Decoders per sender and topic on the receiving side
+decoders = dict()
+
+
+def iscompact(data):
+    ''' Returns True if data is a compact message. '''
+    return isinstance(data, dict) and 'compact' in data and 'fields' in data
+
+
+def decode(sender_id, topic, msg):
+    ''' Decode a compact message from sender_id, with the decoder for this
+        sender and topic. Returns None when the message can't be decoded. '''
+    decoder = decoders.get((sender_id, topic))
+    if decoder is None:
+        decoder = decoders[(sender_id, topic)] = Decoder(
+            lambda rtopic, rdata: bs.net.send(rtopic, rdata, sender_id))
+    return decoder.decode(topic, msg)
+
@@ -2,6 +2,7 @@
 import os
 import bluesky as bs
 from bluesky.core.walltime import Timer
+from bluesky.network.netstats import NetStats
 
 
 class Node:
@@ -10,6 +11,8 @@ class Node:
         self.server_id = b''
         self.act_id = None
         self.running = True
+        # A detached node doesn't send or receive messages
+        self.netstats = NetStats()
 
     def update(self):
         ''' Update timers. '''
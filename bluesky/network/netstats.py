@@ -0,0 +1,130 @@
+''' Network statistics: message counters per topic and peer.
+
+    Each node counts the messages and bytes it sends and receives per topic
+    and per peer, the time spent encoding and decoding them, and, for
+    published shared state, the latency from publication by the simulation
+    to reception. The peer of a sent message is its destination group (b''
+    for broadcasts, GROUPID_SHM for broadcasts through shared memory), and
+    the peer of a received message is its sender.
+
+    Counting costs two clock reads and a dict lookup per message, so the
+    counters are always enabled. Latency is measured with the wall clock
+    of both hosts, and is therefore only as accurate as their clock
+    synchronisation. Messages of a replay (see replay.py) keep the time at
+    which they were originally published.
+'''
+import time
+from bluesky.network.common import bin2hex, asbytestr, GROUPID_SHM
+
+
+class NetStats:
+    ''' Message statistics of one node or server. '''
+    def __init__(self):
+        # Counters per (topic, peer): [messages, bytes, encode/decode time]
+        self.sent = dict()
+        self.received = dict()
+        # Latency per (topic, peer): [messages, total, maximum, last]
+        self.latency = dict()
+        self.tstart = time.time()
+
+    def reset(self):
+        ''' Restart counting. '''
+        self.__init__()
+
+    def count_sent(self, topic, peer, frames, tcodec=0.0):
+        ''' Count a sent message of topic to peer, consisting of frames. '''
+        counter = self.sent.get((topic, peer))
+        if counter is None:
+            counter = self.sent[(topic, peer)] = [0, 0, 0.0]
+        counter[0] += 1
+        counter[1] += nbytes(frames)
+        counter[2] += tcodec
+
+    def count_received(self, topic, peer, frames, tcodec=0.0):
+        ''' Count a received message of topic from peer, consisting of frames. '''
+        counter = self.received.get((topic, peer))
+        if counter is None:
+            counter = self.received[(topic, peer)] = [0, 0, 0.0]
+        counter[0] += 1
+        counter[1] += nbytes(frames)
+        counter[2] += tcodec
+
+    def count_latency(self, topic, peer, tsent):
+        ''' Count the latency of a message of topic from peer that was
+            published at wall-clock time tsent. Returns the latency [s]. '''
+        latency = time.time() - tsent
+        counter = self.latency.get((topic, peer))
+        if counter is None:
+            counter = self.latency[(topic, peer)] = [0, 0.0, latency, latency]
+        counter[0] += 1
+        counter[1] += latency
+        counter[2] = max(counter[2], latency)
+        counter[3] = latency
+        return latency
+
+    def stats(self):
+        ''' Return the statistics as a dict with, per direction, a dict per
+            topic with the counters of each peer. Times are in ms. '''
+        def table(counters, latency=None):
+            result = dict()
+            for (topic, peer), (n, size, tcodec) in counters.items():
+                entry = dict(n=n, bytes=size, tcodec=1e3 * tcodec)
+                nlat, total, maxlat, last = (latency or {}).get((topic, peer), (0, 0.0, 0.0, 0.0))
+                if nlat:
+                    entry.update(latency=1e3 * total / nlat, maxlatency=1e3 * maxlat,
+                                 lastlatency=1e3 * last)
+                result.setdefault(topic.decode(), dict())[peername(peer)] = entry
+            return result
+
+        return dict(duration=time.time() - self.tstart, sent=table(self.sent),
+                    received=table(self.received, self.latency))
+
+
+def nbytes(frames):
+    ''' Return the total size of a list of message frames. '''
+    return sum(memoryview(frame).nbytes for frame in frames)
+
+
+def peername(peer):
+    ''' Readable name of a peer id, '*' for broadcasts, and 'shm' for
+        broadcasts through shared memory. '''
+    if not peer:
+        return '*'
+    return 'shm' if peer == asbytestr(GROUPID_SHM) else bin2hex(peer)
+
+
+def totals(peers):
+    ''' Sum the counters of all peers of a topic. '''
+    n = sum(entry['n'] for entry in peers.values())
+    result = dict(n=n, bytes=sum(entry['bytes'] for entry in peers.values()),
+                  tcodec=sum(entry['tcodec'] for entry in peers.values()))
+    nlat = [(entry['n'], entry['latency']) for entry in peers.values() if 'latency' in entry]
+    if nlat:
+        result['latency'] = sum(n * lat for n, lat in nlat) / sum(n for n, _ in nlat)
+        result['maxlatency'] = max(entry.get('maxlatency', 0.0) for entry in peers.values())
+    return result
+
+
+def format_stats(stats, title='', perpeer=True, labels=('Sent', 'Received')):
+    ''' Format statistics as returned by NetStats.stats() as text lines. '''
+    duration = max(stats['duration'], 1e-9)
+    lines = [f'{title}Network statistics over {duration:.0f} s']
+    for direction, label, codec in zip(('sent', 'received'), labels, ('encode', 'decode')):
+        topics = stats.get(direction, {})
+        if not topics:
+            continue
+        lines.append(f'{label}:')
+        for topic, peers in sorted(topics.items(), key=lambda item: -totals(item[1])['bytes']):
+            rows = [(topic, totals(peers))]
+            if perpeer and len(peers) > 1:
+                rows += [(f'  {peer}', entry) for peer, entry in sorted(peers.items())]
+            for name, entry in rows:
+                line = (f'  {name}: {entry["n"]} msgs '
+                        f'({entry["n"] / duration:.1f}/s), {entry["bytes"] / 1e3:.1f} kB '
+                        f'({entry["bytes"] / 1e3 / duration:.1f} kB/s)')
+                if entry['tcodec']:
+                    line += f', {codec} {entry["tcodec"] / entry["n"]:.3f} ms/msg'
+                if 'latency' in entry:
+                    line += f', latency {entry["latency"]:.1f} ms (max {entry["maxlatency"]:.1f})'
+                lines.append(line)
+    return lines
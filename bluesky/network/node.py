@@ -1,14 +1,16 @@
 ''' Node test '''
+import os
+import time
 from collections.abc import Collection
 import zmq
-import msgpack
 import bluesky as bs
 from bluesky import stack
 from bluesky.core import Entity, Signal
 from bluesky.network import context as ctx
 from bluesky.network.subscriber import Subscription
-from bluesky.network.npcodec import encode_ndarray, decode_ndarray
-from bluesky.network.common import genid, asbytestr, seqidx2id, seqid2idx, MSG_SUBSCRIBE, MSG_UNSUBSCRIBE, GROUPID_NOGROUP, GROUPID_CLIENT, GROUPID_SIM, GROUPID_DEFAULT, IDLEN
+from bluesky.network import npcodec, shmem
+from bluesky.network.netstats import NetStats
+from bluesky.network.common import genid, asbytestr, seqidx2id, seqid2idx, MSG_SUBSCRIBE, MSG_UNSUBSCRIBE, GROUPID_NOGROUP, GROUPID_CLIENT, GROUPID_SIM, GROUPID_DEFAULT, GROUPID_SHM, IDLEN
 
 
 # Register settings defaults
@@ -24,6 +26,19 @@ class Node(Entity):
         self.act_id = None
         self.nodes = set()
         self.servers = set()
+        self.conninfo = None
+        # True in a process that was forked from another node
+        self.forked = False
+        # True when this node receives published arrays through shared memory
+        self.shm = False
+        # To-group of broadcast subscriptions per topic, when it differs from all ('')
+        self.bcgroups = dict()
+        # Active subscriptions of other nodes to messages sent by this node
+        self.subscribers = set()
+        # Shared memory for the arrays of each topic published by this node
+        self.shmwriters = dict()
+        # Message statistics per topic and peer
+        self.netstats = NetStats()
 
         zmqctx = zmq.Context.instance()
         self.sock_recv = zmqctx.socket(zmq.SUB)
@@ -43,6 +58,7 @@ class Node(Entity):
         self.node_removed = Signal('node-removed')
         self.server_added = Signal('server-added')
         self.server_removed = Signal('server-removed')
+        self.client_removed = Signal('client-removed')
 
     def connect(self, hostname=None, recv_port=None, send_port=None, protocol='tcp'):
         ''' Connect node to a server.
@@ -53,6 +69,7 @@ class Node(Entity):
             - send_port: Network port to use for outgoing communication
             - protocol: Network protocol to use
         '''
+        self.conninfo = (hostname, recv_port, send_port, protocol)
         conbase = f'{protocol}://{hostname or "localhost"}'
         rcon = conbase + f':{recv_port or bs.settings.recv_port}'
         scon = conbase + f':{send_port or bs.settings.send_port}'
@@ -63,6 +80,42 @@ class Node(Entity):
         # Register this node by subscribing to targeted messages
         self.subscribe('',  '', to_group=self.node_id)
 
+    def fork(self, node_id):
+        ''' Fork this node into a child process that continues as a new node.
+
+            The child process can't use the ZMQ context and sockets of the
+            parent, and therefore reconnects with new sockets, and renews
+            all subscriptions of the parent.
+
+            Arguments:
+            - node_id: The id of the new node
+
+            Returns:
+            - The process id of the child in the parent process, 0 in the child
+        '''
+        pid = os.fork()
+        if pid == 0:
+            # Leave the parent's sockets alone: they are closed by the parent
+            self.forked = True
+            self.node_id = node_id
+            self.group_id = node_id[:-1]
+            self.server_id = node_id[:-1] + seqidx2id(0)
+            # Shared memory blocks of the parent stay with the parent
+            self.shmwriters = dict()
+            self.subscribers = set()
+            self.netstats = NetStats()
+            zmqctx = zmq.Context.instance()
+            # Don't wait for a server that has stopped to receive our last messages
+            zmqctx.setsockopt(zmq.LINGER, 1000)
+            self.sock_recv = zmqctx.socket(zmq.SUB)
+            self.sock_send = zmqctx.socket(zmq.XPUB)
+            self.poller = zmq.Poller()
+            self.connect(*(self.conninfo or ()))
+            for sub in Subscription.subscriptions.values():
+                for from_group, to_group in sub.subs:
+                    self._subscribe(sub.topic, from_group, to_group, sub.actonly)
+        return pid
+
     def close(self):
         ''' Close all network connections. '''
         self.poller.unregister(self.sock_recv)
@@ -70,6 +123,8 @@ class Node(Entity):
         self.sock_recv.close()
         self.sock_send.close()
         zmq.Context.instance().destroy()
+        for writer in self.shmwriters.values():
+            writer.close()
 
 
     def update(self):
@@ -93,17 +148,32 @@ class Node(Entity):
                     # The event does not refer to incoming data: skip for now
                     continue
             
-                # Receive the message
-                ctx.msg = sock.recv_multipart()
+                # Receive the message. Array data frames are used without copying
+                ctx.msg = sock.recv_multipart(copy=False)
                 if not ctx.msg:
                     # In the rare case that a message is empty, skip remaning processing
                     continue
+                ctx.msg[0] = ctx.msg[0].bytes
 
                 # Regular incoming data
                 if sock == self.sock_recv:
                     ctx.topic = ctx.msg[0][IDLEN:-IDLEN].decode()
                     ctx.sender_id = ctx.msg[0][-IDLEN:]
-                    pydata = msgpack.unpackb(ctx.msg[1], object_hook=decode_ndarray, raw=False)
+                    tstart = time.perf_counter()
+                    try:
+                        pydata = npcodec.unpackb(ctx.msg[1:])
+                    except shmem.StaleError:
+                        # Already overwritten by a newer message, which we will receive next
+                        continue
+                    except FileNotFoundError:
+                        # The first block can't be found: the sender is on
+                        # another host. Use the network instead
+                        print(f'Shared memory of node {ctx.sender_id} is not accessible, '
+                              'switching to network transport')
+                        self.sharedmemory(False)
+                        continue
+                    self.netstats.count_received(ctx.msg[0][IDLEN:-IDLEN], ctx.sender_id, ctx.msg,
+                                                 time.perf_counter() - tstart)
                     sub = Subscription.subscriptions.get(ctx.topic, None) #or Subscription(ctx.topic, directedonly=True)
                     if sub is None:
                         print('No subscription known for', ctx.topic, 'on', self.node_id)
@@ -123,6 +193,10 @@ class Node(Entity):
                 elif sock == self.sock_send:
                     # This is an (un)subscribe message. If it's an id-only subscription
                     # this is also a registration message
+                    if ctx.msg[0][0] == MSG_SUBSCRIBE:
+                        self.subscribers.add(ctx.msg[0][1:])
+                    else:
+                        self.subscribers.discard(ctx.msg[0][1:])
                     if len(ctx.msg[0]) == IDLEN + 1:
                         sender_id = ctx.msg[0][1:]
                         sequence_idx = seqid2idx(sender_id[-1])
@@ -146,18 +220,58 @@ class Node(Entity):
                                     self.servers.discard(sender_id)
                                     self.server_removed.emit(sender_id)
 
+                        elif sender_id[0] == GROUPID_CLIENT and ctx.msg[0][0] == MSG_UNSUBSCRIBE:
+                            # A client has disconnected
+                            self.client_removed.emit(sender_id)
+
         except zmq.ZMQError:
             return False
 
     def send(self, topic: str, data: str|Collection='', to_group: int|str|bytes=''):
         btopic = asbytestr(topic)
         bto_group = asbytestr(to_group or stack.sender() or '')
-        self.sock_send.send_multipart(
-            [
-                bto_group.ljust(IDLEN, b'*') + btopic + self.node_id,
-                msgpack.packb(data, default=encode_ndarray, use_bin_type=True)
-            ]
-        )
+        header = bto_group.ljust(IDLEN, b'*') + btopic + self.node_id
+        if not bto_group and self.subscribers:
+            # Broadcasts to local subscribers are sent through shared memory,
+            # and to others only when there are any
+            shmheader = asbytestr(GROUPID_SHM).ljust(IDLEN, b'*') + btopic + self.node_id
+            if self.hassubscribers(shmheader):
+                writer = self.shmwriters.get(btopic)
+                if writer is None:
+                    writer = self.shmwriters[btopic] = shmem.Writer()
+                tstart = time.perf_counter()
+                frames = [shmheader] + npcodec.packb(data, writer)
+                self.netstats.count_sent(btopic, asbytestr(GROUPID_SHM), frames, time.perf_counter() - tstart)
+                self.sock_send.send_multipart(frames, copy=False)
+                if not self.hassubscribers(header):
+                    return
+        tstart = time.perf_counter()
+        frames = [header] + npcodec.packb(data)
+        self.netstats.count_sent(btopic, bto_group, frames, time.perf_counter() - tstart)
+        self.sock_send.send_multipart(frames, copy=False)
+
+    def hassubscribers(self, header):
+        ''' Returns True if other nodes are subscribed to messages with this header. '''
+        return any(header.startswith(prefix) for prefix in self.subscribers)
+
+    def sharedmemory(self, enable=True):
+        ''' Receive the published arrays of the topics in shmem.TOPICS through
+            shared memory. Only use this when all simulation nodes are on
+            the same host as this node. '''
+        self.shm = enable
+        for topic in shmem.TOPICS:
+            if self.bcgroups.get(asbytestr(topic)) != self.node_id:
+                self._setbcgroup(topic, GROUPID_SHM if enable else '')
+
+    def _setbcgroup(self, topic, to_group=''):
+        ''' Receive broadcasts of topic with subscriptions to to_group. '''
+        sub = Subscription.subscriptions.get(topic)
+        from_groups = [from_group for from_group, group in sub.subs if not group] if sub else []
+        for from_group in from_groups:
+            self._unsubscribe(topic, from_group)
+        self.bcgroups[asbytestr(topic)] = asbytestr(to_group)
+        for from_group in from_groups:
+            self._subscribe(topic, from_group, '', sub.actonly)
 
     def subscribe(self, topic, from_group: int|str|bytes=GROUPID_DEFAULT, to_group: int|str|bytes='', actonly=False):
         ''' Subscribe to a topic.
@@ -202,7 +316,7 @@ class Node(Entity):
             from_group = GROUPID_CLIENT
         btopic = asbytestr(topic)
         bfrom_group = asbytestr(from_group)
-        bto_group = asbytestr(to_group)
+        bto_group = asbytestr(to_group) or self.bcgroups.get(btopic, b'')
         self.sock_recv.setsockopt(zmq.SUBSCRIBE, bto_group.ljust(IDLEN, b'*') + btopic + bfrom_group)
 
     def _unsubscribe(self, topic, from_group: int|str|bytes=GROUPID_DEFAULT, to_group: int|str|bytes=''):
@@ -210,7 +324,7 @@ class Node(Entity):
             from_group = GROUPID_CLIENT
         btopic = asbytestr(topic)
         bfrom_group = asbytestr(from_group)
-        bto_group = asbytestr(to_group)
+        bto_group = asbytestr(to_group) or self.bcgroups.get(btopic, b'')
         self.sock_recv.setsockopt(zmq.UNSUBSCRIBE, bto_group.ljust(IDLEN, b'*') + btopic + bfrom_group)
 
     def addnodes(self, count=1, *node_ids):
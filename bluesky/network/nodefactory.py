@@ -0,0 +1,53 @@
+''' Fork-server for simulation nodes.
+
+    The node factory is a template process that initialises BlueSky (settings,
+    navigation database, performance models, plugins) once. For each node id
+    it receives on its standard input it forks a ready-to-run simulation
+    node, which connects to the server under that id. The server uses the
+    node factory when the node_forkserver setting is enabled.
+
+    Usage: python -m bluesky.network.nodefactory [--configfile fname]
+
+    Requests are lines of the form: <node id in hex> [scenario file]
+'''
+import os
+import sys
+import signal
+import argparse
+import bluesky as bs
+from bluesky.network.common import hex2bin
+
+
+def main():
+    ''' Initialise the template, and fork simulation nodes on request. '''
+    parser = argparse.ArgumentParser(prog='BlueSky node factory')
+    parser.add_argument('--configfile', dest='configfile', default=None)
+    args = parser.parse_args()
+    bs.init(mode='sim', configfile=args.configfile)
+
+    # The template itself stops on SIGTERM, forked nodes shut down cleanly.
+    # Forked nodes are reaped automatically.
+    simhandler = signal.getsignal(signal.SIGTERM)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+
+    # Stop when the server closes our standard input
+    for request in sys.stdin:
+        if not request.strip():
+            continue
+        node_id, *scenfile = request.split()
+        sys.stdout.flush()
+        if bs.net.fork(hex2bin(node_id)) == 0:
+            signal.signal(signal.SIGTERM, simhandler)
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            sys.stdin.close()
+            # Don't continue with the random state of the template
+            bs.sim.setseed(int.from_bytes(os.urandom(4), 'little'))
+            if scenfile:
+                bs.stack.stack(f'IC {scenfile[0]}')
+            # Doesn't return: forked nodes exit when the simulation ends
+            bs.sim.run()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,25 @@
+''' Msgpack codec for messages with numpy arrays.
+
+    Small arrays are stored inline in the msgpack payload. Large arrays are
+    sent as separate frames of a multipart ZMQ message, directly from and to
+    the array memory: on the receiving side they are used without copying
+    the data. Messages with inline arrays only, as sent by earlier versions,
+    are decoded as before.
+
+    For receivers on the same host, large arrays can instead be written to
+    shared memory (see shmem.py), in which case the message consists of the
+    payload and the location of the arrays in shared memory.
+'''
+import msgpack
 import numpy as np
 
+from bluesky.network import shmem
+
+
+# Arrays of at least this size [bytes] are sent as separate message frames
+FRAME_THRESHOLD = 1024
+
+
 def encode_ndarray(o):
     '''Msgpack encoder for numpy arrays.'''
     if isinstance(o, np.ndarray):
@@ -9,8 +29,74 @@ def encode_ndarray(o):
                 b'data': o.tobytes()}
     return o
 
+
 def decode_ndarray(o):
     '''Msgpack decoder for numpy arrays.'''
     if o.get(b'numpy'):
-        return np.fromstring(o[b'data'], dtype=np.dtype(o[b'type'])).reshape(o[b'shape'])
+        return np.frombuffer(o[b'data'], dtype=np.dtype(o[b'type'])).reshape(o[b'shape'])
     return o
+
+
+def packb(data, shm=None):
+    ''' Serialise data to a list of message frames: the msgpack payload,
+        followed by the data of each large array in data.
+
+        Large arrays are copied once, as a snapshot: the simulation can
+        change its arrays while ZMQ is still sending them in the background.
+        The resulting frames can be sent with copy=False.
+
+        When a shared memory writer is passed as shm, large arrays are
+        written to shared memory, and the second frame contains their location.
+    '''
+    frames = []
+    arrays = []
+
+    def encode(o):
+        if isinstance(o, np.ndarray) and o.nbytes >= FRAME_THRESHOLD and not o.dtype.hasobject:
+            if shm is not None:
+                arrays.append(o)
+                return {b'numpy': True,
+                        b'type': o.dtype.str,
+                        b'shape': o.shape,
+                        b'shm': len(arrays) - 1}
+            frames.append(np.array(o, order='C'))
+            return {b'numpy': True,
+                    b'type': o.dtype.str,
+                    b'shape': o.shape,
+                    b'frame': len(frames)}
+        return encode_ndarray(o)
+
+    payload = msgpack.packb(data, default=encode, use_bin_type=True)
+    if arrays:
+        return [payload, msgpack.packb(shm.write(arrays), use_bin_type=True)]
+    return [payload] + frames
+
+
+def unpackb(frames):
+    ''' Deserialise a list of message frames created with packb.
+
+        Frames can be bytes, or zmq.Frame objects received with copy=False.
+        Arrays are created directly on the frame buffers, without copying.
+        Arrays that were sent inline are read-only views on the payload,
+        and arrays in shared memory are read-only views on the shared memory.
+
+        Raises shmem.StaleError when the shared memory of the message
+        has already been overwritten by a newer message.
+    '''
+    location = None
+
+    def decode(o):
+        nonlocal location
+        if o.get(b'numpy'):
+            dtype = np.dtype(o[b'type'])
+            idx = o.get(b'shm')
+            if idx is not None:
+                if location is None:
+                    location = msgpack.unpackb(memoryview(frames[1]), raw=False)
+                return shmem.view(location, idx, dtype, o[b'shape'])
+            idx = o.get(b'frame')
+            buf = o[b'data'] if idx is None else memoryview(frames[idx])
+            return np.frombuffer(buf, dtype=dtype).reshape(o[b'shape'])
+        return o
+
+    return msgpack.unpackb(frames[0], object_hook=decode, raw=False)
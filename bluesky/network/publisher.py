@@ -1,4 +1,5 @@
 import inspect
+import time
 from collections import defaultdict
 from collections.abc import Callable
 
@@ -6,12 +7,26 @@ import bluesky as bs
 from bluesky.core.funcobject import FuncObject
 from bluesky.core.timedfunction import timed_function
 from bluesky.core.walltime import Timer
-from bluesky.network.common import ActionType
+from bluesky.network.common import ActionType, asbytestr, bin2hex, GROUPID_SHM, IDLEN
 from bluesky.network.subscriber import subscriber
 from bluesky.network.sharedstate import _recursive_update
 import bluesky.network.context as ctx
 
 
+# Register settings defaults
+bs.settings.set_variable_defaults(publish_adaptive=True, publish_maxfactor=8,
+                                  publish_maxload=0.25, publish_limits=dict())
+
+# Receivers that haven't acknowledged a message for this long are considered inactive [s]
+ACK_TIMEOUT = 3.0
+
+# Minimum time between adaptations of the publishing interval [s]
+ADAPT_INTERVAL = 1.0
+
+# Number of recent messages per destination for which the send time is kept
+NSENT = 64
+
+
 class PublisherMeta(type):
     __publishers__ = dict()
     __timers__ = dict()
@@ -19,15 +34,14 @@ class PublisherMeta(type):
     def __call__(cls, topic: str, dt=None, collect=False, send_type='replace'):
         pub = PublisherMeta.__publishers__.get(topic)
         if pub is None:
-            pub = PublisherMeta.__publishers__[topic] = super().__call__(topic, dt, collect)
+            pub = PublisherMeta.__publishers__[topic] = super().__call__(topic, dt, collect, send_type)
             # If dt is specified, also create a timer
             if dt is not None:
                 if dt not in PublisherMeta.__timers__:
                     timer = PublisherMeta.__timers__[dt] = Timer(dt)
                 else:
                     timer = PublisherMeta.__timers__[dt]
-                callback = getattr(pub, f'send_{send_type}')
-                timer.timeout.connect(callback)
+                timer.timeout.connect(pub.publish)
         return pub
 
     @subscriber
@@ -37,6 +51,16 @@ class PublisherMeta(type):
         for pub in (p for p in map(PublisherMeta.__publishers__.get, topics) if p is not None):
             pub.send_replace(to_group=ctx.sender_id)
 
+    @subscriber(topic='PUBACK', broadcast=False)
+    @staticmethod
+    def puback(topic, to_group, seq, ndropped, latency=None):
+        ''' Receivers periodically acknowledge the last message they received of a
+            topic, and report the number of messages they missed, and the
+            latency of the acknowledged message. '''
+        pub = PublisherMeta.__publishers__.get(topic)
+        if pub is not None:
+            pub.ack(ctx.sender_id, to_group, seq, ndropped, latency)
+
 
 class StatePublisher(metaclass=PublisherMeta):
     ''' BlueSky shared state publisher class.
@@ -78,6 +102,34 @@ class StatePublisher(metaclass=PublisherMeta):
         self.topic = topic
         self.dt = dt
         self.collects = collect
+        self.send_type = send_type
+
+        # Periodic publishers adapt their interval [ms] between dtmin and dtmax
+        dtmin, dtmax = bs.settings.publish_limits.get(topic, (None, None))
+        self.dtmin = dtmin or dt
+        self.dtmax = dtmax or (dt and dt * bs.settings.publish_maxfactor)
+        self.interval = self.dtmin
+
+        # Sequence number of the last message, and send times of recent
+        # messages per destination group
+        self.seq = defaultdict(int)
+        self.tsent = defaultdict(dict)
+
+        # Bookkeeping for the adaptive interval
+        self.tpublish = 0.0
+        self.tadapt = 0.0
+        self.cost = 0.0
+        self.dropped = False
+        # Latest lag and time of acknowledgement, and the number of missed
+        # messages and the latency reported by each receiver
+        self.lag = dict()
+        self.receiverdrops = dict()
+        self.latency = dict()
+
+        # Statistics
+        self.nsent = 0
+        self.nskipped = 0
+        self.ndropped = 0
 
     @staticmethod
     def get_payload():
@@ -90,12 +142,12 @@ class StatePublisher(metaclass=PublisherMeta):
             if self.collects:
                 self.collect(self.topic, [ActionType.Update.value, data], to_group)
             else:
-                bs.net.send(self.topic, [ActionType.Update.value, data], to_group)
+                self._send(ActionType.Update.value, data, to_group)
 
 
     def send_delete(self, to_group=b'', **keys):
         if keys:
-            bs.net.send(self.topic, [ActionType.Delete.value, keys], to_group)
+            self._send(ActionType.Delete.value, keys, to_group)
 
 
     def send_append(self, to_group=b'', **data):
@@ -104,7 +156,7 @@ class StatePublisher(metaclass=PublisherMeta):
             if self.collects:
                 self.collect(self.topic, [ActionType.Append.value, data], to_group)
             else:
-                bs.net.send(self.topic, [ActionType.Append.value, data], to_group)
+                self._send(ActionType.Append.value, data, to_group)
 
     def send_extend(self, to_group=b'', **data):
         data = data or self.get_payload()
@@ -112,12 +164,106 @@ class StatePublisher(metaclass=PublisherMeta):
             if self.collects:
                 self.collect(self.topic, [ActionType.Extend.value, data], to_group)
             else:
-                bs.net.send(self.topic, [ActionType.Extend.value, data], to_group)
+                self._send(ActionType.Extend.value, data, to_group)
 
     def send_replace(self, to_group=b'', **data):
         data = data or self.get_payload()
         if data:
-            bs.net.send(self.topic, [ActionType.Replace.value, data], to_group)
+            self._send(ActionType.Replace.value, data, to_group)
+
+    def _send(self, action, data, to_group=b''):
+        ''' Send a message with a sequence number per destination group,
+            with which receivers can report lag and missed messages, and
+            the wall-clock time of sending, to measure latency. '''
+        group = asbytestr(to_group)
+        self.seq[group] += 1
+        seq = self.seq[group]
+        tsent = self.tsent[group]
+        tsent[seq] = time.perf_counter()
+        if len(tsent) > NSENT:
+            del tsent[next(iter(tsent))]
+        self.nsent += 1
+        bs.net.send(self.topic, [action, data, seq, time.time()], to_group)
+
+    def publish(self):
+        ''' Periodic publication of this topic at the adaptive interval. '''
+        now = time.perf_counter()
+        if 1e3 * (now - self.tpublish) < self.interval - 0.5 * self.dt:
+            # Messages of extend/append/update publishers are combined in the next message
+            self.nskipped += 1
+            return
+        if self.send_type == 'replace' and not self.hassubscribers():
+            # Don't spend time on data that nobody receives
+            return
+        self.tpublish = now
+        getattr(self, f'send_{self.send_type}')()
+        self.cost += 0.2 * (time.perf_counter() - now - self.cost)
+        if bs.settings.publish_adaptive:
+            self.adapt(now)
+
+    def hassubscribers(self, broadcast=False):
+        ''' Returns True if other nodes subscribed to this topic. With broadcast=True,
+            only subscriptions to the broadcasts of this topic are counted, and not
+            those to messages sent directly to a client. '''
+        subscribers = getattr(bs.net, 'subscribers', None)
+        if subscribers is None:
+            return True
+        if broadcast:
+            groups = (b'*' * IDLEN, asbytestr(GROUPID_SHM).ljust(IDLEN, b'*'))
+            subscribers = [prefix for prefix in subscribers if prefix[:IDLEN] in groups]
+        btopic = asbytestr(self.topic)
+        return any(prefix[IDLEN:IDLEN + len(btopic)] == btopic[:len(prefix) - IDLEN]
+                   for prefix in subscribers if len(prefix) > IDLEN)
+
+    def ack(self, receiver_id, to_group, seq, ndropped, latency=None):
+        ''' Process the acknowledgement of message seq sent to to_group. '''
+        now = time.perf_counter()
+        tsent = self.tsent[asbytestr(to_group)].get(seq)
+        if tsent is not None:
+            self.lag[receiver_id] = (now - tsent, now)
+        if latency is not None:
+            self.latency[receiver_id] = latency
+        newdrops = ndropped - self.receiverdrops.get(receiver_id, 0)
+        if newdrops > 0:
+            self.ndropped += newdrops
+            self.dropped = True
+        self.receiverdrops[receiver_id] = ndropped
+
+    def adapt(self, now):
+        ''' Adapt the publishing interval to the lag of the receivers, the
+            messages they missed, and the time spent on publishing. '''
+        if now - self.tadapt < ADAPT_INTERVAL:
+            return
+        self.tadapt = now
+        for receiver_id in [r for r, (_, tack) in self.lag.items() if now - tack > ACK_TIMEOUT]:
+            del self.lag[receiver_id]
+            self.receiverdrops.pop(receiver_id, None)
+            self.latency.pop(receiver_id, None)
+
+        maxlag = max((lag for lag, _ in self.lag.values()), default=0.0)
+        load = self.cost / (1e-3 * self.interval)
+        if self.dropped or maxlag > 1e-3 * self.interval or load > bs.settings.publish_maxload:
+            # A receiver can't keep up, or publishing takes too much time: back off
+            self.interval = min(self.dtmax, 2.0 * self.interval)
+        elif maxlag < 0.5e-3 * self.interval and load < 0.5 * bs.settings.publish_maxload:
+            self.interval = max(self.dtmin, 0.8 * self.interval)
+        self.dropped = False
+
+    def stats(self):
+        ''' Return the publishing interval and statistics of this publisher. '''
+        return dict(interval=self.interval, dtmin=self.dtmin, dtmax=self.dtmax,
+                    cost=1e3 * self.cost, nreceivers=len(self.lag),
+                    lag=1e3 * max((lag for lag, _ in self.lag.values()), default=0.0),
+                    latency=1e3 * max(self.latency.values(), default=0.0),
+                    nsent=self.nsent, nskipped=self.nskipped, ndropped=self.ndropped)
+
+    def receivers(self):
+        ''' Return the lag, latency [ms], and missed messages of each receiver
+            that acknowledges this topic. '''
+        return {bin2hex(receiver_id): dict(lag=1e3 * lag,
+                                           latency=1e3 * self.latency.get(receiver_id, 0.0),
+                                           ndropped=self.receiverdrops.get(receiver_id, 0))
+                for receiver_id, (lag, _) in self.lag.items()}
 
     def payload(self, func: Callable):
         ''' Decorator method to specify payload getter for this Publisher. '''
@@ -125,6 +271,12 @@ class StatePublisher(metaclass=PublisherMeta):
         return func
 
 
+def periodic_publishers():
+    ''' Return a dict with all publishers that publish periodically. '''
+    return {topic: pub for topic, pub in PublisherMeta.__publishers__.items()
+            if pub.dt is not None}
+
+
 def state_publisher(func: Callable|None = None, *, topic='', dt=None, send_type='replace'):
     ''' BlueSky shared state publisher decorator.
 
@@ -0,0 +1,243 @@
+''' Recording of the published state streams of a simulation node.
+
+    A recording consists of two append-only files:
+    - The recording itself, which starts with the MAGIC header, followed by
+      length-prefixed records. A record is a msgpack list of
+      [simt, topic, action, frames], with the message frames as they were
+      published (see npcodec.py), and the shared state action of the
+      message (b'' for regular messages).
+    - An index file (same name plus '.idx'), with an INDEX_DTYPE entry per
+      keyframe: the simulation time, the offset of the keyframe in the
+      recording, and the number of recorded aircraft-seconds up to then.
+
+    A keyframe record has topic b'' and action KEYFRAME, and as frames a list
+    of [topic, action, frames] items that together form the full state at
+    that time: a replace message for each shared state topic, and the last
+    message of each other state topic. Starting from a keyframe, a reader
+    only needs the records up to the requested time to reconstruct the state.
+    Like the trails of a client, the extended data (trails) in a keyframe is
+    bounded by trails_maxlen and trails_maxage, so that keyframes don't keep
+    growing with the length of the recording. A reset of the simulation
+    starts a new run in the recording with a keyframe. Seeking to a time
+    that occurs in more than one run goes to the latest of these runs.
+'''
+import struct
+from pathlib import Path
+import msgpack
+import numpy as np
+
+import bluesky as bs
+from bluesky.network import compact, npcodec
+from bluesky.network.common import ActionType
+from bluesky.network.sharedstate import Store, RingStore
+
+
+# Register settings defaults
+bs.settings.set_variable_defaults(record_keyinterval=60.0, trails_maxlen=1000000,
+                                  trails_maxage=0.0)
+
+# Start of each recording file
+MAGIC = b'BSREC001'
+
+# Action of keyframe records
+KEYFRAME = b'K'
+
+# Entries in the index file
+INDEX_DTYPE = np.dtype([('simt', '<f8'), ('offset', '<u8'), ('acsec', '<f8')])
+
+# Regular messages that are events rather than state: not part of keyframes
+EVENTS = (b'ECHO', b'CMDLINE', b'SHOWDIALOG', b'RESET')
+
+# Size of the length prefix of each record
+LENGTH = struct.Struct('<I')
+
+
+def indexname(fname):
+    ''' Return the name of the index file of recording fname. '''
+    return Path(f'{fname}.idx')
+
+
+def pack(simt, topic, action, frames):
+    ''' Serialise a record. '''
+    record = msgpack.packb([simt, topic, action, [memoryview(f).cast('B') for f in frames]],
+                           use_bin_type=True)
+    return LENGTH.pack(len(record)) + record
+
+
+def merge(messages):
+    ''' Combine a list of (action, frames) shared state messages into the
+        frames of one replace message. '''
+    extend = any(action == ActionType.Extend.value for action, _ in messages)
+    store = RingStore(bs.settings.trails_maxlen, bs.settings.trails_maxage, 'trailtime') \
+        if extend else Store()
+    for action, frames in messages:
+        _, data, *_ = npcodec.unpackb(frames)
+        if action == ActionType.Replace.value:
+            store.replace(data)
+        elif action == ActionType.Update.value:
+            store.update(data)
+        elif action == ActionType.Append.value:
+            store.append(data)
+        elif action == ActionType.Extend.value:
+            store.extend(data)
+        elif action == ActionType.Delete.value:
+            store.delete(data)
+    data = store.buffer.since() if isinstance(store, RingStore) else vars(store)
+    return npcodec.packb([ActionType.Replace.value, data])
+
+
+class Recorder:
+    ''' Records the broadcasts of one simulation node to a file.
+
+        Arguments:
+        - fname: The name of the recording file
+        - reply: Function called as reply(topic, data) to send messages to
+          the recorded node (to acknowledge compact aircraft data)
+    '''
+    def __init__(self, fname, reply=None):
+        self.fname = Path(fname)
+        self.file = open(self.fname, 'wb')
+        self.index = open(indexname(self.fname), 'wb')
+        self.file.write(MAGIC)
+        self.decoder = compact.Decoder(reply or (lambda topic, data: None))
+        # Current simulation time, and time of the last keyframe
+        self.simt = 0.0
+        self.tkey = None
+        # Recorded aircraft-seconds, and time of the last aircraft data
+        self.acsec = 0.0
+        self.tacdata = None
+        self.nrecords = 0
+        # Messages per shared state topic since its last replace message,
+        # and the last message of other state topics
+        self.messages = dict()
+
+    def close(self):
+        ''' Close the recording. Returns the recording statistics. '''
+        # A final keyframe makes the end of the recording seekable
+        if self.nrecords:
+            self.keyframe()
+        self.file.close()
+        self.index.close()
+        return self.stats()
+
+    def stats(self):
+        ''' Return the size of the recording, and its size per aircraft-hour. '''
+        size = self.fname.stat().st_size if self.file.closed else self.file.tell()
+        achours = self.acsec / 3600.0
+        return dict(size=size, simt=self.simt, achours=achours, nrecords=self.nrecords,
+                    bytes_per_achour=size / achours if achours else 0.0)
+
+    def record(self, topic, frames):
+        ''' Record a message with topic from its message frames. '''
+        data = npcodec.unpackb(frames)
+        action = b''
+        tprev = self.simt
+        if isinstance(data, (list, tuple)) and data and ActionType.isaction(data[0]) \
+                and isinstance(data[1], dict):
+            action = data[0]
+            if compact.iscompact(data[1]):
+                # Compact messages depend on earlier frames: store them decoded
+                decoded = self.decoder.decode(topic.decode(), data[1])
+                if decoded is None:
+                    return
+                data = [action, decoded, *data[2:]]
+                frames = npcodec.packb(data)
+            payload = data[1]
+            if topic == b'ACDATA' and 'id' in payload:
+                if self.tacdata is not None:
+                    self.acsec += len(payload['id']) * max(0.0, payload['simt'] - self.tacdata)
+                self.tacdata = payload['simt']
+            self.simt = payload.get('simt', self.simt)
+        elif topic == b'SIMINFO':
+            self.simt = data[2]
+        elif topic == b'RESET':
+            # Like the clients, forget the state of the simulation before its reset
+            self.messages.clear()
+
+        # A simulation reset (decreasing time) starts with a new keyframe
+        if self.tkey is None or self.simt < tprev or \
+                self.simt - self.tkey >= bs.settings.record_keyinterval:
+            self.keyframe()
+
+        if action in (b'', ActionType.Replace.value):
+            if topic not in EVENTS:
+                self.messages[topic] = [(action, frames)]
+        else:
+            self.messages.setdefault(topic, []).append((action, frames))
+        self.file.write(pack(self.simt, topic, action, frames))
+        self.nrecords += 1
+
+    def keyframe(self):
+        ''' Write a keyframe with the current state, and add it to the index. '''
+        self.tkey = self.simt
+        items = []
+        for topic, messages in self.messages.items():
+            action, frames = messages[0]
+            if action and (len(messages) > 1 or action != ActionType.Replace.value):
+                action, frames = ActionType.Replace.value, merge(messages)
+                self.messages[topic] = [(action, frames)]
+            items.append([topic, action, [memoryview(f).cast('B') for f in frames]])
+        offset = self.file.tell()
+        record = msgpack.packb([self.simt, b'', KEYFRAME, items], use_bin_type=True)
+        self.file.write(LENGTH.pack(len(record)) + record)
+        self.index.write(np.array([(self.simt, offset, self.acsec)], dtype=INDEX_DTYPE).tobytes())
+        # Make the new keyframe available to readers of a recording in progress
+        self.file.flush()
+        self.index.flush()
+
+
+class Reader:
+    ''' Sequential and indexed reading of a recording. '''
+    def __init__(self, fname):
+        self.fname = Path(fname)
+        self.file = open(self.fname, 'rb')
+        if self.file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{fname} is not a BlueSky recording')
+        self.index = np.zeros(0, dtype=INDEX_DTYPE)
+        self.reload()
+
+    def close(self):
+        self.file.close()
+
+    def reload(self):
+        ''' Read the index again, for recordings that are still in progress. '''
+        index = np.fromfile(indexname(self.fname), dtype=np.uint8)
+        self.index = index[:len(index) // INDEX_DTYPE.itemsize * INDEX_DTYPE.itemsize].view(INDEX_DTYPE)
+
+    def stats(self):
+        ''' Return the size of the recording, and its size per aircraft-hour. '''
+        size = self.fname.stat().st_size
+        achours = self.index['acsec'][-1] / 3600.0 if len(self.index) else 0.0
+        return dict(size=size, simt=self.index['simt'][-1] if len(self.index) else 0.0,
+                    achours=achours, bytes_per_achour=size / achours if achours else 0.0)
+
+    def find(self, simt):
+        ''' Return the offset of the last keyframe at or before simt, in the
+            latest run of the simulation that started before simt. '''
+        if not len(self.index):
+            return len(MAGIC)
+        times = self.index['simt']
+        # Each simulation reset starts a new run with decreasing time
+        starts = [0, *(np.flatnonzero(np.diff(times) < 0) + 1)]
+        start = next((i for i in reversed(starts) if times[i] <= simt), 0)
+        end = next((i for i in starts if i > start), len(times))
+        idx = start + max(0, np.searchsorted(times[start:end], simt, side='right') - 1)
+        return int(self.index['offset'][idx])
+
+    def seek(self, offset):
+        ''' Continue reading at offset. '''
+        self.file.seek(offset)
+
+    def read(self):
+        ''' Read the next record as (simt, topic, action, frames). Returns None
+            at the end of the recording, or at an incomplete record. '''
+        start = self.file.tell()
+        prefix = self.file.read(LENGTH.size)
+        if len(prefix) == LENGTH.size:
+            length, = LENGTH.unpack(prefix)
+            record = self.file.read(length)
+            if len(record) == length:
+                return msgpack.unpackb(record, raw=False)
+        # An incomplete record: try again later
+        self.file.seek(start)
+        return None
@@ -0,0 +1,200 @@
+''' Replay of recorded simulation state streams.
+
+    A replay node serves a recording (see recording.py) to GUI clients as if
+    it were a simulation node, without running a simulation: it needs no
+    navigation database or performance models. Clients control the replay
+    with the following stack commands:
+    - OP / PLAY: Start or continue the replay
+    - HOLD / PAUSE: Pause the replay
+    - DTMULT factor: Set the replay speed factor
+    - SEEK time: Continue at simulation time [s or hh:mm:ss]
+    - INFO: Show the replay position and recording size
+    - QUIT: Stop the replay node
+
+    Usage: python -m bluesky.network.replay fname [--groupid id] [--configfile fname]
+'''
+import time
+import argparse
+
+import bluesky as bs
+from bluesky.network import context as ctx
+from bluesky.network.node import Node
+from bluesky.network.subscriber import subscribe
+from bluesky.network.common import ActionType, hex2bin, GROUPID_SIM, IDLEN
+from bluesky.network.recording import Reader, KEYFRAME, EVENTS
+
+
+# Messages from clients that a replay node doesn't respond to
+IGNORED = ('VIEWPORT', 'ACKFRAME', 'PUBACK', 'PANZOOM')
+
+
+def txt2simt(txt):
+    ''' Convert a time in seconds or [hh:]mm:ss to seconds. '''
+    simt = 0.0
+    for part in txt.split(':'):
+        simt = 60.0 * simt + float(part)
+    return simt
+
+
+class ReplayNode(Node):
+    ''' Network node that replays a recording. '''
+    def __init__(self, fname, group_id=None):
+        super().__init__(group_id or GROUPID_SIM)
+        self.reader = Reader(fname)
+        self.running = True
+        self.playing = False
+        self.speed = 1.0
+        # Current replay time, and wall-clock time of the last step
+        self.simt = 0.0
+        self.tlast = time.time()
+        # Simulation time of the last record that was read
+        self.tread = 0.0
+        # The next record to send
+        self.next = None
+        # Messages per topic that make up the current state
+        self.state = dict()
+
+        subscribe('STACK', broadcast=False).connect(self.stack)
+        subscribe('REQUEST', broadcast=False).connect(self.request)
+        subscribe('QUIT', broadcast=False).connect(self.quit)
+        for topic in IGNORED:
+            subscribe(topic, broadcast=False)
+
+    def run(self):
+        ''' Main loop of the replay node. '''
+        self.seek(0.0)
+        self.send_state()
+        while self.running:
+            self.receive(timeout=10)
+            self.step()
+        self.close()
+
+    def quit(self):
+        self.running = False
+
+    def step(self):
+        ''' Send the recorded messages up to the current replay time. '''
+        now = time.time()
+        if self.playing:
+            self.simt += (now - self.tlast) * self.speed
+        self.tlast = now
+        while self.playing:
+            if self.next is None:
+                self.next = self.reader.read()
+                if self.next is None:
+                    # Wait for recordings in progress, instead of running ahead
+                    self.simt = min(self.simt, self.tread)
+                    break
+            if self.next[0] > self.simt:
+                break
+            self.process(*self.next, publish=True)
+            self.next = None
+
+    def process(self, simt, topic, action, frames, publish=False):
+        ''' Update the current state with a record, and optionally publish it. '''
+        self.tread = simt
+        if action == KEYFRAME:
+            self.state = {topic: [(action, frames)] for topic, action, frames in frames}
+            return
+        if action in (b'', ActionType.Replace.value):
+            if topic not in EVENTS:
+                self.state[topic] = [(action, frames)]
+        else:
+            self.state.setdefault(topic, []).append((action, frames))
+        if publish:
+            self.publish(topic, frames)
+
+    def publish(self, topic, frames, to_group=b''):
+        ''' Send a recorded message as a message of this node. '''
+        header = to_group.ljust(IDLEN, b'*') + topic + self.node_id
+        if to_group or self.hassubscribers(header):
+            self.sock_send.send_multipart([header] + frames)
+
+    def seek(self, simt):
+        ''' Continue the replay at simt. Starts at the last keyframe before simt,
+            and processes the records up to simt without publishing them. '''
+        self.reader.reload()
+        self.reader.seek(self.reader.find(simt))
+        self.state = dict()
+        self.next = None
+        self.tread = 0.0
+        while (record := self.reader.read()) is not None:
+            if record[0] > simt and record[2] != KEYFRAME:
+                self.next = record
+                break
+            self.process(*record)
+        self.simt = simt
+
+    def send_state(self, to_group=b'', topics=None):
+        ''' Send the current state of all (or the given) topics. '''
+        for topic, messages in self.state.items():
+            if topics is None or topic in topics:
+                for _, frames in messages:
+                    self.publish(topic, frames, to_group)
+        if topics is None or b'STATECHANGE' in topics:
+            self.send('STATECHANGE', [ActionType.Replace.value,
+                                      dict(simstate=bs.OP if self.playing else bs.HOLD)], to_group)
+
+    def request(self, *topics):
+        ''' Clients request the full state of topics. '''
+        self.send_state(ctx.sender_id, {topic.encode() for topic in topics})
+
+    def stack(self, cmdlines=''):
+        ''' Process the replay commands of a client. '''
+        for cmdline in cmdlines.split(';'):
+            cmd, *args = cmdline.replace(',', ' ').split() or ['']
+            cmd = cmd.upper()
+            if not cmd:
+                continue
+            if cmd in ('OP', 'PLAY'):
+                self.playing = True
+                self.tlast = time.time()
+                self.send_state(topics={b'STATECHANGE'})
+                text = f'Replay at {self.simt:.1f} s, speed {self.speed:g}'
+            elif cmd in ('HOLD', 'PAUSE'):
+                self.playing = False
+                self.send_state(topics={b'STATECHANGE'})
+                text = f'Replay paused at {self.simt:.1f} s'
+            elif cmd == 'DTMULT' and args:
+                self.speed = float(args[0])
+                text = f'Replay speed {self.speed:g}'
+            elif cmd == 'SEEK' and args:
+                self.seek(txt2simt(args[0]))
+                self.send_state()
+                text = f'Replay at {self.simt:.1f} s'
+            elif cmd == 'INFO':
+                stats = self.reader.stats()
+                text = (f'Replay at {self.simt:.1f} of {stats["simt"]:.1f} s, '
+                        f'{"playing" if self.playing else "paused"}, speed {self.speed:g}\n'
+                        f'Recording of {stats["size"] / 1e6:.1f} MB, '
+                        f'{stats["bytes_per_achour"] / 1e3:.1f} kB per aircraft-hour')
+            elif cmd == 'QUIT':
+                self.quit()
+                text = 'Replay stopped'
+            else:
+                text = f'{cmd} is not available in a replay. ' \
+                       'Use OP, HOLD, DTMULT, SEEK, INFO, or QUIT'
+            self.send('ECHO', dict(text=text, flags=0), ctx.sender_id)
+
+
+def main():
+    ''' Start a replay node for a recording. '''
+    parser = argparse.ArgumentParser(prog='BlueSky replay node')
+    parser.add_argument('fname')
+    parser.add_argument('--groupid', dest='groupid', default=None)
+    parser.add_argument('--configfile', dest='configfile', default=None)
+    parser.add_argument('--hostname', dest='hostname', default=None)
+    args = parser.parse_args()
+
+    # Only settings are needed: no simulation, navdb or performance models
+    from bluesky import pathfinder, settings
+    pathfinder.init()
+    settings.init(args.configfile)
+
+    node = ReplayNode(args.fname, hex2bin(args.groupid) if args.groupid else None)
+    node.connect(args.hostname)
+    node.run()
+
+
+if __name__ == '__main__':
+    main()
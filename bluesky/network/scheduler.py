@@ -0,0 +1,152 @@
+''' Cost-aware scheduling of batch scenarios over simulation nodes. '''
+import json
+import time
+import bluesky as bs
+from bluesky.network.common import bin2hex
+
+
+# Register settings defaults
+bs.settings.set_variable_defaults(cache_path='cache')
+
+
+def estimate(scen):
+    ''' Estimate the cost of a batch scenario as the number of created
+        aircraft times the simulated duration of the scenario. '''
+    ntraf = 0
+    for cmdline in scen['scencmd']:
+        args = cmdline.replace(',', ' ').split()
+        cmd = args[0].upper() if args else ''
+        if cmd == 'CRE':
+            ntraf += 1
+        elif cmd == 'MCRE':
+            ntraf += int(args[1]) if len(args) > 1 and args[1].isdigit() else 1
+    scentime = scen['scentime']
+    duration = scentime[-1] - scentime[0] if scentime else 0.0
+    return max(1, ntraf) * max(1.0, duration)
+
+
+class BatchScheduler:
+    ''' Scheduler for batch scenarios.
+
+        Scenarios are kept in a single queue, ordered by expected runtime
+        (longest first). Nodes take the next scenario from the queue as soon
+        as they are idle, so that long scenarios don't end up at the tail
+        of a batch. The expected runtime of a scenario is its recorded runtime
+        from earlier batches, or otherwise its estimated cost, scaled with the
+        average runtime per unit of cost of the recorded scenarios.
+
+        Arguments:
+        - histfile: The file in which recorded runtimes are stored
+        - clock: Function that returns the current (wall-clock) time [s]
+    '''
+    def __init__(self, histfile=None, clock=time.time):
+        self.histfile = histfile or bs.resource(bs.settings.cache_path) / 'batchruntimes.json'
+        self.clock = clock
+        self.queue = []
+        # Scenario and start time per busy node
+        self.running = dict()
+        # Number of completed scenarios, cost and busy time per node
+        self.nodestats = dict()
+        self.ntotal = 0
+        self.ndone = 0
+        # Recorded cost and runtime per scenario name
+        try:
+            with open(self.histfile) as f:
+                self.history = json.load(f)
+        except (OSError, ValueError):
+            self.history = dict()
+
+    def __bool__(self):
+        return bool(self.queue)
+
+    def rate(self):
+        ''' Average recorded runtime per unit of cost. '''
+        cost = sum(c for c, _ in self.history.values())
+        runtime = sum(r for _, r in self.history.values())
+        return runtime / cost if cost > 0.0 and runtime > 0.0 else 1.0
+
+    def expected(self, scen, rate=None):
+        ''' Return the expected runtime of a scenario. '''
+        cost, runtime = self.history.get(scen['name'], (None, None))
+        if cost == scen['cost']:
+            return runtime
+        return scen['cost'] * (rate or self.rate())
+
+    def add(self, scenarios):
+        ''' Add scenarios to the queue. '''
+        for scen in scenarios:
+            scen['cost'] = estimate(scen)
+            self.queue.append(scen)
+            self.ntotal += 1
+        rate = self.rate()
+        for scen in self.queue:
+            scen['expected'] = self.expected(scen, rate)
+        self.queue.sort(key=lambda scen: scen['expected'], reverse=True)
+
+    def clear(self):
+        ''' Remove all queued scenarios, and reset batch progress. '''
+        self.queue.clear()
+        self.ntotal = len(self.running)
+        self.ndone = 0
+        self.nodestats.clear()
+
+    def next(self, node_id):
+        ''' Take the next scenario from the queue, to run on node node_id.
+            Returns None if the queue is empty. '''
+        if not self.queue:
+            return None
+        scen = self.queue.pop(0)
+        self.running[node_id] = (scen, self.clock())
+        return scen
+
+    def done(self, node_id):
+        ''' Register that node node_id has finished its current scenario.
+            Returns True if the node was running a batch scenario. '''
+        scen, tstart = self.running.pop(node_id, (None, 0.0))
+        if scen is None:
+            return False
+        runtime = self.clock() - tstart
+        self.history[scen['name']] = (scen['cost'], runtime)
+        stats = self.nodestats.setdefault(node_id, [0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += scen['cost']
+        stats[2] += runtime
+        self.ndone += 1
+        if not self.queue and not self.running:
+            self.save()
+        return True
+
+    def requeue(self, node_id):
+        ''' Put the scenario of node node_id back in the queue,
+            for instance when the node is removed. '''
+        scen, _ = self.running.pop(node_id, (None, 0.0))
+        if scen is not None:
+            self.queue.insert(0, scen)
+
+    def eta(self):
+        ''' Return the expected time until the batch is completed [s]. '''
+        now = self.clock()
+        remaining = [scen['expected'] for scen in self.queue] + \
+            [max(0.0, scen['expected'] - (now - tstart)) for scen, tstart in self.running.values()]
+        if not remaining:
+            return 0.0
+        # The batch takes at least as long as its longest remaining scenario
+        return max(sum(remaining) / max(1, len(self.running)), max(remaining))
+
+    def status(self):
+        ''' Return batch progress, ETA, and the throughput of each node. '''
+        nodes = dict()
+        for node_id, (ndone, cost, busytime) in self.nodestats.items():
+            nodes[bin2hex(node_id)] = dict(ndone=ndone, throughput=cost / busytime if busytime else 0.0)
+        for node_id, (scen, _) in self.running.items():
+            nodes.setdefault(bin2hex(node_id), dict(ndone=0, throughput=0.0))['scenario'] = scen['name']
+        return dict(ntotal=self.ntotal, ndone=self.ndone, nqueued=len(self.queue),
+                    eta=self.eta(), nodes=nodes)
+
+    def save(self):
+        ''' Store the recorded runtimes. Fails silently when the file can't be written. '''
+        try:
+            with open(self.histfile, 'w') as f:
+                json.dump(self.history, f)
+        except OSError:
+            pass
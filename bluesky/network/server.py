@@ -1,7 +1,11 @@
 ''' Server test '''
+import os
 import sys
+import time
 import signal
-from subprocess import Popen
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from subprocess import Popen, PIPE
 from multiprocessing import cpu_count
 from threading import Thread
 
@@ -9,15 +13,19 @@ import zmq
 import msgpack
 
 import bluesky as bs
-from bluesky.network.npcodec import encode_ndarray
+from bluesky.network import npcodec
+from bluesky.network.netstats import NetStats, format_stats
+from bluesky.network.recording import Recorder
 from bluesky.network.discovery import Discovery
+from bluesky.network.scheduler import BatchScheduler
 from bluesky.network.common import genid, bin2hex, MSG_SUBSCRIBE, MSG_UNSUBSCRIBE, GROUPID_SIM, IDLEN
 
 
 # Register settings defaults
 bs.settings.set_variable_defaults(max_nnodes=cpu_count(),
                                   recv_port=11000, send_port=11001,
-                                  enable_discovery=False)
+                                  enable_discovery=False, node_forkserver=False,
+                                  node_starttimeout=30.0)
 
 def split_scenarios(scentime, scencmd):
     ''' Split the contents of a batch file into individual scenarios. '''
@@ -34,14 +42,30 @@ class Server(Thread):
     def __init__(self, discovery, altconfig=None, startscn=None):
         super().__init__()
         self.spawned_processes = dict()
+        self.forked_processes = dict()
+        # Template process that forks pre-initialised nodes
+        self.nodefactory = None
+        # Request time of nodes that haven't reported their state yet
+        self.starting = dict()
         self.running = True
         self.max_nnodes = min(cpu_count(), bs.settings.max_nnodes)
-        self.scenarios = []
+        self.scheduler = BatchScheduler()
         self.server_id = genid(groupid=GROUPID_SIM, seqidx=0)
         self.max_group_idx = 0
         self.sim_nodes = set()
         self.all_nodes = set()
         self.avail_nodes = set()
+        # Active recordings per sim node, and started replay nodes
+        self.recorders = dict()
+        # Recordings are written in a separate thread, so that they don't delay
+        # forwarding. Its replies to recorded nodes are sent from the main loop
+        self.recordwriter = ThreadPoolExecutor(max_workers=1, thread_name_prefix='recorder')
+        self.recordreplies = deque()
+        self.replay_processes = dict()
+        # Partitioned simulations, by the node id of each partition
+        self.partitions = dict()
+        # Forwarded messages per topic and sender, and messages of this server
+        self.netstats = NetStats()
         
         # Information to pass on to spawned nodes
         self.altconfig = altconfig
@@ -66,9 +90,31 @@ class Server(Thread):
         self.running = False
 
     def sendscenario(self, node_id):
-        # Send a new scenario to the target sim process
-        scen = self.scenarios.pop(0)
-        self.send(b'BATCH', scen, node_id)
+        # Send the next (longest) scenario to the target sim process
+        scen = self.scheduler.next(node_id)
+        self.send(b'BATCH', dict(name=scen['name'], scentime=scen['scentime'],
+                                 scencmd=scen['scencmd']), node_id)
+
+    def nstarting(self):
+        ''' Return the number of started nodes that haven't reported their state yet.
+            The processes of forked nodes can't be polled: forked nodes that
+            don't report their state within node_starttimeout [s] are assumed
+            to have failed. '''
+        for node_id, p in self.spawned_processes.items():
+            if p.poll() is not None:
+                self.starting.pop(node_id, None)
+        tmin = time.time() - bs.settings.node_starttimeout
+        for node_id in [node_id for node_id, tstart in self.starting.items()
+                        if tstart < tmin and node_id in self.forked_processes]:
+            del self.starting[node_id]
+        return len(self.starting)
+
+    def sendbatchstatus(self):
+        ''' Report batch progress, and inform clients when the batch is complete. '''
+        status = self.scheduler.status()
+        self.send(b'BATCHSTATUS', status)
+        if status['ndone'] == status['ntotal']:
+            self.send(b'ECHO', dict(text=f'Batch complete: {status["ndone"]} scenarios', flags=0))
 
     def addnodes(self, count=1, node_ids=None, startscn=None):
         ''' Add [count] nodes to this server. '''
@@ -78,6 +124,10 @@ class Server(Thread):
             else:
                 self.max_group_idx += 1
                 newid = genid(self.server_id[:-1], seqidx=self.max_group_idx)
+            self.starting[newid] = time.time()
+            if bs.settings.node_forkserver and hasattr(os, 'fork'):
+                self.forknode(newid, startscn)
+                continue
             args = [sys.executable, '-m', 'bluesky', '--sim', '--groupid', bin2hex(newid)]
             if self.altconfig:
                 args.extend(['--configfile', self.altconfig])
@@ -85,13 +135,106 @@ class Server(Thread):
                 args.extend(['--scenfile', startscn])
             self.spawned_processes[newid] = Popen(args)
 
+    def forknode(self, node_id, startscn=None):
+        ''' Request a pre-initialised simulation node from the node factory.
+            The node factory is started on first use, and kept running, so
+            that new nodes don't need to initialise BlueSky. '''
+        if self.nodefactory is None or self.nodefactory.poll() is not None:
+            args = [sys.executable, '-m', 'bluesky.network.nodefactory']
+            if self.altconfig:
+                args.extend(['--configfile', self.altconfig])
+            # Nodes forked by the factory share its process group
+            self.nodefactory = Popen(args, stdin=PIPE, text=True, start_new_session=True)
+        # The process id of the forked node is not needed: the server
+        # stops all forked nodes by stopping the process group of the factory
+        self.forked_processes[node_id] = None
+        self.nodefactory.stdin.write(f'{bin2hex(node_id)} {startscn or ""}\n')
+        self.nodefactory.stdin.flush()
+
+    def branchnodes(self, count):
+        ''' Reserve [count] node ids for nodes that are forked from a running node. '''
+        node_ids = []
+        for _ in range(count):
+            self.max_group_idx += 1
+            newid = genid(self.server_id[:-1], seqidx=self.max_group_idx)
+            # The process id is known once the node is forked
+            self.forked_processes[newid] = None
+            node_ids.append(newid)
+        return node_ids
+
+    def record(self, node_id, fname=''):
+        ''' Start recording the broadcasts of node_id to fname, or stop
+            an active recording when no filename is given. '''
+        wasrecording = bool(self.recorders)
+        recorder = self.recorders.pop(node_id, None)
+        if recorder is not None:
+            # Closing waits for the records that are still queued
+            stats = self.recordwriter.submit(recorder.close).result()
+            self.send(b'ECHO', dict(text=f'Recorded {stats["simt"]:.0f} s to {recorder.fname}: '
+                                         f'{stats["size"] / 1e6:.1f} MB, '
+                                         f'{stats["bytes_per_achour"] / 1e3:.1f} kB per aircraft-hour',
+                                    flags=0))
+        if fname:
+            try:
+                self.recorders[node_id] = Recorder(
+                    fname, lambda topic, data: self.recordreplies.append((topic.encode(), data, node_id)))
+                self.send(b'ECHO', dict(text=f'Recording to {fname}', flags=0))
+            except OSError as e:
+                self.send(b'ECHO', dict(text=f'RECORD: Error opening {fname}: {e}', flags=0))
+
+        # Receive all broadcasts while there are active recordings
+        if self.recorders and not wasrecording:
+            self.sock_recv.send_multipart([b'\x01' + b'*' * IDLEN])
+        elif wasrecording and not self.recorders:
+            self.sock_recv.send_multipart([b'\x00' + b'*' * IDLEN])
+
+    def replay(self, fname):
+        ''' Start a replay node for recording fname. '''
+        self.max_group_idx += 1
+        newid = genid(self.server_id[:-1], seqidx=self.max_group_idx)
+        args = [sys.executable, '-m', 'bluesky.network.replay', fname, '--groupid', bin2hex(newid)]
+        if self.altconfig:
+            args.extend(['--configfile', self.altconfig])
+        self.replay_processes[newid] = Popen(args)
+
+    def partition(self, node_id, members):
+        ''' Register the partitions of a partitioned simulation. A node that
+            sends an empty list of members leaves its partitioned simulation. '''
+        group = self.partitions.pop(node_id, None)
+        if group is not None:
+            group['members'].discard(node_id)
+            self.syncpartitions(group)
+        if members:
+            group = dict(members=set(members), ready=dict())
+            for member in members:
+                self.partitions[member] = group
+
+    def syncpartitions(self, group):
+        ''' Let the partitions of a simulation continue with each
+            synchronisation that all partitions have reached. '''
+        for nsync in sorted(group['ready']):
+            if not group['members'] <= group['ready'][nsync]:
+                break
+            del group['ready'][nsync]
+            for member in group['members']:
+                self.send(b'PSYNC', nsync, member)
+
+    def sendnetstats(self, dest=b'', reset=False):
+        ''' Send the message statistics of this server as text to dest. '''
+        lines = format_stats(self.netstats.stats(), 'Server: ', labels=('Sent', 'Forwarded'))
+        if reset:
+            self.netstats.reset()
+        self.send(b'ECHO', dict(text='\n'.join(lines), flags=0), dest)
+
+    def isownnode(self, node_id):
+        ''' Returns True if node_id is a sim node started by this server. '''
+        return node_id[0] == GROUPID_SIM and \
+            (node_id in self.spawned_processes or node_id in self.forked_processes)
+
     def send(self, topic, data='', dest=b''):
-        self.sock_send.send_multipart(
-            [
-                dest.ljust(IDLEN, b'*') + topic + self.server_id,
-                msgpack.packb(data, default=encode_ndarray, use_bin_type=True)
-            ]
-        )
+        frames = [dest.ljust(IDLEN, b'*') + topic + self.server_id] + npcodec.packb(data)
+        self.netstats.count_sent(topic, dest, frames)
+        self.sock_send.send_multipart(frames, copy=False)
 
     def run(self):
         ''' The main loop of this server. '''
@@ -122,6 +265,9 @@ class Server(Thread):
                 print('ERROR while polling')
                 break  # interrupted
 
+            while self.recordreplies:
+                self.send(*self.recordreplies.popleft())
+
             # The socket with incoming data
             for sock, event in events.items():
                 if event != zmq.POLLIN:
@@ -138,31 +284,47 @@ class Server(Thread):
                             bs.settings.send_port)
                     continue
 
-                # Receive the message
-                msg = sock.recv_multipart()
+                # Receive the message. Only the header frame is copied:
+                # data frames are forwarded as they are
+                msg = sock.recv_multipart(copy=False)
                 if not msg:
                     # In the rare case that a message is empty, skip remaning processing
                     continue
+                msg[0] = msg[0].bytes
                 if sock == self.sock_send:
                     # This is an (un)subscribe message. If it's an id-only subscription
                     # this is also a registration message
                     if len(msg[0]) == IDLEN + 1:
                         if msg[0][0] == MSG_SUBSCRIBE:
                             # This is an initial client, server, or node subscription
-                            if msg[0][1] == GROUPID_SIM and msg[0][1:] in self.spawned_processes:
+                            if self.isownnode(msg[0][1:]):
                                 # This is a node owned by this server which has successfully started.
                                 self.sim_nodes.add(msg[0][1:])
                                 self.send(b'REQUEST', ['STATECHANGE'], msg[0][1:])
-                        elif msg[0][0] == MSG_UNSUBSCRIBE and msg[0][1] == GROUPID_SIM and msg[0][1:] in self.spawned_processes:
-                            print('Removing node', msg[0][1:])
-                            self.sim_nodes.discard(msg[0][1:])
+                        elif msg[0][0] == MSG_UNSUBSCRIBE:
+                            if msg[0][1:] in self.recorders:
+                                # Finish the recording of a node that stops
+                                self.record(msg[0][1:])
+                            if msg[0][1:] in self.partitions:
+                                # The other partitions don't wait for a node that stops
+                                self.partition(msg[0][1:], [])
+                            if self.isownnode(msg[0][1:]):
+                                print('Removing node', msg[0][1:])
+                                self.sim_nodes.discard(msg[0][1:])
+                                self.avail_nodes.discard(msg[0][1:])
+                                # Another node takes over the scenario of a removed node
+                                self.scheduler.requeue(msg[0][1:])
+                                if self.avail_nodes and self.scheduler:
+                                    self.sendscenario(self.avail_nodes.pop())
                     # Always forward
-                    self.sock_recv.send_multipart(msg)
+                    self.sock_recv.send_multipart(msg, copy=False)
                 elif sock == self.sock_recv:
                     # First check if message is directed at this server
                     if msg[0].startswith(self.server_id):
                         topic, sender_id = msg[0][IDLEN:-IDLEN], msg[0][-IDLEN:]
-                        data = msgpack.unpackb(msg[1], raw=False)
+                        tstart = time.perf_counter()
+                        data = npcodec.unpackb(msg[1:])
+                        self.netstats.count_received(topic, sender_id, msg, time.perf_counter() - tstart)
                         # TODO: also use Signal logic in server?
                         if topic == b'QUIT':
                             self.quit()
@@ -171,43 +333,79 @@ class Server(Thread):
                                 self.addnodes(count=data)
                             elif isinstance(data, dict):
                                 self.addnodes(**data)
+                        elif topic == b'BRANCH':
+                            # A sim node requests ids for [count] forked copies of itself
+                            self.send(b'FORK', dict(node_ids=self.branchnodes(data)), sender_id)
+                        elif topic == b'FORKED':
+                            self.forked_processes.update(data)
+                        elif topic == b'RECORD':
+                            self.record(sender_id, data)
+                        elif topic == b'REPLAY':
+                            self.replay(data)
+                        elif topic == b'PARTITION':
+                            self.partition(sender_id, data)
+                        elif topic == b'NETSTATS':
+                            self.sendnetstats(*data)
+                        elif topic == b'PSYNC':
+                            group = self.partitions.get(sender_id)
+                            if group is not None:
+                                group['ready'].setdefault(data, set()).add(sender_id)
+                                self.syncpartitions(group)
                         elif topic == b'STATECHANGE':
+                            tstart = self.starting.pop(sender_id, None)
+                            if tstart is not None:
+                                print(f'Node {bin2hex(sender_id)} ready {time.time() - tstart:.2f} s after start request')
                             state = data[1]['simstate']
                             if state < bs.OP:
                                 # If we have batch scenarios waiting, send
                                 # the simulation node a new scenario, otherwise store it in
                                 # the available simulation node list
-                                if self.scenarios:
+                                finished = self.scheduler.done(sender_id)
+                                if self.scheduler:
                                     self.sendscenario(sender_id)
                                 else:
                                     self.avail_nodes.add(sender_id)
+                                if finished:
+                                    self.sendbatchstatus()
                             else:
                                 self.avail_nodes.discard(sender_id)
                         elif topic == b'BATCH':
                             scentime, scencmd = data
-                            self.scenarios = [scen for scen in split_scenarios(scentime, scencmd)]
+                            self.scheduler.clear()
+                            self.scheduler.add(split_scenarios(scentime, scencmd))
                             # Check if the batch list contains scenarios
-                            if not self.scenarios:
+                            if not self.scheduler:
                                 echomsg = 'No scenarios defined in batch file!'
                             else:
-                                echomsg = f'Found {len(self.scenarios)} scenarios in batch'
+                                echomsg = f'Found {len(self.scheduler.queue)} scenarios in batch'
                                 # Send scenario to available nodes (nodes that are in init or hold mode):
-                                while self.avail_nodes and self.scenarios:
-                                    node_id = next(iter(self.avail_nodes))
-                                    self.sendscenario(node_id)
-                                    self.avail_nodes.discard(node_id)
+                                while self.avail_nodes and self.scheduler:
+                                    self.sendscenario(self.avail_nodes.pop())
 
                                 # If there are still scenarios left, determine and
-                                # start the required number of local nodes
-                                reqd_nnodes = min(len(self.scenarios), max(0, self.max_nnodes - len(self.sim_nodes)))
-                                self.addnodes(reqd_nnodes)
+                                # start the required number of local nodes. Nodes
+                                # that are still starting up are reused.
+                                reqd_nnodes = min(len(self.scheduler.queue) - self.nstarting(),
+                                                  self.max_nnodes - len(self.sim_nodes) - self.nstarting())
+                                self.addnodes(max(0, reqd_nnodes))
+                                self.sendbatchstatus()
                             # ECHO the results to the calling client
                             topic = b'ECHO'
                             data = msgpack.packb(dict(text=echomsg, flags=0), use_bin_type=True)
                             self.sock_send.send_multipart([sender_id + topic + self.server_id, data])
                     else:
-                        self.sock_send.send_multipart(msg)
+                        self.netstats.count_received(msg[0][IDLEN:-IDLEN], msg[0][-IDLEN:], msg)
+                        recorder = self.recorders.get(msg[0][-IDLEN:])
+                        if recorder is not None and msg[0].startswith(b'*' * IDLEN):
+                            self.recordwriter.submit(recorder.record, msg[0][IDLEN:-IDLEN], msg[1:])
+                        self.sock_send.send_multipart(msg, copy=False)
         print('Server quit. Stopping nodes:')
+        for node_id in list(self.recorders):
+            self.record(node_id)
+        self.recordwriter.shutdown()
+        for p in self.replay_processes.values():
+            p.terminate()
+            p.wait()
         for pid, p in self.spawned_processes.items():
             # print('Stopping node:', pid, end=' ')
             # p.send_signal(signal.SIGTERM)
@@ -216,6 +414,21 @@ class Server(Thread):
             # Inform network that node is removed
             self.sock_recv.send_multipart([b'\x00' + pid])
             # print('done')
+        if self.nodefactory is not None:
+            try:
+                os.killpg(self.nodefactory.pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+            self.nodefactory.stdin.close()
+            self.nodefactory.wait()
+        for node_id, pid in self.forked_processes.items():
+            # Forked nodes are children of their parent sim node, not of this server
+            if pid:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+            self.sock_recv.send_multipart([b'\x00' + node_id])
         print('Closing connections:', end=' ')
         self.poller.unregister(self.sock_recv)
         self.poller.unregister(self.sock_send)
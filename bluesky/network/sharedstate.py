@@ -3,17 +3,25 @@
     BlueSky's sharedstate is used to keep a shared state 
     across client(s) and simulation node(s)
 '''
+import time
 from typing import Any, Generic, Optional, Type, TypeVar
 import numpy as np
 
 from types import SimpleNamespace
 from copy import deepcopy
 from collections import defaultdict
+from itertools import repeat
 
 import bluesky as bs
 from bluesky.core import signal
 from bluesky.network import context as ctx
-from bluesky.network.common import ActionType
+from bluesky.network.common import ActionType, IDLEN
+from bluesky.network import compact, shmem
+from bluesky.tools.ringbuffer import RingBuffer
+
+
+# Register settings defaults
+bs.settings.set_variable_defaults(publish_ackinterval=0.5)
 
 
 # Keep track of the set of subscribed sharedstate topics. Store signals to emit
@@ -45,8 +53,18 @@ def on_actnode_changed(act_id):
     ctx.action = ActionType.NoAction
 
 
-def on_sharedstate_received(action, data):
+def on_sharedstate_received(action, data, seq=None, tsent=None):
     ''' Retrieve and process state data. '''
+    latency = None
+    if tsent is not None:
+        latency = bs.net.netstats.count_latency(ctx.topic.encode(), ctx.sender_id, tsent)
+    if seq is not None:
+        acknowledge(seq, latency)
+    if compact.iscompact(data):
+        data = compact.decode(ctx.sender_id, ctx.topic, data)
+        if data is None:
+            # Can't be decoded yet: a keyframe has been requested
+            return
     store = get(ctx.sender_id, ctx.topic.lower())
 
     # Store sharedstate context
@@ -78,6 +96,25 @@ def on_sharedstate_received(action, data):
     ctx.action_content = None
 
 
+def acknowledge(seq, latency=None):
+    ''' Keep track of missed messages of the current message stream, and
+        periodically acknowledge the last received message to its sender,
+        with its latency when known. '''
+    to_group = bytes(ctx.msg[0][:IDLEN]).rstrip(b'*') if ctx.msg else b''
+    key = (ctx.sender_id, ctx.topic, to_group)
+    last, ndropped, tack = streams.get(key, (None, 0, 0.0))
+    if last is not None and seq > last + 1:
+        ndropped += seq - last - 1
+    now = time.perf_counter()
+    if now - tack >= bs.settings.publish_ackinterval:
+        tack = now
+        ack = [ctx.topic, to_group, seq, ndropped]
+        if latency is not None:
+            ack.append(latency)
+        bs.net.send('PUBACK', ack, ctx.sender_id)
+    streams[key] = (seq, ndropped, tack)
+
+
 def get(remote_id=None, group=None):
     ''' Retrieve a remote store, or a group in a remote store.
         Returns the store of the active remote if no remote id is provided.
@@ -108,7 +145,7 @@ def setdefault(name: str, default: Any, group: Optional[str]=None):
     setattr(target, name, default)
 
 
-def addtopic(topic: str) -> signal.Signal:
+def addtopic(topic: str, store: Optional['Store']=None) -> signal.Signal:
     ''' Add a sharedstate topic if it doesn't yet exist.
     
         This creates a storage group for this topic, which is added to each 
@@ -116,6 +153,10 @@ def addtopic(topic: str) -> signal.Signal:
         
         Arguments:
         - topic:  The sharedstate topic to add
+        - store:  The (empty) storage object for this topic (optional).
+                  A plain Store is used if no store is given. When the
+                  topic already has a plain Store, its contents are moved
+                  to the given store.
     '''
     topic = topic.lower()
 
@@ -126,11 +167,19 @@ def addtopic(topic: str) -> signal.Signal:
     # No creation needed if topic is already known
     if not hasattr(defaults, topic):
         # Add store to the defaults
-        setattr(defaults, topic, Store())
+        setattr(defaults, topic, store or Store())
 
         # Also add to existing stores if necessary
         for remote in remotes.values():
-            setattr(remote, topic, Store())
+            setattr(remote, topic, deepcopy(store) or Store())
+
+    elif store is not None and type(getattr(defaults, topic)) is Store:
+        # The topic was created with a plain Store (e.g., by an ActData
+        # default): replace it with the specialised store type
+        for target in [defaults, *remotes.values()]:
+            newstore = deepcopy(store)
+            vars(newstore).update(vars(getattr(target, topic)))
+            setattr(target, topic, newstore)
 
     return sig
 
@@ -155,6 +204,10 @@ class Store(SimpleNamespace):
             elif isinstance(container, dict):
                 _recursive_update(container, item)
             else:
+                # Received arrays use the message buffer, and are read-only
+                if isinstance(container, np.ndarray) and not container.flags.writeable:
+                    container = container.copy()
+                    setattr(self, key, container)
                 for idx, value in item.items():
                     container[idx] = value
 
@@ -163,7 +216,7 @@ class Store(SimpleNamespace):
         for key, item in data.items():
             container = getattr(self, key, None)
             if container is None:
-                setattr(self, key, [item])
+                setattr(self, key, [shmem.keep(item)])
             elif isinstance(container, np.ndarray):
                 setattr(self, key, np.append(container, item))
 
@@ -172,15 +225,16 @@ class Store(SimpleNamespace):
         for key, item in data.items():
             container = getattr(self, key, None)
             if container is None:
-                setattr(self, key, item)
+                setattr(self, key, shmem.keep(item))
             elif isinstance(container, list):
                 container.extend(item)
             elif isinstance(container, np.ndarray):
                 setattr(self, key, np.concatenate([container, item]))
 
     def replace(self, data):
-        ''' Replace data containers in this store. '''
-        vars(self).update(data)
+        ''' Replace data containers in this store. Arrays received through
+            shared memory are copied: the block is reused by later messages. '''
+        vars(self).update({key: shmem.keep(item) for key, item in data.items()})
 
     def delete(self, data):
         ''' Delete data from this store. '''
@@ -214,11 +268,11 @@ class Store(SimpleNamespace):
             if idx is None:
                 continue
 
-            for container in vars(self).values():
+            for name, container in list(vars(self).items()):
                 if isinstance(container, np.ndarray):
                     mask = np.ones_like(container, dtype=bool)
                     mask[idx] = False
-                    setattr(self, key, container[mask])
+                    setattr(self, name, container[mask])
                 elif isinstance(container, list):
                     if isinstance(idx, int):
                         container.pop(idx)
@@ -228,6 +282,142 @@ class Store(SimpleNamespace):
                             container.pop(iidx)
 
 
+class RingStore(Store):
+    ''' Storage object for extend-type state data, such as trails.
+
+        Extended data is kept in a bounded ring buffer. Columns can be
+        accessed as attributes, which returns a copy of all rows. Users
+        that only need the newly added rows can use buffer.since(index).
+
+        Arguments:
+        - maxlen: Maximum number of rows (0 or None for no limit)
+        - maxage: Maximum age of rows (0 or None for no limit)
+        - timekey: Name of the column with the time of each row
+    '''
+    def __init__(self, maxlen=None, maxage=None, timekey=None):
+        super().__init__()
+        self.buffer = RingBuffer(maxlen, maxage, timekey)
+
+    def __getattr__(self, name):
+        # Only called for attributes that aren't stored directly
+        buffer = self.__dict__.get('buffer')
+        if buffer is not None and name in buffer.chunks:
+            return buffer.column(name)
+        raise AttributeError(name)
+
+    def valid(self):
+        ''' Return True if this store contains data. '''
+        return len(self.buffer) > 0
+
+    def extend(self, data):
+        ''' Add rows to the ring buffer. '''
+        self.buffer.extend(data)
+
+    def append(self, data):
+        ''' Add a single row to the ring buffer. '''
+        self.buffer.extend({key: [item] for key, item in data.items()})
+
+    def replace(self, data):
+        ''' Replace all rows in the ring buffer. '''
+        self.buffer.clear()
+        self.buffer.extend(data)
+
+
+class KeyedStore(Store):
+    ''' Storage object for per-aircraft state data, such as ACDATA.
+
+        Keeps a persistent lookup from key (aircraft id) to index, which is
+        updated once when new data arrives instead of on each lookup. Each
+        key also gets a handle: an integer that stays the same for as long
+        as the key is present in the data, also when its index changes.
+    '''
+    # Name of the key variable
+    key = 'id'
+    __slots__ = ('_keys', '_idx', '_handles', '_hidx', '_nexthandle', 'handles')
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._keys = None
+        self._idx = dict()
+        self._handles = dict()
+        self._hidx = dict()
+        self._nexthandle = 0
+        # Handle of each row
+        self.handles = np.zeros(0, dtype=np.int64)
+
+    def update(self, data):
+        super().update(data)
+        self.reindex(force=True)
+
+    def append(self, data):
+        super().append(data)
+        self.reindex(force=True)
+
+    def extend(self, data):
+        super().extend(data)
+        self.reindex(force=True)
+
+    def replace(self, data):
+        super().replace(data)
+        self.reindex()
+
+    def delete(self, data):
+        super().delete(data)
+        self.reindex(force=True)
+
+    def reindex(self, force=False):
+        ''' Update the key lookup after a change of the key variable. '''
+        keys = getattr(self, self.key, None)
+        if keys is self._keys and not force:
+            return
+        keys = [] if keys is None else keys if isinstance(keys, list) else list(keys)
+        # Usually the data contains the same aircraft in the same order
+        if force or keys != self._keys:
+            # Keep the first index of duplicate keys
+            self._idx = dict(zip(reversed(keys), range(len(keys) - 1, -1, -1)))
+            handles = dict()
+            for key in keys:
+                if key not in handles:
+                    handle = self._handles.get(key)
+                    if handle is None:
+                        handle = self._nexthandle
+                        self._nexthandle += 1
+                    handles[key] = handle
+            self._handles = handles
+            self._hidx = {handles[key]: idx for key, idx in self._idx.items()}
+            self.handles = np.fromiter(map(handles.get, keys), dtype=np.int64,
+                                       count=len(keys))
+        self._keys = keys
+
+    def id2idx(self, acid):
+        ''' Return the index of key acid, or -1 if it isn't present.
+            For a list of keys an array of indices is returned. '''
+        self.reindex()
+        if isinstance(acid, str):
+            return self._idx.get(acid, -1)
+        return np.fromiter(map(self._idx.get, acid, repeat(-1)), dtype=np.int64,
+                           count=len(acid))
+
+    def id2handle(self, acid):
+        ''' Return the handle of key acid, or -1 if it isn't present.
+            For a list of keys an array of handles is returned. '''
+        self.reindex()
+        if isinstance(acid, str):
+            return self._handles.get(acid, -1)
+        return np.fromiter(map(self._handles.get, acid, repeat(-1)), dtype=np.int64,
+                           count=len(acid))
+
+    def handle2idx(self, handle):
+        ''' Return the current index of the aircraft with handle, or -1 if
+            it is no longer present. For a sequence of handles an array of
+            indices is returned. '''
+        self.reindex()
+        if np.ndim(handle) == 0:
+            return self._hidx.get(int(handle), -1)
+        return np.fromiter(map(self._hidx.get, np.asarray(handle).tolist(), repeat(-1)),
+                           dtype=np.int64, count=len(handle))
+
+
 # Type template variable for ActData accessor class
 T = TypeVar('T')
 
@@ -306,3 +496,7 @@ defaults = Store()
 
 # Keep a dict of remote state storage namespaces
 remotes = defaultdict(_genstore)
+
+# Last sequence number, number of missed messages, and time of the last
+# acknowledgement per received message stream (sender, topic, to_group)
+streams = dict()
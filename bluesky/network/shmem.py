@@ -0,0 +1,195 @@
+''' Shared-memory transport of published arrays for nodes on the same host.
+
+    Nodes that run on the same host as the node that publishes a topic can
+    receive the large arrays in its messages through shared memory instead
+    of the network. The publishing node writes these arrays into a double-
+    buffered shared memory block per topic, and only sends the location of
+    the arrays (block name, generation and offsets) over the network.
+    Receivers map the arrays directly from the shared memory block.
+
+    Each block starts with the generation number of the message it holds.
+    A block is overwritten by the message two generations later: the arrays
+    of a received message remain valid until two newer messages of the same
+    topic have been published. A receiver that lags further behind detects
+    this from the generation number, and skips the overwritten message.
+    Received data that is kept longer than the message it came with should
+    therefore not reference shared memory: see keep().
+'''
+import os
+import mmap
+from multiprocessing import shared_memory
+try:
+    from multiprocessing import resource_tracker
+except ImportError:
+    resource_tracker = None
+import numpy as np
+
+
+# Topics that local subscribers receive through shared memory. Only topics
+# of which each message replaces the previous one: a skipped message of a
+# topic that is extended (such as TRAILS) would be lost
+TOPICS = ('ACDATA',)
+
+# Alignment of arrays in a block [bytes]
+ALIGN = 64
+
+# Generation number of a block that is no longer used by its writer
+RETIRED = -2
+
+
+class StaleError(Exception):
+    ''' A message refers to a shared memory block that has been overwritten. '''
+
+
+def aligned(nbytes):
+    ''' Return nbytes rounded up to the array alignment. '''
+    return -(-nbytes // ALIGN) * ALIGN
+
+
+class Writer:
+    ''' Double-buffered shared memory for the arrays of one published topic. '''
+    def __init__(self):
+        self.generation = 0
+        self.blocks = [None, None]
+
+    def write(self, arrays):
+        ''' Write arrays to the next buffer. Returns the location of the
+            arrays as (block name, generation, offsets). '''
+        self.generation += 1
+        slot = self.generation % 2
+        offsets = []
+        size = ALIGN
+        for array in arrays:
+            offsets.append(size)
+            size += aligned(array.nbytes)
+
+        block = self.blocks[slot]
+        if block is None or block.size < size:
+            # Leave room for growth to avoid reallocating the block on each new aircraft
+            self.retire(slot)
+            block = self.blocks[slot] = shared_memory.SharedMemory(create=True, size=2 * size)
+            created.add(block.name)
+
+        header = np.ndarray(1, dtype=np.int64, buffer=block.buf)
+        header[0] = -1
+        for array, offset in zip(arrays, offsets):
+            np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf, offset=offset)[...] = array
+        header[0] = self.generation
+        return block.name, self.generation, offsets
+
+    def retire(self, slot):
+        ''' Mark the block in slot as retired, and remove it. Receivers
+            keep their mapping of this block until they no longer use it. '''
+        block = self.blocks[slot]
+        if block is not None:
+            np.ndarray(1, dtype=np.int64, buffer=block.buf)[0] = RETIRED
+            block.close()
+            block.unlink()
+            created.discard(block.name)
+            self.blocks[slot] = None
+
+    def close(self):
+        ''' Remove all blocks of this writer. '''
+        for slot in range(len(self.blocks)):
+            self.retire(slot)
+
+
+class Mapping(shared_memory.SharedMemory):
+    ''' A shared memory block of another process, mapped for reading. '''
+    def __init__(self, name):
+        super().__init__(name)
+        if resource_tracker is not None and os.name == 'posix' and name not in created:
+            # The block is owned by the writer: it shouldn't be removed
+            # when this process exits
+            resource_tracker.unregister(self._name, 'shared_memory')
+
+    def __del__(self):
+        # Arrays on this block can outlive the mapping object at exit
+        try:
+            self.close()
+        except (OSError, BufferError):
+            pass
+
+
+# Names of the blocks created by writers in this process
+created = set()
+
+# Shared memory blocks that this process has mapped for reading
+blocks = dict()
+
+# Retired blocks that can't be unmapped yet because their arrays are still in use
+retired = dict()
+
+# Names of retired blocks that have been unmapped
+closed = set()
+
+
+def attach(name):
+    ''' Map the shared memory block with the given name. '''
+    block = blocks.get(name)
+    if block is None:
+        if name in retired or name in closed:
+            raise StaleError(f'Shared memory block {name} was retired')
+        release()
+        try:
+            block = Mapping(name)
+        except FileNotFoundError:
+            if blocks or retired or closed:
+                # Shared memory is accessible, but this block was already
+                # removed by its writer
+                raise StaleError(f'Shared memory block {name} was removed') from None
+            raise
+        blocks[name] = block
+    return block
+
+
+def release():
+    ''' Unmap retired blocks that are no longer in use. '''
+    for name, block in list(blocks.items()):
+        if np.ndarray(1, dtype=np.int64, buffer=block.buf)[0] == RETIRED:
+            retired[name] = blocks.pop(name)
+    for name, block in list(retired.items()):
+        # A failed close leaves the block unusable, but keeps it mapped
+        try:
+            block.close()
+        except BufferError:
+            # Arrays on this block are still in use
+            continue
+        del retired[name]
+        closed.add(name)
+
+
+def view(location, idx, dtype, shape):
+    ''' Return a read-only array on shared memory.
+
+        Arguments:
+        - location: The location of the arrays of a message, as returned
+          by Writer.write
+        - idx: The index of the array in this message
+        - dtype, shape: The type and shape of the array
+    '''
+    name, generation, offsets = location
+    block = attach(name)
+    if np.ndarray(1, dtype=np.int64, buffer=block.buf)[0] != generation:
+        raise StaleError(f'Shared memory block {name} was overwritten')
+    # Unlike np.ndarray, np.frombuffer keeps the buffer exported while the
+    # array exists, which prevents unmapping the block while it is in use
+    array = np.frombuffer(block.buf, dtype=dtype, count=int(np.prod(shape)),
+                          offset=offsets[idx]).reshape(shape)
+    array.flags.writeable = False
+    return array
+
+
+def isshared(array):
+    ''' Returns True if array is a view on a shared memory block. '''
+    while isinstance(array, np.ndarray):
+        array = array.base
+    return isinstance(array, memoryview) and isinstance(array.obj, mmap.mmap)
+
+
+def keep(value):
+    ''' Return value, or a copy of it when it is an array on shared memory.
+        Use this for received data that outlives its message. '''
+    if isinstance(value, np.ndarray) and isshared(value):
+        return value.copy()
+    return value
@@ -6,15 +6,18 @@ import bluesky as bs
 import netCDF4 as nc
 from bluesky import stack
 from bluesky.core import timed_function
+from bluesky.tools.cachefile import ArrayCache
 from bluesky.traffic.windsim import WindSim
 
 
 datadir = Path('')
+cache = None
 
 
 def init_plugin():
-    global datadir
+    global datadir, cache
     datadir = bs.resource(bs.settings.data_path) / 'NetCDF'
+    cache = ArrayCache('wind', bs.settings.wind_cachesize * 1e6)
 
     if not datadir.is_dir():
         datadir.mkdir()
@@ -136,6 +139,40 @@ class WindECMWF(WindSim):
 
         return data
 
+    def griddata(self, netcdf, lat0, lon0, lat1, lon1, hour):
+        ''' Extract wind from netcdf data, and arrange it as a regular grid
+            in the format of addpointvne: lat, lon, vnorth, veast, windalt. '''
+        data = self.extract_wind(netcdf, lat0, lon0, lat1, lon1, hour).T
+
+        data = data[np.lexsort((data[:, 2], data[:, 1], data[:, 0]))] # Sort by lat, lon, alt
+        reshapefactor = int((1 + (max(lat0, lat1) - min(lat0, lat1))*4) * \
+                            (1 + (max(lon0, lon1) - min(lon0, lon1))*4))
+
+        lat     = np.reshape(data[:,0], (reshapefactor, -1)).T[0,:]
+        lon     = np.reshape(data[:,1], (reshapefactor, -1)).T[0,:]
+        veast   = np.reshape(data[:,3], (reshapefactor, -1)).T
+        vnorth  = np.reshape(data[:,4], (reshapefactor, -1)).T
+        windalt = np.reshape(data[:,2], (reshapefactor, -1)).T[:,0]
+
+        return lat, lon, vnorth, veast, windalt
+
+    def getgrid(self, year, month, day, hour, lat0, lon0, lat1, lon1):
+        ''' Get the wind grid of one reanalysis in the format of addpointvne.
+            Previously decoded grids are taken from the wind cache, so that
+            NetCDF files are only downloaded and decoded once per area. '''
+        key = ('era5', f'{year:04d}{month:02d}{day:02d}{hour:02d}', 0,
+               lat0, lon0, lat1, lon1)
+        data = cache.load(key)
+        if data is not None:
+            return data['lat'], data['lon'], data['vnorth'], data['veast'], data['windalt']
+
+        netcdf = self.fetch_nc(year, month, day)
+        if netcdf is None:
+            return None
+        lat, lon, vnorth, veast, windalt = self.griddata(netcdf, lat0, lon0, lat1, lon1, hour)
+        cache.save(key, lat=lat, lon=lon, vnorth=vnorth, veast=veast, windalt=windalt)
+        return lat, lon, vnorth, veast, windalt
+
     @stack.command(name='WINDECMWF')
     def loadwind(self, lat0: 'lat', lon0: 'lon', lat1: 'lat', lon1: 'lon',
                year: int=None, month: int=None, day: int=None, hour: int=None):
@@ -167,9 +204,12 @@ class WindECMWF(WindSim):
         txt = "Loading wind field for %s-%s-%s..." % (self.year, self.month, self.day)
         stack.echo("%s" % txt)
 
-        netcdf = self.fetch_nc(self.year, self.month, self.day)
+        grid = None
+        if self.lat0 != self.lat1 and self.lon0 != self.lon1:
+            grid = self.getgrid(self.year, self.month, self.day, self.hour,
+                                self.lat0, self.lon0, self.lat1, self.lon1)
 
-        if netcdf is None or self.lat0 == self.lat1 or self.lon0 == self.lon1:
+        if grid is None:
             return False, "Wind data non-existend in area [%d, %d], [%d, %d]. " \
                 % (self.lat0, self.lat1, self.lon0, self.lon1) \
                 + "time: %04d-%02d-%02d" \
@@ -179,25 +219,53 @@ class WindECMWF(WindSim):
         self.clear()
 
         # add new wind field
-        data = self.extract_wind(netcdf, self.lat0, self.lon0, self.lat1, self.lon1, self.hour).T
-
-        data = data[np.lexsort((data[:, 2], data[:, 1], data[:, 0]))] # Sort by lat, lon, alt
-        reshapefactor = int((1 + (max(self.lat0, self.lat1) - min(self.lat0, self.lat1))*4) * \
-                            (1 + (max(self.lon0, self.lon1) - min(self.lon0, self.lon1))*4))
-
-        lat     = np.reshape(data[:,0], (reshapefactor, -1)).T[0,:]
-        lon     = np.reshape(data[:,1], (reshapefactor, -1)).T[0,:]
-        veast   = np.reshape(data[:,3], (reshapefactor, -1)).T
-        vnorth  = np.reshape(data[:,4], (reshapefactor, -1)).T
-        windalt = np.reshape(data[:,2], (reshapefactor, -1)).T[:,0]
-
-        self.addpointvne(lat, lon, vnorth, veast, windalt)        
+        self.addpointvne(*grid)
 
         return True, "Wind field updated in area [%d, %d], [%d, %d]. " \
             % (self.lat0, self.lat1, self.lon0, self.lon1) \
             + "time: %04d-%02d-%02d" \
             % (self.year, self.month, self.day)
 
+    @stack.command(name='WINDECMWF4D')
+    def loadwind4d(self, lat0: 'lat', lon0: 'lon', lat1: 'lat', lon1: 'lon', nhours: int=24):
+        ''' WINDECMWF4D: Load a time-varying windfield from ERA5 reanalyses.
+
+            The 3-hourly reanalyses covering the next nhours of simulated time
+            are added as time slices. Each slice is read from the wind cache or
+            the local NetCDF directory (and downloaded only when not present) on
+            first use, and unloaded again when the simulation has passed it.
+
+            Arguments:
+            - lat0, lon0, lat1, lon1 [deg]: Bounding box in which to generate wind field
+            - nhours: Number of hours to cover, starting at the current simulation UTC
+        '''
+        lat0, lon0, lat1, lon1 = min(lat0, lat1), min(lon0, lon1), \
+                                 max(lat0, lat1), max(lon0, lon1)
+        if lat0 == lat1 or lon0 == lon1:
+            return False, 'WINDECMWF4D: Empty area specified.'
+
+        # Periodic reloading is replaced by time interpolation between slices
+        self.autoload = False
+        self.clear()
+
+        t0 = bs.sim.utc.replace(minute=0, second=0, microsecond=0)
+        t0 -= datetime.timedelta(hours=t0.hour % 3)
+        for i in range(nhours // 3 + 2):
+            t = t0 + datetime.timedelta(hours=3 * i)
+            self.addslice(t, self.sliceloader(t, lat0, lon0, lat1, lon1))
+
+        return True, f'WINDECMWF4D: Added {len(self.slices)} wind slices from ' \
+            f'{t0:%Y-%m-%d %H:%M} in area [{lat0}, {lat1}], [{lon0}, {lon1}]'
+
+    def sliceloader(self, t, lat0, lon0, lat1, lon1):
+        ''' Return a function that loads the wind field of time t. '''
+        def loader():
+            grid = self.getgrid(t.year, t.month, t.day, t.hour, lat0, lon0, lat1, lon1)
+            if grid is None:
+                raise RuntimeError(f'WINDECMWF4D: No wind data available for {t}')
+            return grid
+        return loader
+
     @timed_function(name='WINDECMWF', dt=3600)
     def update(self):
         if self.autoload:
@@ -7,6 +7,7 @@ import numpy as np
 import bluesky as bs
 from bluesky import stack
 from bluesky.core import timed_function
+from bluesky.tools.cachefile import ArrayCache
 from bluesky.traffic.windsim import WindSim
 
 bs.settings.set_variable_defaults(
@@ -15,10 +16,12 @@ bs.settings.set_variable_defaults(
 # nlayer = 23
 
 datadir = Path('')
+cache = None
 
 def init_plugin():
-    global datadir
+    global datadir, cache
     datadir = bs.resource(bs.settings.data_path) / 'grib'
+    cache = ArrayCache('wind', bs.settings.wind_cachesize * 1e6)
 
     if not datadir.is_dir():
         datadir.mkdir()
@@ -137,6 +140,41 @@ class WindGFS(WindSim):
 
         return data
 
+    def griddata(self, grb, lat0, lon0, lat1, lon1):
+        ''' Extract wind from grib data, and arrange it as a regular grid
+            in the format of addpointvne: lat, lon, vnorth, veast, windalt. '''
+        data = self.extract_wind(grb, lat0, lon0, lat1, lon1).T
+
+        data = data[np.lexsort((data[:, 2], data[:, 1], data[:, 0]))] # Sort by lat, lon, alt
+        reshapefactor = int((1 + max(lat0, lat1) - min(lat0, lat1)) * \
+                            (1 + max(lon0, lon1) - min(lon0, lon1)))
+
+        lat     = np.reshape(data[:,0], (reshapefactor, -1)).T[0,:]
+        lon     = np.reshape(data[:,1], (reshapefactor, -1)).T[0,:]
+        veast   = np.reshape(data[:,3], (reshapefactor, -1)).T
+        vnorth  = np.reshape(data[:,4], (reshapefactor, -1)).T
+        windalt = np.reshape(data[:,2], (reshapefactor, -1)).T[:,0]
+
+        return lat, lon, vnorth, veast, windalt
+
+    def getgrid(self, year, month, day, hour, pred, lat0, lon0, lat1, lon1):
+        ''' Get the wind grid of one analysis (or prediction) in the format
+            of addpointvne. Previously decoded grids are taken from the wind
+            cache, so that grib files are only downloaded and decoded once
+            per area. Returns None when no wind data is available. '''
+        key = ('gfs', f'{year:04d}{month:02d}{day:02d}{hour:02d}', pred,
+               lat0, lon0, lat1, lon1)
+        data = cache.load(key)
+        if data is not None:
+            return data['lat'], data['lon'], data['vnorth'], data['veast'], data['windalt']
+
+        grb = self.fetch_grb(year, month, day, hour, pred)
+        if grb is None:
+            return None
+        lat, lon, vnorth, veast, windalt = self.griddata(grb, lat0, lon0, lat1, lon1)
+        cache.save(key, lat=lat, lon=lon, vnorth=vnorth, veast=veast, windalt=windalt)
+        return lat, lon, vnorth, veast, windalt
+
     @stack.command(name='WINDGFS')
     def loadwind(self, lat0: 'lat', lon0: 'lon', lat1: 'lat', lon1: 'lon',
                year: int=None, month: int=None, day: int=None, hour: int=None):
@@ -175,9 +213,12 @@ class WindGFS(WindSim):
         txt = "Loading wind field for %s-%s-%s %s:00..." % (self.year, self.month, self.day, self.hour)
         stack.echo("%s" % txt)
 
-        grb = self.fetch_grb(self.year, self.month, self.day, self.hour, pred)
+        grid = None
+        if self.lat0 != self.lat1 and self.lon0 != self.lon1:
+            grid = self.getgrid(self.year, self.month, self.day, self.hour, pred,
+                                self.lat0, self.lon0, self.lat1, self.lon1)
 
-        if grb is None or self.lat0 == self.lat1 or self.lon0 == self.lon1:
+        if grid is None:
             return False, "Wind data non-existend in area [%d, %d], [%d, %d]. " \
                 % (self.lat0, self.lat1, self.lon0, self.lon1) \
                 + "time: %04d-%02d-%02d %02d:00" \
@@ -187,25 +228,56 @@ class WindGFS(WindSim):
         self.clear()
 
         # add new wind field
-        data = self.extract_wind(grb, self.lat0, self.lon0, self.lat1, self.lon1).T
-
-        data = data[np.lexsort((data[:, 2], data[:, 1], data[:, 0]))] # Sort by lat, lon, alt
-        reshapefactor = int((1 + max(self.lat0, self.lat1) - min(self.lat0, self.lat1)) * \
-                            (1 + max(self.lon0, self.lon1) - min(self.lon0, self.lon1)))
-
-        lat     = np.reshape(data[:,0], (reshapefactor, -1)).T[0,:]
-        lon     = np.reshape(data[:,1], (reshapefactor, -1)).T[0,:]
-        veast   = np.reshape(data[:,3], (reshapefactor, -1)).T
-        vnorth  = np.reshape(data[:,4], (reshapefactor, -1)).T
-        windalt = np.reshape(data[:,2], (reshapefactor, -1)).T[:,0]
-
-        self.addpointvne(lat, lon, vnorth, veast, windalt)        
+        self.addpointvne(*grid)
 
         return True, "Wind field updated in area [%d, %d], [%d, %d]. " \
             % (self.lat0, self.lat1, self.lon0, self.lon1) \
             + "time: %04d-%02d-%02d %02d:00" \
             % (self.year, self.month, self.day, self.hour)
 
+    @stack.command(name='WINDGFS4D')
+    def loadwind4d(self, lat0: 'lat', lon0: 'lon', lat1: 'lat', lon1: 'lon', nhours: int=24):
+        ''' WINDGFS4D: Load a time-varying windfield from NOAA analyses.
+
+            The 3-hourly analyses covering the next nhours of simulated time
+            are added as time slices. Each slice is read from the wind cache or
+            the local grib directory (and downloaded only when not present) on
+            first use, and unloaded again when the simulation has passed it.
+
+            Arguments:
+            - lat0, lon0, lat1, lon1 [deg]: Bounding box in which to generate wind field
+            - nhours: Number of hours to cover, starting at the current simulation UTC
+        '''
+        lat0, lon0, lat1, lon1 = min(lat0, lat1), min(lon0, lon1), \
+                                 max(lat0, lat1), max(lon0, lon1)
+        if lat0 == lat1 or lon0 == lon1:
+            return False, 'WINDGFS4D: Empty area specified.'
+
+        # Periodic reloading is replaced by time interpolation between slices
+        self.autoload = False
+        self.clear()
+
+        t0 = bs.sim.utc.replace(minute=0, second=0, microsecond=0)
+        t0 -= datetime.timedelta(hours=t0.hour % 3)
+        for i in range(nhours // 3 + 2):
+            t = t0 + datetime.timedelta(hours=3 * i)
+            self.addslice(t, self.sliceloader(t, lat0, lon0, lat1, lon1))
+
+        return True, f'WINDGFS4D: Added {len(self.slices)} wind slices from ' \
+            f'{t0:%Y-%m-%d %H:%M} in area [{lat0}, {lat1}], [{lon0}, {lon1}]'
+
+    def sliceloader(self, t, lat0, lon0, lat1, lon1):
+        ''' Return a function that loads the wind field of time t. '''
+        def loader():
+            # Analyses are available every six hours, with +3h predictions in between
+            pred = t.hour % 6
+            grid = self.getgrid(t.year, t.month, t.day, t.hour - pred, pred,
+                                lat0, lon0, lat1, lon1)
+            if grid is None:
+                raise RuntimeError(f'WINDGFS4D: No wind data available for {t}')
+            return grid
+        return loader
+
     @timed_function(name='WINDGFS', dt=3600)
     def update(self):
         if self.autoload:
@@ -0,0 +1,416 @@
+''' Binary checkpoints of the complete simulation state.
+
+    A checkpoint file contains a header, the pickled simulation state, and
+    the raw data of all registered traffic arrays. The arrays are stored
+    64-byte aligned, so that they can be used directly from a (copy-on-write)
+    memory map of the file when a checkpoint is loaded.
+
+    The checkpoint contains:
+    - All arrays and lists registered with settrafarrays, and all other
+      (picklable) attributes of the objects in the TrafficArrays tree. This
+      includes the routes, CD/CR state, and the state of plugin entities.
+    - The simulation clock and timers, and the simulation UTC
+    - The states of the random number generators
+    - The pending scenario commands, and the position in a streamed scenario
+    - The loaded plugins, and the selected implementations of replaceables
+'''
+import gc
+import io
+import os
+import mmap
+import pickle
+import random
+import struct
+from pathlib import Path
+import numpy as np
+
+import bluesky as bs
+from bluesky.core import base, simtime
+from bluesky.core.entity import Proxy, getproxied
+from bluesky.core.plugin import Plugin
+from bluesky.core.trafficarrays import TrafficArrays
+from bluesky.stack.cmdparser import commandgroup
+from bluesky.stack.simstack import Stack, streamscn
+from bluesky.traffic.route import Route
+
+
+# Header: magic, size of the pickled state, offset of the array data
+MAGIC = b'BSCHKP01'
+HEADER = struct.Struct('<8sqq')
+
+# Alignment of the stored arrays [bytes]
+ALIGN = 64
+
+# TrafficArrays attributes that describe the tree itself
+TREEVARS = {'_parent', '_children', '_ArrVars', '_LstVars'}
+
+# BlueSky singletons that are referenced instead of stored
+SINGLETONS = ('traf', 'sim', 'scr', 'net', 'navdb', 'ref', 'server')
+
+# Errors of a checkpoint file that can't be read or decoded
+LOADERRORS = (OSError, EOFError, ValueError, struct.error, pickle.UnpicklingError,
+              AttributeError, ImportError)
+
+# The path and memory map of the last loaded checkpoint
+_mapped = None
+
+
+def walk(node, path):
+    ''' Iterate over (path, node) of a TrafficArrays tree. Nodes are
+        identified by the class names along the path from the root. '''
+    yield path, node
+    count = dict()
+    for child in node._children:
+        name = type(child).__name__
+        n = count[name] = count.get(name, -1) + 1
+        yield from walk(child, f'{path}/{name}' + (f'[{n}]' if n else ''))
+
+
+def references(nodes):
+    ''' Return a dict of persistent ids by object id of all objects that
+        are referred to, rather than stored in a checkpoint. '''
+    refs = dict()
+    for name in SINGLETONS:
+        obj = getattr(bs, name, None)
+        if obj is not None:
+            refs[id(obj)] = refs[id(getproxied(obj))] = ('bs', name)
+    for path, node in nodes.items():
+        refs[id(node)] = ('node', path)
+        proxy = getattr(type(node), '_proxy', None)
+        if isinstance(proxy, Proxy) and getproxied(proxy) is node:
+            refs[id(proxy)] = ('proxy', path)
+    for timer in simtime.Timer.timers():
+        refs[id(timer)] = ('timer', timer.name)
+    return refs
+
+
+class StatePickler(pickle.Pickler):
+    ''' Pickler that stores references to BlueSky singletons, TrafficArrays
+        nodes, and simulation timers by name. '''
+    def __init__(self, file, refs):
+        super().__init__(file, pickle.HIGHEST_PROTOCOL)
+        self.refs = refs
+
+    def persistent_id(self, obj):
+        return self.refs.get(id(obj))
+
+
+class StateUnpickler(pickle.Unpickler):
+    ''' Unpickler that resolves the references stored by StatePickler.
+        References to TrafficArrays nodes that don't exist are restored as
+        None. After loading, noderefs is True when the value refers to a
+        TrafficArrays node. '''
+    def __init__(self, file, nodes):
+        super().__init__(file)
+        self.nodes = nodes
+        self.noderefs = False
+
+    def persistent_load(self, pid):
+        kind, name = pid
+        if kind == 'bs':
+            return getattr(bs, name)
+        if kind == 'timer':
+            return simtime.Timer.gettimer(name)
+        self.noderefs = True
+        node = self.nodes.get(name)
+        if kind == 'proxy' and node is not None:
+            return type(node)._proxy
+        return node
+
+
+def loadstate(data, nodes):
+    ''' Unpickle a single value. Returns the value, and whether it refers to
+        TrafficArrays nodes. '''
+    unpickler = StateUnpickler(io.BytesIO(data), nodes)
+    return unpickler.load(), unpickler.noderefs
+
+
+def dumpstate(value, refs):
+    ''' Pickle a single value. Returns None if value can't be pickled. '''
+    buf = io.BytesIO()
+    try:
+        StatePickler(buf, refs).dump(value)
+    except (pickle.PicklingError, TypeError, AttributeError):
+        return None
+    return buf.getvalue()
+
+
+def save(fname):
+    ''' Write the complete simulation state to checkpoint file fname.
+
+        Returns:
+        - List of paths of attributes that can't be pickled (and are
+          therefore not stored).
+    '''
+    with nogc():
+        return _save(fname)
+
+
+def load(fname):
+    ''' Restore the simulation state from checkpoint file fname. The state
+        is decoded before the current simulation is reset, so that a file
+        that can't be decoded leaves the current simulation intact.
+
+        Loading unpickles the contents of the file, which can execute
+        arbitrary code: only load checkpoints from trusted sources.
+
+        Returns:
+        - List of paths of stored TrafficArrays nodes that don't exist
+          in the current simulation (and are therefore not restored), and
+          of a streamed scenario file that can't be opened.
+    '''
+    with nogc():
+        return _load(fname)
+
+
+class nogc:
+    ''' Context manager that pauses the garbage collector. (Un)pickling the
+        many small objects of a large traffic picture otherwise triggers a
+        large number of collections. '''
+    def __enter__(self):
+        self.enabled = gc.isenabled()
+        gc.disable()
+
+    def __exit__(self, *args):
+        if self.enabled:
+            gc.enable()
+
+
+def _save(fname):
+    if _mapped is not None and _mapped[0] == Path(fname).resolve():
+        release()
+    root = TrafficArrays.root
+    nodes = dict(walk(root, type(root).__name__))
+    refs = references(nodes)
+
+    # Arrays are stored as raw data, all other attributes are pickled
+    nodestate = dict()
+    arrays = []
+    offset = 0
+    skipped = []
+    for path, node in nodes.items():
+        if node is bs.net:
+            # The network node is not part of the simulation state
+            continue
+        table = dict()
+        attrs = dict()
+        for name, value in vars(node).items():
+            if name in TREEVARS or isinstance(value, TrafficArrays):
+                continue
+            if name in node._ArrVars and not value.dtype.hasobject:
+                arr = np.ascontiguousarray(value)
+                table[name] = (arr.dtype.str, arr.shape, offset)
+                arrays.append((offset, arr))
+                offset += -(-arr.nbytes // ALIGN) * ALIGN
+                continue
+            data = dumpstate(value, refs)
+            if data is None:
+                skipped.append(f'{path}.{name}')
+            else:
+                attrs[name] = data
+        nodestate[path] = (table, attrs)
+
+    timers = dict()
+    for timer in simtime.Timer.timers():
+        timers[timer.name] = dumpstate(vars(timer), refs)
+        if timers[timer.name] is None:
+            skipped.append(f'timer {timer.name}')
+
+    state = pickle.dumps(dict(
+        nodes=nodestate,
+        plugins=list(Plugin.loaded_plugins),
+        impls={name: impl.selected().__name__.upper() for name, impl in base.replaceables.items()},
+        clock=vars(simtime._clock).copy(),
+        timers=timers,
+        sim=dict(simt=bs.sim.simt, simdt=bs.sim.simdt, utc=bs.sim.utc, dtmult=bs.sim.dtmult),
+        rng=(random.getstate(), np.random.get_state()),
+        scenname=Stack.scenname,
+        scendata=Stack.scen.data(),
+        # A streamed scenario continues from the file after the commands read so far
+        scenstream=Stack.scen.position()
+    ), pickle.HIGHEST_PROTOCOL)
+
+    # The arrays of a loaded checkpoint are mapped from its file: write
+    # a new file instead of overwriting it
+    dataofs = -(-(HEADER.size + len(state)) // ALIGN) * ALIGN
+    tmpname = Path(f'{fname}.tmp')
+    with open(tmpname, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(state), dataofs))
+        f.write(state)
+        for arrofs, arr in arrays:
+            f.seek(dataofs + arrofs)
+            f.write(arr.data)
+        f.truncate(dataofs + offset)
+    os.replace(tmpname, fname)
+    return skipped
+
+
+def release():
+    ''' Copy the arrays of the last loaded checkpoint out of its memory map,
+        and close the map, so that its file can be replaced. '''
+    global _mapped
+    if _mapped is None:
+        return
+    _, mm = _mapped
+    _mapped = None
+    for _, node in walk(TrafficArrays.root, ''):
+        for name in node._ArrVars:
+            if ismapped(node.__dict__.get(name), mm):
+                node.__dict__[name] = np.array(node.__dict__[name])
+    try:
+        mm.close()
+    except BufferError:
+        # Other copies of the mapped arrays are still in use: the map is
+        # closed when they are released
+        pass
+
+
+def ismapped(arr, mm):
+    ''' Returns True when array arr is a view of memory map mm. '''
+    while isinstance(arr, np.ndarray):
+        arr = arr.base
+    return isinstance(arr, memoryview) and arr.obj is mm
+
+
+def _load(fname):
+    global _mapped
+    with open(fname, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    magic, statesize, dataofs = HEADER.unpack_from(mm)
+    if magic != MAGIC:
+        raise ValueError(f'{fname} is not a BlueSky checkpoint file')
+    state = pickle.loads(mm[HEADER.size:HEADER.size + statesize])
+    unavailable = [name for name in state['plugins'] if name not in Plugin.plugins]
+    if unavailable:
+        raise ValueError(f'{fname} needs unavailable plugins: ' + ', '.join(unavailable))
+
+    # Decode all attributes and timers before resetting the simulation.
+    # Values that refer to TrafficArrays nodes are decoded again after
+    # the reset, when these nodes have their restored implementations
+    root = TrafficArrays.root
+    nodes = dict(walk(root, type(root).__name__))
+    attrs = {path: {name: loadstate(data, nodes) for name, data in nodeattrs.items()}
+             for path, (_, nodeattrs) in state['nodes'].items()}
+    timers = {name: data and loadstate(data, nodes) for name, data in state['timers'].items()}
+
+    # Start from a clean simulation with the same plugins and implementations
+    bs.sim.reset()
+    for name in state['plugins']:
+        if name not in Plugin.loaded_plugins:
+            Plugin.load(name)
+    for name, implname in state['impls'].items():
+        impl = base.replaceables.get(name)
+        impl = impl and impl.derived().get(implname)
+        if impl is not None:
+            impl.select()
+
+    nodes = dict(walk(root, type(root).__name__))
+    unset = {path: node for path, node in nodes.items() if node is not bs.net}
+    ntraf = 0
+    missing = []
+    _mapped = (Path(fname).resolve(), mm)
+    for path, (table, nodeattrs) in state['nodes'].items():
+        node = unset.pop(path, None)
+        if node is None:
+            missing.append(path)
+            continue
+        for name, (dtype, shape, offset) in table.items():
+            dtype = np.dtype(dtype)
+            count = int(np.prod(shape))
+            node.__dict__[name] = np.frombuffer(mm, dtype, count, dataofs + offset).reshape(shape) \
+                if count else np.zeros(shape, dtype)
+        for name, (value, noderefs) in attrs[path].items():
+            node.__dict__[name] = loadstate(nodeattrs[name], nodes)[0] if noderefs else value
+        if path == type(root).__name__:
+            ntraf = root.ntraf
+
+    # Objects that weren't in the checkpoint get default values for all aircraft
+    for node in unset.values():
+        if ntraf:
+            node.create(ntraf)
+
+    # Route store and aircraft id lookup
+    for route in root.ap.route:
+        Route._routes[route.acid] = route
+    root.idmap = None
+
+    vars(simtime._clock).update(state['clock'])
+    for name, data in state['timers'].items():
+        timer = simtime.Timer.gettimer(name)
+        if timer is not None and data is not None:
+            value, noderefs = timers[name]
+            vars(timer).update(loadstate(data, nodes)[0] if noderefs else value)
+    vars(bs.sim).update(state['sim'])
+
+    pystate, npstate = state['rng']
+    random.setstate(pystate)
+    np.random.set_state(npstate)
+
+    Stack.scenname = state['scenname']
+    Stack.scen.set(*state['scendata'])
+    if state.get('scenstream'):
+        name, window, nread = state['scenstream']
+        try:
+            Stack.scen.resume(streamscn(name), window, nread, name, bs.sim.simt)
+        except OSError:
+            missing.append(f'scenario {name}')
+    return missing
+
+
+def checkpointpath(fname):
+    ''' Return the path of checkpoint file fname. '''
+    fname = Path(fname).with_suffix('.chk')
+    if not fname.is_absolute():
+        fname = bs.resource(bs.settings.scenario_path) / fname
+    return fname
+
+
+@commandgroup(name='CHECKPOINT')
+def checkpoint():
+    ''' CHECKPOINT: Save or load a binary checkpoint of the complete simulation
+        state. Unlike SAVEIC, a checkpoint restores the simulation exactly.
+
+        Usage:
+        - CHECKPOINT SAVE fname
+        - CHECKPOINT LOAD fname
+    '''
+    return True, checkpoint.__doc__
+
+
+@checkpoint.subcommand(name='SAVE')
+def save_checkpoint(fname: 'word'):
+    ''' Save the complete simulation state to a checkpoint file.
+
+        Arguments:
+        - fname: The name of the checkpoint file
+    '''
+    fname = checkpointpath(fname)
+    try:
+        skipped = save(fname)
+    except OSError as e:
+        return False, f'CHECKPOINT: Error writing {fname}: {e}'
+    msg = f'CHECKPOINT: Saved {bs.traf.ntraf} aircraft at t={bs.sim.simt} to {fname}'
+    if skipped:
+        msg += '\nNot stored (not picklable): ' + ', '.join(skipped)
+    return True, msg
+
+
+@checkpoint.subcommand(name='LOAD')
+def load_checkpoint(fname: 'word'):
+    ''' Restore the complete simulation state from a checkpoint file.
+
+        A checkpoint file can execute arbitrary code when it is loaded:
+        only load checkpoints from trusted sources.
+
+        Arguments:
+        - fname: The name of the checkpoint file
+    '''
+    fname = checkpointpath(fname)
+    try:
+        missing = load(fname)
+    except LOADERRORS as e:
+        return False, f'CHECKPOINT: Error reading {fname}: {e}'
+    msg = f'CHECKPOINT: Loaded {bs.traf.ntraf} aircraft at t={bs.sim.simt} from {fname}'
+    if missing:
+        msg += '\nNot restored: ' + ', '.join(missing)
+    return True, msg
@@ -0,0 +1,382 @@
+''' Distributed simulation of one airspace by multiple simulation nodes.
+
+    PARTITION divides the airspace into a grid of geographic tiles, and forks
+    the running simulation into one node per tile. Each node only simulates
+    the aircraft in its own tile:
+    - Aircraft that leave a tile migrate to the node of their new tile, with
+      their complete state: all traffic arrays, including route and
+      autopilot state.
+    - Before each conflict detection step, each node sends the aircraft in
+      the halo of the other tiles to the nodes of these tiles. The halo of a
+      tile is the region around it in which aircraft can be in conflict with
+      aircraft in the tile. These aircraft are ghosts at the receiving node:
+      intruders for conflict detection, that are simulated elsewhere.
+    - Nodes only perform a conflict detection step when all nodes have
+      reached it. The server keeps this barrier. Halos and migrants are sent
+      with the number of their synchronisation: a node that receives them
+      before it reached that step itself keeps them until it does.
+
+    Conflicts between an own aircraft and a ghost are detected by both
+    nodes, but only counted by the node of the aircraft with the lowest id.
+
+    Limitations:
+    - Conflict resolution across tiles isn't supported.
+    - Each node executes the scenario commands. New aircraft are kept by the
+      node of their tile, commands for an aircraft only succeed at the node
+      that simulates it. Commands that are entered by a user are only
+      executed by the node they are sent to.
+    - Partitions run with fixed timesteps (REALTIME OFF), and random
+      processes such as turbulence and ADS-B noise differ per node.
+'''
+import io
+import time
+import numpy as np
+
+import bluesky as bs
+from bluesky.core import timed_function
+from bluesky.core.trafficarrays import TrafficArrays
+from bluesky.network import subscriber
+from bluesky.network import context as ctx
+from bluesky.stack import command
+from bluesky.simulation.checkpoint import walk, references, dumpstate, StateUnpickler
+from bluesky.tools.aero import nm
+from bluesky.traffic.asas import ConflictResolution
+from bluesky.traffic.asas.detection import GHOSTVARS, GHOSTPARAMS
+from bluesky.traffic.route import Route
+
+
+# Register settings defaults
+bs.settings.set_variable_defaults(partition_halomargin=1.1)
+
+
+class Partition:
+    ''' The tile of this node in a partitioned simulation. '''
+    def __init__(self):
+        # Node ids of all partitions, by tile index
+        self.members = []
+        # Tile index of this node
+        self.tile = None
+        # The inner boundaries of the tile grid [deg]
+        self.latbounds = np.zeros(0)
+        self.lonbounds = np.zeros(0)
+        # Number of partitions requested from the server
+        self.npending = 0
+        self.clear()
+
+    def clear(self):
+        ''' Clear the synchronisation state and statistics. '''
+        # Aircraft ids at the last synchronisation
+        self.known = set()
+        # Number of the last requested synchronisation, and of the last
+        # one released by the server
+        self.nsync = 0
+        self.nreleased = 0
+        self.waiting = False
+        # Received ghosts per synchronisation and partition, and largest
+        # rpz, dtlookahead and gs per partition
+        self.halos = dict()
+        self.reach = dict()
+        # Received migrations of synchronisations this node hasn't reached
+        self.pending = []
+        # Own aircraft that migrated at the last synchronisation
+        self.migrants = None
+        # Statistics
+        self.nout = 0
+        self.nin = 0
+        self.tsync = 0.0
+        self.twait = 0.0
+
+    def box(self, tile):
+        ''' Return the (lat0, lat1, lon0, lon1) boundaries of tile. '''
+        ilat, ilon = divmod(tile, len(self.lonbounds) + 1)
+        latedges = np.concatenate(([-np.inf], self.latbounds, [np.inf]))
+        lonedges = np.concatenate(([-np.inf], self.lonbounds, [np.inf]))
+        return latedges[ilat], latedges[ilat + 1], lonedges[ilon], lonedges[ilon + 1]
+
+    def owner(self, lat, lon):
+        ''' Return the tile index of positions lat, lon. '''
+        return np.searchsorted(self.latbounds, lat, side='right') * (len(self.lonbounds) + 1) + \
+            np.searchsorted(self.lonbounds, lon, side='right')
+
+    def halodist(self):
+        ''' Return the width of the halo of a tile [m]: the largest distance at
+            which conflicts can be detected, with a margin for aircraft that
+            accelerate between two synchronisations. '''
+        rpz, dtlook, gs = np.max([self.ownreach(), *self.reach.values()], axis=0)
+        return bs.settings.partition_halomargin * (rpz + dtlook * 2.0 * gs)
+
+    @staticmethod
+    def ownreach():
+        ''' Return the largest rpz, dtlookahead and groundspeed of own aircraft. '''
+        traf = bs.traf
+        if not traf.ntraf:
+            return [0.0, 0.0, 0.0]
+        return [float(np.max(traf.cd.rpz)), float(np.max(traf.cd.dtlookahead)), float(np.max(traf.gs))]
+
+    def inhalo(self, tile, lat, lon, dist):
+        ''' Returns True for positions that are within dist [m] of tile. '''
+        lat0, lat1, lon0, lon1 = self.box(tile)
+        dlat = dist / (60.0 * nm)
+        coslat = np.cos(np.radians(np.minimum(np.abs(lat) + dlat, 89.0)))
+        dlon = dlat / coslat
+        return (lat > lat0 - dlat) & (lat < lat1 + dlat) & (lon > lon0 - dlon) & (lon < lon1 + dlon)
+
+    def ready(self):
+        ''' Returns True when this node can perform its next simulation step. '''
+        if not self.members:
+            return True
+        if self.tile is None:
+            if bs.net.node_id not in self.members:
+                # The simulation hasn't forked into its partitions yet
+                return False
+            self.start()
+
+        # Only conflict detection steps need the state of the other partitions
+        timer = bs.traf.asastimer
+        if (timer.counter or timer.rel_freq) != 1:
+            return True
+        if not self.waiting:
+            self.exchange()
+            return False
+        if self.nreleased < self.nsync:
+            return False
+        self.waiting = False
+        self.twait += time.perf_counter() - self.tsync
+        bs.traf.cd.ghosts = self.ghosts()
+        return True
+
+    def start(self):
+        ''' Start simulating the tile of this node. All partitions start with
+            the complete traffic: only keep the aircraft in this tile. '''
+        self.tile = self.members.index(bs.net.node_id)
+        traf = bs.traf
+        away = np.flatnonzero(self.owner(traf.lat, traf.lon) != self.tile)
+        if len(away):
+            traf.delete(away)
+        self.known = set(traf.id)
+        # Conflicts before partitioning are counted by the first partition
+        if self.tile > 0:
+            traf.cd.confpairs_all.clear()
+            traf.cd.lospairs_all.clear()
+
+    def exchange(self):
+        ''' Migrate aircraft that left this tile, send the halos of the other
+            tiles to their partitions, and ask the server to continue when
+            all partitions have reached this step. '''
+        traf = bs.traf
+        self.nsync += 1
+        owner = self.owner(traf.lat, traf.lon)
+        away = owner != self.tile
+        new = np.array([acid not in self.known for acid in traf.id], dtype=bool)
+
+        # Aircraft in the halo of each other tile. These include migrants,
+        # but not the new aircraft of other tiles
+        candidates = np.flatnonzero(~(away & new))
+        ghosts = ghostdata(candidates)
+        reach = self.ownreach()
+        dist = self.halodist()
+        for tile, node_id in enumerate(self.members):
+            if tile != self.tile:
+                sel = self.inhalo(tile, ghosts['lat'], ghosts['lon'], dist) & \
+                    (owner[candidates] != tile)
+                bs.net.send(b'HALO', dict(nsync=self.nsync, reach=reach,
+                                          ghosts=select(ghosts, sel)), node_id)
+
+        # Migrate aircraft that left this tile. New aircraft are created by
+        # all partitions: only the partition of their tile keeps them.
+        migrants = np.flatnonzero(away & ~new)
+        self.migrants = ghostdata(migrants)
+        for tile in np.unique(owner[migrants]):
+            idx = migrants[owner[migrants] == tile]
+            bs.net.send(b'MIGRATE', dict(nsync=self.nsync, **migrate(idx)), self.members[tile])
+        self.nout += len(migrants)
+        gone = np.flatnonzero(away)
+        if len(gone):
+            traf.delete(gone)
+        self.known = set(traf.id)
+
+        # Aircraft that migrated to this tile before this node reached this step
+        pending = [migration for nsync, migration in self.pending if nsync <= self.nsync]
+        self.pending = [(nsync, migration) for nsync, migration in self.pending
+                        if nsync > self.nsync]
+        for migration in pending:
+            self.arrive(**migration)
+
+        self.waiting = True
+        self.tsync = time.perf_counter()
+        bs.net.send(b'PSYNC', self.nsync, bs.net.server_id)
+
+    def arrive(self, n, rows, conflicts, losses):
+        ''' Continue the simulation of n aircraft that entered this tile. '''
+        insert(n, rows)
+        self.known.update(bs.traf.id[-n:])
+        self.nin += n
+        # Ongoing conflicts of these aircraft were already counted
+        cd = bs.traf.cd
+        cd.confpairs_unique.update(frozenset(pair) for pair in conflicts)
+        cd.lospairs_unique.update(frozenset(pair) for pair in losses)
+
+    def ghosts(self):
+        ''' Return the combined ghosts that all other partitions sent for
+            the current synchronisation. '''
+        halos = [halo for halo in self.halos.pop(self.nsync, dict()).values() if len(halo['id'])]
+        if self.migrants is not None and len(self.migrants['id']):
+            halos.append(self.migrants)
+        if not halos:
+            return None
+        ghosts = {name: np.concatenate([halo[name] for halo in halos])
+                  for name in GHOSTVARS + GHOSTPARAMS}
+        ids = np.concatenate([np.asarray(halo['id'], dtype=str) for halo in halos])
+        # A migrant can also be in the halo of the partition it migrated to
+        _, first = np.unique(ids, return_index=True)
+        ghosts = {name: values[first] for name, values in ghosts.items()}
+        ghosts['id'] = list(ids[first])
+        return ghosts
+
+    def leave(self):
+        ''' Stop taking part in a partitioned simulation. '''
+        if self.members and bs.net is not None:
+            bs.net.send(b'PARTITION', [], bs.net.server_id)
+        self.members = []
+        self.tile = None
+        self.npending = 0
+        self.clear()
+
+
+def ghostdata(idx):
+    ''' Return the ghost data of own aircraft idx. '''
+    traf = bs.traf
+    data = {name: getattr(traf, name)[idx] for name in GHOSTVARS}
+    data.update({name: getattr(traf.cd, name)[idx] for name in GHOSTPARAMS})
+    data['id'] = [traf.id[i] for i in idx]
+    return data
+
+
+def select(data, sel):
+    ''' Return the items of ghost data selected by boolean array sel. '''
+    return {name: (values[sel] if isinstance(values, np.ndarray) else
+                   [v for v, s in zip(values, sel) if s]) for name, values in data.items()}
+
+
+def migrate(idx):
+    ''' Return the complete state of aircraft idx: the values of each traffic
+        array of each TrafficArrays object, and their conflicts. '''
+    root = TrafficArrays.root
+    nodes = dict(walk(root, type(root).__name__))
+    refs = references(nodes)
+    rows = dict()
+    for path, node in nodes.items():
+        rows[path] = {name: dumpstate(node.__dict__[name][idx], refs) for name in node._ArrVars}
+        rows[path].update({name: dumpstate([node.__dict__[name][i] for i in idx], refs)
+                           for name in node._LstVars})
+    ids = {root.id[i] for i in idx}
+    cd = root.cd
+    return dict(n=len(idx), rows=rows,
+                conflicts=[list(pair) for pair in cd.confpairs_unique if pair & ids],
+                losses=[list(pair) for pair in cd.lospairs_unique if pair & ids])
+
+
+def insert(n, rows):
+    ''' Create n aircraft from their complete state. '''
+    root = TrafficArrays.root
+    nodes = dict(walk(root, type(root).__name__))
+    TrafficArrays.create(root, n)
+    root.ntraf += n
+    root.create_children(n)
+    for path, values in rows.items():
+        node = nodes.get(path)
+        if node is None:
+            continue
+        for name, data in values.items():
+            if data is not None and node.istrafarray(name):
+                node.__dict__[name][-n:] = StateUnpickler(io.BytesIO(data), nodes).load()
+    for route in root.ap.route[-n:]:
+        Route._routes[route.acid] = route
+    root.idmap = None
+
+
+# The partition of this node
+_partition = Partition()
+
+
+def ready():
+    ''' Returns True when this node can perform its next simulation step. '''
+    return _partition.ready()
+
+
+@timed_function(hook='reset')
+def reset():
+    ''' A reset ends the participation in a partitioned simulation. '''
+    _partition.leave()
+
+
+@subscriber(topic='FORK', broadcast=False)
+def on_fork(node_ids):
+    ''' The server reserved node ids for the other partitions. '''
+    if _partition.npending and len(node_ids) == _partition.npending:
+        _partition.members = [bs.net.node_id] + list(node_ids)
+        _partition.npending = 0
+        bs.net.send(b'PARTITION', _partition.members, bs.net.server_id)
+
+
+@subscriber(topic='PSYNC', broadcast=False)
+def on_psync(nsync):
+    ''' All partitions have reached synchronisation nsync. '''
+    _partition.nreleased = max(_partition.nreleased, nsync)
+
+
+@subscriber(topic='HALO', broadcast=False)
+def on_halo(nsync, reach, ghosts):
+    ''' Store the ghosts that another partition sends for this tile. '''
+    _partition.halos.setdefault(nsync, dict())[ctx.sender_id] = ghosts
+    _partition.reach[ctx.sender_id] = reach
+
+
+@subscriber(topic='MIGRATE', broadcast=False)
+def on_migrate(nsync, n, rows, conflicts, losses):
+    ''' Continue the simulation of aircraft that entered this tile, when
+        this node has reached the synchronisation of their migration. '''
+    migration = dict(n=n, rows=rows, conflicts=conflicts, losses=losses)
+    if nsync > _partition.nsync:
+        _partition.pending.append((nsync, migration))
+    else:
+        _partition.arrive(**migration)
+
+
+@command(name='PARTITION')
+def partition(nlat: int = 0, nlon: int = 1):
+    ''' PARTITION [nlat, nlon]: Continue this simulation with one simulation
+        node per tile of a grid of nlat x nlon geographic tiles. Tile
+        boundaries divide the current traffic evenly. Without arguments,
+        show the state of the partition of this node. '''
+    part = _partition
+    if not nlat:
+        if part.tile is None:
+            return True, 'PARTITION: This simulation is not partitioned'
+        lat0, lat1, lon0, lon1 = part.box(part.tile)
+        cd = bs.traf.cd
+        return True, f'PARTITION: Tile {part.tile + 1} of {len(part.members)}, ' \
+            f'lat {lat0:.2f} to {lat1:.2f}, lon {lon0:.2f} to {lon1:.2f}\n' \
+            f'{bs.traf.ntraf} aircraft, {len(cd.ghosts["id"]) if cd.ghosts else 0} ghosts, ' \
+            f'{part.nin} migrated in, {part.nout} migrated out\n' \
+            f'{part.nsync} synchronisations, {1e3 * part.twait / max(1, part.nsync):.2f} ms wait per step\n' \
+            f'{len(cd.confpairs_all)} conflicts, {len(cd.lospairs_all)} losses of separation counted'
+
+    ntiles = nlat * nlon
+    if part.members or part.npending:
+        return False, 'PARTITION: This simulation is already partitioned'
+    if ntiles < 2:
+        return False, 'PARTITION: At least two tiles are needed'
+    if bs.traf.ntraf < ntiles:
+        return False, f'PARTITION: Need at least {ntiles} aircraft to divide over {ntiles} tiles'
+    if ConflictResolution.selected() is not ConflictResolution:
+        return False, 'PARTITION: Conflict resolution across tiles is not supported. Use RESO OFF'
+    if bs.sim.rtmode:
+        return False, 'PARTITION: Partitions need fixed timesteps. Use REALTIME OFF'
+
+    part.latbounds = np.quantile(bs.traf.lat, np.arange(1, nlat) / nlat)
+    part.lonbounds = np.quantile(bs.traf.lon, np.arange(1, nlon) / nlon)
+    part.npending = ntiles - 1
+    bs.sim.branchvariants = [None] * part.npending
+    bs.net.send(b'BRANCH', part.npending, bs.net.server_id)
+    return True, f'PARTITION: Requested {part.npending} nodes from server'
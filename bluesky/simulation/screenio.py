@@ -5,10 +5,18 @@ import numpy as np
 # Local imports
 import bluesky as bs
 from bluesky import stack
-from bluesky.core import Entity
+from bluesky.core import Entity, signal
 from bluesky.tools import aero
 from bluesky.core.walltime import Timer
-from bluesky.network.publisher import state_publisher, StatePublisher
+from bluesky.network import compact, subscriber
+from bluesky.network import context as ctx
+from bluesky.network.publisher import state_publisher, StatePublisher, PublisherMeta, periodic_publishers
+from bluesky.network.netstats import format_stats
+from bluesky.simulation.viewport import Viewports
+
+
+# Register settings defaults
+bs.settings.set_variable_defaults(acdata_compact=False)
 
 
 # =========================================================================
@@ -49,6 +57,12 @@ class ScreenIO(Entity):
         self.samplecount = 0
         self.prevcount   = 0
 
+        # Encoder for compact aircraft data messages
+        self.acencoder = compact.Encoder()
+
+        # Registered client viewports for aircraft data
+        self.viewports = Viewports()
+
         # Output event timers
         self.slow_timer = Timer(1000 // SIMINFO_RATE)
         self.slow_timer.timeout.connect(self.send_siminfo)
@@ -105,6 +119,57 @@ class ScreenIO(Entity):
         elif name in bs.traf.id:
             self.custacclr[name] = (r, g, b)
 
+    @stack.command(name='PUBRATE', annotations='txt,float,float')
+    def pubrate(self, topic='', dtmin=0.0, dtmax=0.0):
+        ''' PUBRATE: Show the adaptive publishing interval of periodically
+            published topics, or set the interval limits [ms] of a topic.
+
+            Usage:
+            - PUBRATE
+            - PUBRATE topic dtmin,dtmax
+        '''
+        publishers = periodic_publishers()
+        if not topic:
+            lines = [f'{topic}: interval {s["interval"]:.0f} ms '
+                     f'[{s["dtmin"]:.0f}-{s["dtmax"]:.0f}], cost {s["cost"]:.2f} ms, '
+                     f'lag {s["lag"]:.0f} ms, sent {s["nsent"]}, dropped {s["ndropped"]}'
+                     for topic, s in ((t, p.stats()) for t, p in publishers.items())]
+            return True, '\n'.join(lines)
+        pub = publishers.get(topic)
+        if pub is None:
+            return False, f'PUBRATE: {topic} is not a periodically published topic'
+        if dtmin <= 0.0 or dtmax < dtmin:
+            return False, 'PUBRATE: dtmin should be positive, and not larger than dtmax'
+        pub.dtmin, pub.dtmax = dtmin, dtmax
+        pub.interval = min(dtmax, max(dtmin, pub.interval))
+        return True, f'PUBRATE: Interval of {topic} between {dtmin:.0f} and {dtmax:.0f} ms'
+
+    @stack.command(name='NETSTATS', annotations='txt')
+    def netstats(self, cmd=''):
+        ''' NETSTATS: Show the messages, bytes, encode and decode time, and
+            latency per topic sent and received by this node, the lag and
+            latency of each receiver of published topics, and the messages
+            forwarded by the server. NETSTATS RESET restarts counting.
+
+            Usage:
+            - NETSTATS [RESET]
+        '''
+        if cmd and cmd.upper() != 'RESET':
+            return False, 'NETSTATS: Unknown argument, use NETSTATS [RESET]'
+        lines = format_stats(bs.net.netstats.stats())
+        receivers = {topic: pub.receivers() for topic, pub in PublisherMeta.__publishers__.items()}
+        if any(receivers.values()):
+            lines.append('Receivers:')
+            for topic, stats in receivers.items():
+                lines.extend(f'  {topic} {receiver}: lag {s["lag"]:.1f} ms, '
+                             f'latency {s["latency"]:.1f} ms, dropped {s["ndropped"]}'
+                             for receiver, s in stats.items())
+        if cmd:
+            bs.net.netstats.reset()
+        # The server replies with its own statistics
+        bs.net.send(b'NETSTATS', [stack.sender() or b'', bool(cmd)], bs.net.server_id)
+        return True, '\n'.join(lines)
+
     # =========================================================================
     # Slots
     # =========================================================================
@@ -125,10 +190,24 @@ class ScreenIO(Entity):
             data = dict(traillat0=bs.traf.trails.newlat0,
                         traillon0=bs.traf.trails.newlon0,
                         traillat1=bs.traf.trails.newlat1,
-                        traillon1=bs.traf.trails.newlon1)
+                        traillon1=bs.traf.trails.newlon1,
+                        trailtime=bs.traf.trails.newtime)
             bs.traf.trails.clearnew()
             return data
 
+    @state_publisher(topic='PUBSTATS', dt=1000 // SIMINFO_RATE)
+    def send_pubstats(self):
+        # Adaptive publishing intervals and statistics per topic
+        return {topic: pub.stats() for topic, pub in periodic_publishers().items()}
+
+    @state_publisher(topic='NETSTATS', dt=1000 // SIMINFO_RATE)
+    def send_netstats(self):
+        # Message statistics of this node, and the lag and latency of each
+        # receiver of published topics
+        return dict(node=bs.net.netstats.stats(),
+                    receivers={topic: pub.receivers() for topic, pub in
+                               PublisherMeta.__publishers__.items()})
+
     @state_publisher(topic='ACDATA', dt=1000 // ACUPDATE_RATE)
     def send_aircraft_data(self):
         data = dict()
@@ -169,8 +248,59 @@ class ScreenIO(Entity):
         if self.custgrclr:
             data['custgrclr'] = self.custgrclr
 
+        if ctx.sender_id is not None:
+            # A response to a full state request is sent as keyframe, with
+            # only the aircraft in the viewport of the requesting client
+            viewport = self.viewports.clients.get(ctx.sender_id)
+            if viewport is not None:
+                data = self.viewports.select(
+                    data, self.viewports.mask(viewport, bs.traf.lat, bs.traf.lon))
+            return self.encode_aircraft_data(data, ctx.sender_id, keyframe=True)
+
+        # Clients with a viewport are sent their selection directly
+        for viewport, clients in self.viewports.due().items():
+            selection = self.viewports.select(
+                data, self.viewports.mask(viewport, bs.traf.lat, bs.traf.lon))
+            selection = self.encode_aircraft_data(selection, clients[0])
+            for client_id in clients:
+                StatePublisher('ACDATA').send_replace(client_id, **selection)
+
+        if not StatePublisher('ACDATA').hassubscribers(broadcast=True):
+            # All clients receive their viewport selection, don't encode
+            # the broadcast data for nobody
+            return None
+        return self.encode_aircraft_data(data)
+
+    def encode_aircraft_data(self, data, client_id=None, keyframe=False):
+        ''' Compact-encode aircraft data when enabled, with the encoder of the
+            viewport of client_id, or the encoder of the broadcast data. '''
+        if bs.settings.acdata_compact:
+            encoder = self.viewports.encoder(client_id) or self.acencoder
+            return encoder.encode(data, keyframe)
         return data
 
+    @subscriber(topic='ACKFRAME', broadcast=False)
+    def ackframe(self, topic, nframe):
+        ''' A client acknowledges that it has decoded a compact frame. '''
+        if topic == 'ACDATA':
+            encoder = self.viewports.encoder(ctx.sender_id) or self.acencoder
+            encoder.ack(ctx.sender_id, nframe)
+
+    @subscriber(topic='VIEWPORT', broadcast=False)
+    def viewport(self, *bounds):
+        ''' A client registers its viewport as (south lat, north lat,
+            west lon, east lon, zoom), or removes it when no bounds are given. '''
+        if bounds:
+            self.viewports.set(ctx.sender_id, *bounds)
+        else:
+            self.viewports.remove(ctx.sender_id)
+
+    @signal.subscriber(topic='client-removed')
+    def on_client_removed(self, client_id):
+        ''' Forget the viewport and route selection of a disconnected client. '''
+        self.viewports.remove(client_id)
+        self.client_route.pop(client_id, None)
+
     def send_route_data(self):
         ''' Send route data to client(s) '''
         # Case 1: A route is selected by one or more specific clients
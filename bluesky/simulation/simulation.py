@@ -1,4 +1,6 @@
 ''' BlueSky simulation control object. '''
+import os
+import sys
 import time
 import datetime
 import signal
@@ -11,7 +13,9 @@ from bluesky.core.base import Base
 import bluesky.core as core
 from bluesky.core import plugin, simtime
 from bluesky.network import subscriber
+from bluesky.network.server import split_scenarios
 from bluesky.network.publisher import state_publisher, StatePublisher
+from bluesky.simulation import partition
 from bluesky.core.walltime import Timer
 from bluesky.core.timedfunction import hooks
 from bluesky.stack import simstack, recorder
@@ -62,6 +66,11 @@ class Simulation(Base):
         # Keep track of known clients
         self.clients = set()
 
+        # Scenario variants of a BRANCH command, node ids and process ids of branches
+        self.branchvariants = []
+        self.branchids = []
+        self.branchpids = []
+
         # Connect to system ABORT/INTERRUPT signal
         signal.signal(signal.SIGINT, lambda *args: self.quit())
         signal.signal(signal.SIGTERM, lambda *args: self.quit())
@@ -77,6 +86,9 @@ class Simulation(Base):
             Timer.update_timers()
             # Update network connections
             bs.net.update()
+            # Fork when the server has reserved nodes for a BRANCH command
+            if self.branchids:
+                self.forkbranches()
             # Perform a simulation step
             self.update()
 
@@ -90,6 +102,12 @@ class Simulation(Base):
         # Close savefile which may be open for recording
         recorder.saveclose()  # Close reording file if it is on
 
+        # A forked node can't run the exit handlers of its parent process:
+        # these would hang on the inherited network context
+        if getattr(bs.net, 'forked', False):
+            sys.stdout.flush()
+            os._exit(0)
+
     def step(self, dt_increment=0):
         ''' Perform one simulation timestep.
         
@@ -98,13 +116,17 @@ class Simulation(Base):
         '''
         if self.state == bs.INIT:
             # Simulation starts as soon as there is traffic, or pending commands
-            if bs.traf.ntraf > 0 or len(bs.stack.get_scendata()[0]) > 0:
+            if bs.traf.ntraf > 0 or len(simstack.Stack.scen) > 0:
                 self.op()
 
         # Always update stack
         simstack.process()
 
         if self.state == bs.OP:
+            # A partitioned simulation advances together with its other partitions
+            if not partition.ready():
+                return
+
             # Plot/log the current timestep, and call preupdate functions
             plotter.update()
             datalog.update()
@@ -246,7 +268,7 @@ class Simulation(Base):
         # send to server and clear stack
         self.reset()
         try:
-            scentime, scencmd = zip(*[tc for tc in simstack.readscn(fname)])
+            scentime, scencmd = simstack.loadscn(fname)
             bs.net.send(b'BATCH', (scentime, scencmd), bs.net.server_id)
         except FileNotFoundError:
             return False, f'BATCH: File not found: {fname}'
@@ -261,6 +283,85 @@ class Simulation(Base):
         bs.stack.set_scendata(scentime, scencmd)
         self.op()
 
+    def branch(self, count=0, fname=''):
+        ''' Fork the running simulation into [count] copies, that each continue
+            as a new simulation node with one scenario variant from fname.
+
+            Arguments:
+            - count: The number of copies. When omitted, one copy is made
+              for each variant.
+            - fname: A scenario file with variants in batch format: each
+              variant starts with a SCEN command. Timestamps are relative
+              to the time of branching.
+        '''
+        variants = []
+        if fname:
+            try:
+                variants = list(split_scenarios(*simstack.loadscn(fname)))
+            except FileNotFoundError:
+                return False, f'BRANCH: File not found: {fname}'
+        count = count or len(variants)
+        if count < 1:
+            return False, 'BRANCH: No branches to create'
+        if len(variants) > count:
+            return False, f'BRANCH: {len(variants)} variants for {count} branches'
+
+        # Hold until the server has reserved node ids for the branches
+        self.hold()
+        self.branchvariants = variants + [None] * (count - len(variants))
+        bs.net.send(b'BRANCH', count, bs.net.server_id)
+        return True, f'BRANCH: Requested {count} nodes from server'
+
+    def record(self, fname=''):
+        ''' Record the state streams of this simulation for replay, or
+            stop recording when no filename is given. '''
+        if fname:
+            path = bs.resource(bs.settings.log_path) / fname
+            fname = str(path if path.suffix else path.with_suffix('.bsr'))
+        bs.net.send(b'RECORD', fname, bs.net.server_id)
+        return True
+
+    def replay(self, fname):
+        ''' Start a replay node for a recording made with RECORD. '''
+        path = bs.resource(bs.settings.log_path) / fname
+        path = path if path.suffix else path.with_suffix('.bsr')
+        if not path.is_file():
+            return False, f'REPLAY: File not found: {path}'
+        bs.net.send(b'REPLAY', str(path), bs.net.server_id)
+        return True, f'REPLAY: Starting replay node for {path}'
+
+    @subscriber(topic='FORK', broadcast=False)
+    def on_fork_received(self, node_ids):
+        ''' Fork as soon as possible, outside of network processing. '''
+        self.branchids = node_ids
+
+    def forkbranches(self):
+        ''' Fork this simulation into one new node per reserved node id. '''
+        # Clean up earlier branches that have finished
+        self.branchpids = [pid for pid in self.branchpids if os.waitpid(pid, os.WNOHANG)[0] == 0]
+
+        # Buffered output would otherwise be written by both processes
+        sys.stdout.flush()
+        datalog.flush()
+
+        node_ids, self.branchids = self.branchids, []
+        pids = dict()
+        for node_id, variant in zip(node_ids, self.branchvariants):
+            pid = bs.net.fork(node_id)
+            if pid == 0:
+                # This is the branch: start its variant
+                self.branchvariants = []
+                self.branchpids = []
+                datalog.reset()
+                if variant:
+                    simstack.merge(zip(variant['scentime'], variant['scencmd']))
+                self.op()
+                return
+            pids[node_id] = pid
+        self.branchvariants = []
+        self.branchpids.extend(pids.values())
+        bs.net.send(b'FORKED', pids, bs.net.server_id)
+
     @state_publisher(topic='SIMSETTINGS')
     def pub_simsettings(self):
         ''' Publish simulation settings on request. '''
@@ -0,0 +1,103 @@
+''' Per-client viewports for published aircraft data.
+
+    Clients can register the part of the world they are looking at (a
+    lat/lon bounding box and a zoom level) with a simulation node. These
+    clients are sent only the aircraft inside their viewport (plus a
+    margin), and clients that are zoomed far out are sent updates at a
+    reduced rate. The selection mask is computed once per distinct viewport,
+    and shared by all clients with that viewport.
+'''
+import numpy as np
+
+import bluesky as bs
+from bluesky.network import compact
+
+
+# Register settings defaults
+bs.settings.set_variable_defaults(viewport_margin=0.1, viewport_lod_zoom=0.1,
+                                  viewport_lod_interval=5)
+
+
+class Viewports:
+    ''' Registered client viewports of a simulation node. '''
+    def __init__(self):
+        # Viewport per client id. A viewport is a tuple of
+        # (south lat, north lat, west lon, east lon, zoom)
+        self.clients = dict()
+        # Compact encoders per viewport
+        self.encoders = dict()
+        # Number of published updates, to reduce the rate of zoomed-out viewports
+        self.nupdate = 0
+
+    def set(self, client_id, lat0, lat1, lon0, lon1, zoom=1.0):
+        ''' Register the viewport of a client. When lon0 > lon1 the
+            viewport crosses the date line. '''
+        self.clients[client_id] = (min(lat0, lat1), max(lat0, lat1),
+                                   float(lon0), float(lon1), float(zoom))
+        self._prune()
+
+    def remove(self, client_id):
+        ''' Remove the viewport of a client. '''
+        self.clients.pop(client_id, None)
+        self._prune()
+
+    def groups(self):
+        ''' Return a dict with the client ids per distinct viewport. '''
+        groups = dict()
+        for client_id, viewport in self.clients.items():
+            groups.setdefault(viewport, []).append(client_id)
+        return groups
+
+    def due(self):
+        ''' Advance the update counter, and return the client ids per viewport
+            that should receive this update. Viewports zoomed out beyond
+            viewport_lod_zoom are only updated every viewport_lod_interval updates. '''
+        self.nupdate += 1
+        lowrate = self.nupdate % max(1, bs.settings.viewport_lod_interval) == 0
+        return {viewport: clients for viewport, clients in self.groups().items()
+                if lowrate or viewport[4] >= bs.settings.viewport_lod_zoom}
+
+    @staticmethod
+    def mask(viewport, lat, lon):
+        ''' Vectorised selection of the positions inside viewport, with a margin
+            of viewport_margin times the viewport size on each side. '''
+        lat0, lat1, lon0, lon1, _ = viewport
+        width = (lon1 - lon0) % 360.0 if lon1 < lon0 else lon1 - lon0
+        dlat = bs.settings.viewport_margin * (lat1 - lat0)
+        dlon = bs.settings.viewport_margin * width
+        inside = (lat >= lat0 - dlat) & (lat <= lat1 + dlat)
+        if width + 2.0 * dlon < 360.0:
+            inside &= (lon - (lon0 - dlon)) % 360.0 <= width + 2.0 * dlon
+        return inside
+
+    @staticmethod
+    def select(data, inside):
+        ''' Return a copy of data with only the aircraft selected by inside. '''
+        ntraf = len(inside)
+        idx = np.flatnonzero(inside)
+        selection = dict()
+        for name, value in data.items():
+            if isinstance(value, np.ndarray) and value.shape[:1] == (ntraf,):
+                selection[name] = value[idx]
+            elif isinstance(value, list) and len(value) == ntraf:
+                selection[name] = [value[i] for i in idx]
+            else:
+                selection[name] = value
+        return selection
+
+    def encoder(self, client_id):
+        ''' Return the compact encoder for the viewport of client_id,
+            or None if this client has no viewport. '''
+        viewport = self.clients.get(client_id)
+        if viewport is None:
+            return None
+        encoder = self.encoders.get(viewport)
+        if encoder is None:
+            encoder = self.encoders[viewport] = compact.Encoder()
+        return encoder
+
+    def _prune(self):
+        ''' Remove encoders of viewports that are no longer in use. '''
+        inuse = set(self.clients.values())
+        for viewport in [v for v in self.encoders if v not in inuse]:
+            del self.encoders[viewport]
@@ -93,6 +93,12 @@ def initbasecmds():
             "Start a scenario file as batch simulation",
         ],
         "BLUESKY": ["BLUESKY", "", singbluesky, "Sing"],
+        "BRANCH": [
+            "BRANCH [n,variantfile]",
+            "[int,string]",
+            bs.sim.branch,
+            "Fork the running simulation into n nodes, each running one variant",
+        ],
         "BENCHMARK": [
             "BENCHMARK [scenfile,time]",
             "[string,time]",
@@ -324,6 +330,18 @@ def initbasecmds():
             "[bool]",
             bs.sim.realtime,
             "En-/disable realtime running allowing a variable timestep."],
+        "RECORD": [
+            "RECORD [filename]",
+            "[string]",
+            bs.sim.record,
+            "Record the state streams of this simulation, or stop recording",
+        ],
+        "REPLAY": [
+            "REPLAY filename",
+            "string",
+            bs.sim.replay,
+            "Replay a recording in a new node",
+        ],
         "RESET": ["RESET", "", bs.sim.reset, "Reset simulation"],
         "SEED": [
             "SEED value",
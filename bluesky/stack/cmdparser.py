@@ -64,6 +64,20 @@ class Command:
         self.callback = func
 
     def __call__(self, argstring):
+        # Call callback function with parsed parameters
+        ret = self.callback(*self.parse(argstring))
+        # Always return a tuple with a success value and a message string
+        if ret is None:
+            return True, ''
+        if isinstance(ret, (tuple, list)) and ret:
+            if len(ret) > 1:
+                # Assume that (success, echotext) is returned
+                return ret[:2]
+            ret = ret[0]
+        return ret, ''
+
+    def parse(self, argstring):
+        ''' Parse argstring into the list of arguments for the callback. '''
         args = []
         param = None
         # Use callback-specified parameter parsers to generate param list from strings
@@ -87,18 +101,7 @@ class Command:
             result = param(argstring)
             argstring = result[-1]
             args.extend(result[:-1])
-
-        # Call callback function with parsed parameters
-        ret = self.callback(*args)
-        # Always return a tuple with a success value and a message string
-        if ret is None:
-            return True, ''
-        if isinstance(ret, (tuple, list)) and ret:
-            if len(ret) > 1:
-                # Assume that (success, echotext) is returned
-                return ret[:2]
-            ret = ret[0]
-        return ret, ''
+        return args
 
     def __repr__(self):
         if self.valid:
@@ -1,11 +1,12 @@
 ''' BlueSky scenario recorder. '''
-import math
 from pathlib import Path
+import numpy as np
 
 import bluesky as bs
-from bluesky.tools.aero import kts, ft, fpm, tas2cas, density,casormach2tas
+from bluesky.tools.aero import kts, ft, fpm, vtas2cas, vcasormach2tas
 from bluesky.tools.misc import tim2txt
 from bluesky.stack.cmdparser import command, commandgroup
+from bluesky.stack import scncache
 
 # When SAVEIC is used, we will also have a recording scenario file handle
 savefile = None  # File object of recording scenario file
@@ -35,11 +36,19 @@ defexcl = [
 saveexcl = defexcl
 # simt time of moment of SAVEIC command, 00:00:00.00 in recorded file
 saveict0 = 0.0
+# Store the recorded scenario in compiled form when recording is closed
+savecompiled = False
 
 @commandgroup
-def saveic(filename: 'word' = ''):
-    """ Save the current traffic realization in a scenario file. """
-    global savefile, saveict0
+def saveic(filename: 'word' = '', fmt: 'txt' = ''):
+    """ Save the current traffic realization in a scenario file.
+
+        Arguments:
+        - filename: The name of the scenario file
+        - fmt: COMPILED to also store the scenario in compiled form
+          (for fast reloading) when recording is closed
+    """
+    global savefile, saveict0, savecompiled
 
     # No args? Give current status
     if not filename:
@@ -63,101 +72,84 @@ def saveic(filename: 'word' = ''):
     except:
         return False, "Error writing to file"
 
-    # Write files
-    timtxt = "00:00:00.00>"  # Current time will be zero
+    # Write snapshot of current traffic in one go, at time zero
     saveict0 = bs.sim.simt
-
-    for i in range(bs.traf.ntraf):
-        # CRE acid,type,lat,lon,hdg,alt,spd
-        cmdline = (f'CRE {bs.traf.id[i]},{bs.traf.type[i]},{bs.traf.lat[i]},'
-                   f'{bs.traf.lon[i]},{bs.traf.trk[i]},{bs.traf.alt[i] / ft},'
-                   f'{tas2cas(bs.traf.tas[i], bs.traf.alt[i]) / kts}')
-
-        f.write(timtxt + cmdline + "\n")
-
-
-        # Autopilot commands
-        # Altitude & VS
-        if abs(bs.traf.alt[i] - bs.traf.ap.alt[i]) > 10.0:
-            cmdline = "ALT " + bs.traf.id[i] + \
-                "," + repr(bs.traf.ap.alt[i] / ft)
-            f.write(timtxt + cmdline + "\n")
-
-            # VS acid,vs
-            if abs(bs.traf.vs[i]) > 0.05:  # 10 fpm dead band
-                if abs(bs.traf.ap.vs[i]) > 0.05:
-                    vs_ = bs.traf.ap.vs[i] / fpm
-                else:
-                    vs_ = bs.traf.vs[i] / fpm
-
-                cmdline = f'VS {bs.traf.id[i]},{vs_}'
-                f.write(timtxt + cmdline + "\n")
-
-        # Heading as well when heading select
-        delhdg = (bs.traf.hdg[i] - bs.traf.ap.trk[i] + 180.0) % 360.0 - 180.0
-        if abs(delhdg) > 0.5:
-            cmdline = "HDG " + bs.traf.id[i] + "," + repr(bs.traf.ap.trk[i])
-            f.write(timtxt + cmdline + "\n")
-
-        # Speed select mode? => Record a speed command
-        aptas = casormach2tas(bs.traf.selspd[i],bs.traf.ap.spd[i])
-        delspd = aptas - bs.traf.tas[i]
-
-        if abs(delspd) > 0.5*kts: # difference equal more than 1 knot (rounded), so 0.5* 0.514444 m/s
-            if not(0.001<bs.traf.selspd[i]<1.0): # Check for Mach
-                spdcmd = round(bs.traf.selspd[i]/kts,2)
-            else:
-                spdcmd = bs.traf.selspd[i]
-
-            cmdline = "SPD " + bs.traf.id[i] + \
-                "," + repr(spdcmd)
-            f.write(timtxt + cmdline + "\n")
-
-        # DEST acid,dest-apt
-        if bs.traf.ap.dest[i] != "":
-            cmdline = "DEST " + bs.traf.id[i] + "," + bs.traf.ap.dest[i]
-            f.write(timtxt + cmdline + "\n")
-
-        # ORIG acid,orig-apt
-        if bs.traf.ap.orig[i] != "":
-            cmdline = "ORIG " + bs.traf.id[i] + "," + bs.traf.ap.orig[i]
-            f.write(timtxt + cmdline + "\n")
-
-        # Route with ADDWPT
-        route = bs.traf.ap.route[i]
-        for iwp in range(route.nwp):
-            # dets and orig al already done, skip them here
-            if iwp == 0 and route.wpname[iwp] == bs.traf.ap.orig[i]:
-                continue
-
-            if iwp == route.nwp - 1 and route.wpname[iwp] == bs.traf.ap.dest[i]:
-                continue
-
-            # add other waypoints
-            cmdline = "ADDWPT " + bs.traf.id[i] + " "
-            wpname = route.wpname[iwp]
-            if wpname[: len(bs.traf.id[i])] == bs.traf.id[i]:
-                wpname = repr(route.wplat[iwp]) + "," + repr(route.wplon[iwp])
-            cmdline = cmdline + wpname + ","
-
-            if route.wpalt[iwp] >= 0.0:
-                cmdline = cmdline + repr(route.wpalt[iwp] / ft) + ","
-            else:
-                cmdline = cmdline + ","
-
-            if route.wpspd[iwp] >= 0.0:
-                if route.wpspd[iwp] > 1.0:
-                    cmdline = cmdline + repr(route.wpspd[iwp] / kts)
-                else:
-                    cmdline = cmdline + repr(route.wpspd[iwp])
-
-            f.write(timtxt + cmdline + "\n")
+    savecompiled = (fmt == 'COMPILED')
+    f.write(''.join(f'00:00:00.00>{cmdline}\n' for cmdline in snapshot()))
 
     # Saveic: save file
     savefile = f
     return True
 
 
+def snapshot():
+    """ Return the stack commands that recreate the current traffic,
+        including autopilot state and routes.
+        Commands of the same type are grouped for all aircraft. """
+    traf, ap = bs.traf, bs.traf.ap
+    acid = traf.id
+
+    # CRE acid,type,lat,lon,hdg,alt,spd
+    cmdlines = [f'CRE {i},{t},{lat},{lon},{trk},{alt},{cas}' for i, t, lat, lon, trk, alt, cas in
+                zip(acid, traf.type, traf.lat.tolist(), traf.lon.tolist(), traf.trk.tolist(),
+                    (traf.alt / ft).tolist(), (vtas2cas(traf.tas, traf.alt) / kts).tolist())]
+
+    # Altitude & VS
+    altsel = np.abs(traf.alt - ap.alt) > 10.0
+    cmdlines += [f'ALT {acid[i]},{alt}' for i, alt in
+                 zip(np.flatnonzero(altsel), (ap.alt[altsel] / ft).tolist())]
+    # 10 fpm dead band
+    vssel = altsel & (np.abs(traf.vs) > 0.05)
+    vs = np.where(np.abs(ap.vs) > 0.05, ap.vs, traf.vs)
+    cmdlines += [f'VS {acid[i]},{vs}' for i, vs in
+                 zip(np.flatnonzero(vssel), (vs[vssel] / fpm).tolist())]
+
+    # Heading as well when heading select
+    delhdg = (traf.hdg - ap.trk + 180.0) % 360.0 - 180.0
+    hdgsel = np.abs(delhdg) > 0.5
+    cmdlines += [f'HDG {acid[i]},{hdg}' for i, hdg in
+                 zip(np.flatnonzero(hdgsel), ap.trk[hdgsel].tolist())]
+
+    # Speed select mode? => Record a speed command
+    # difference equal more than 1 knot (rounded), so 0.5* 0.514444 m/s
+    spdsel = np.abs(vcasormach2tas(traf.selspd, traf.alt) - traf.tas) > 0.5 * kts
+    ismach = (traf.selspd > 0.001) & (traf.selspd < 1.0)
+    spd = np.where(ismach, traf.selspd, np.round(traf.selspd / kts, 2))
+    cmdlines += [f'SPD {acid[i]},{spd}' for i, spd in
+                 zip(np.flatnonzero(spdsel), spd[spdsel].tolist())]
+
+    # DEST acid,dest-apt and ORIG acid,orig-apt
+    cmdlines += [f'DEST {i},{dest}' for i, dest in zip(acid, ap.dest) if dest]
+    cmdlines += [f'ORIG {i},{orig}' for i, orig in zip(acid, ap.orig) if orig]
+
+    # Routes with ADDWPT, followed by FMS state
+    fmslines = []
+    for i, (route, orig, dest) in enumerate(zip(ap.route, ap.orig, ap.dest)):
+        if route.nwp == 0:
+            continue
+        for iwp, (wpname, lat, lon, alt, spd) in enumerate(zip(
+                route.wpname, route.wplat, route.wplon, route.wpalt, route.wpspd)):
+            # dest and orig are already done, skip them here
+            if iwp == 0 and wpname == orig or iwp == route.nwp - 1 and wpname == dest:
+                continue
+            # Waypoints named after the aircraft are positions
+            if wpname.startswith(acid[i]):
+                wpname = f'{lat},{lon}'
+            alttxt = f'{alt / ft}' if alt >= 0.0 else ''
+            spdtxt = '' if spd < 0.0 else f'{spd / kts}' if spd > 1.0 else f'{spd}'
+            cmdlines.append(f'ADDWPT {acid[i]} {wpname},{alttxt},{spdtxt}')
+
+        if traf.swlnav[i]:
+            fmslines.append(f'LNAV {acid[i]} ON')
+            if 0 < route.iactwp < route.nwp and not route.wpname[route.iactwp].startswith(acid[i]):
+                fmslines.append(f'DIRECT {acid[i]} {route.wpname[route.iactwp]}')
+            fmslines.append(f'VNAV {acid[i]} {"ON" if traf.swvnav[i] else "OFF"}')
+        else:
+            fmslines.append(f'LNAV {acid[i]} OFF')
+
+    return cmdlines + fmslines
+
+
 @saveic.subcommand(name='EXCEPT')
 def setexcept(*commands: 'txt'):
     ''' Indicate commands that need to be omitted by SAVEIC. '''
@@ -179,6 +171,11 @@ def saveclose():
     global savefile
     if savefile is not None:
         savefile.close()
+        if savecompiled:
+            # Local import, simstack imports this module
+            from bluesky.stack.simstack import parsescn
+            fname = Path(savefile.name)
+            scncache.save(fname, *(list(zip(*parsescn(fname))) or [(), ()]))
 
     savefile = None
     return True
@@ -0,0 +1,158 @@
+''' Compiled scenario files.
+
+    Parsed scenario files are stored in the scenario subdirectory of the
+    cache path as a binary .scnc file, containing the command timestamps as a float64 array,
+    and the command lines as indices into a table of unique command lines.
+    Compiled files can be loaded as a whole, or streamed through a memory map.
+    The compiled file is valid as long as the modification time (or, if
+    only the modification time changed, the contents) of the .scn file
+    are unchanged.
+'''
+import os
+import mmap
+import struct
+import hashlib
+from pathlib import Path
+import numpy as np
+
+import bluesky as bs
+
+
+# Register settings defaults
+bs.settings.set_variable_defaults(cache_path='cache')
+
+
+# Header: magic, mtime [ns] and size of the scenario file, sha1 of the
+# scenario file, number of commands, number of unique commands,
+# size of the string table
+MAGIC = b'BSSCNC02'
+HEADER = struct.Struct('<8sqq20sqqq4x')
+
+# Number of commands decoded at once when streaming a compiled file
+CHUNKSIZE = 4096
+
+
+def cachename(fname):
+    ''' Return the filename of the compiled version of scenario file fname.
+        Compiled files are named after the full path of the scenario file. '''
+    fname = Path(fname).resolve()
+    digest = hashlib.sha1(str(fname).encode()).hexdigest()[:16]
+    return bs.resource(bs.settings.cache_path).joinpath('scenario', f'{fname.stem}-{digest}.scnc')
+
+
+def filehash(fname):
+    ''' Return the sha1 digest of the contents of file fname. '''
+    with open(fname, 'rb') as f:
+        return hashlib.sha1(f.read()).digest()
+
+
+def checkheader(fname, header):
+    ''' Return the header values (n, nstr, nbytes) if the compiled file
+        header is valid for scenario file fname, otherwise None. '''
+    magic, mtime, size, digest, n, nstr, nbytes = HEADER.unpack_from(header)
+    stat = fname.stat()
+    if magic != MAGIC or size != stat.st_size or \
+            (mtime != stat.st_mtime_ns and digest != filehash(fname)):
+        return None
+    return n, nstr, nbytes
+
+
+def load(fname):
+    ''' Load the compiled version of scenario file fname.
+
+        Returns:
+        - (scentime, scencmd): lists of command times and command lines,
+          or None when there is no valid compiled file.
+    '''
+    try:
+        with open(cachename(fname), 'rb') as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            header = checkheader(fname, mm)
+            if header is None:
+                return None
+            n, nstr, nbytes = header
+            offset = HEADER.size
+            scentime = np.frombuffer(mm, np.float64, n, offset).tolist()
+            offset += 8 * n + 8 * (nstr + 1)
+            idx = np.frombuffer(mm, np.uint32, n, offset)
+            offset += 4 * n
+            table = mm[offset:offset + nbytes].decode().split('\n') if nstr else []
+            if len(table) != nstr:
+                return None
+            scencmd = np.array(table, dtype=object)[idx].tolist()
+            del idx
+    except (OSError, ValueError, struct.error, UnicodeDecodeError):
+        return None
+    return scentime, scencmd
+
+
+def stream(fname):
+    ''' Open the compiled version of scenario file fname for streaming.
+
+        Returns:
+        - Iterator over (time, command) tuples, or None when there is
+          no valid compiled file.
+    '''
+    cname = cachename(fname)
+    try:
+        with open(cname, 'rb') as f:
+            header = checkheader(fname, f.read(HEADER.size))
+    except (OSError, struct.error):
+        return None
+    if header is None:
+        return None
+    n, nstr, nbytes = header
+    if n == 0:
+        return iter(())
+    try:
+        offset = HEADER.size
+        times = np.memmap(cname, np.float64, 'r', offset, n)
+        offset += 8 * n
+        strofs = np.memmap(cname, np.int64, 'r', offset, nstr + 1)
+        offset += 8 * (nstr + 1)
+        idx = np.memmap(cname, np.uint32, 'r', offset, n)
+        offset += 4 * n
+        strdata = np.memmap(cname, np.uint8, 'r', offset, max(1, nbytes))
+    except (OSError, ValueError):
+        return None
+
+    def chunks():
+        for start in range(0, n, CHUNKSIZE):
+            cidx = idx[start:start + CHUNKSIZE]
+            cmds = [strdata[i0:i1].tobytes().decode() for i0, i1 in
+                    zip(strofs[cidx].tolist(), (strofs[cidx + 1] - 1).tolist())]
+            yield from zip(times[start:start + CHUNKSIZE].tolist(), cmds)
+    return chunks()
+
+
+def save(fname, scentime, scencmd):
+    ''' Store a compiled version of scenario file fname.
+        Fails silently when the compiled file cannot be written. '''
+    # Intern the command lines in a table of unique lines
+    table = dict()
+    idx = np.fromiter((table.setdefault(cmd, len(table)) for cmd in scencmd),
+                      dtype=np.uint32, count=len(scencmd))
+    strings = [cmd.encode() for cmd in table]
+    strdata = b'\n'.join(strings)
+    # Start offsets of the strings in the table (separated by newlines)
+    strofs = np.zeros(len(strings) + 1, dtype=np.int64)
+    np.cumsum([len(string) + 1 for string in strings], out=strofs[1:])
+
+    cname = cachename(fname)
+    tmpname = cname.with_name(f'{cname.name}.{os.getpid()}.tmp')
+    try:
+        stat = fname.stat()
+        cname.parent.mkdir(parents=True, exist_ok=True)
+        with open(tmpname, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, stat.st_mtime_ns, stat.st_size, filehash(fname),
+                                len(scentime), len(table), len(strdata)))
+            f.write(np.asarray(scentime, dtype=np.float64).tobytes())
+            f.write(strofs.tobytes())
+            f.write(idx.tobytes())
+            f.write(strdata)
+        os.replace(tmpname, cname)
+    except OSError:
+        try:
+            os.remove(tmpname)
+        except OSError:
+            pass
@@ -1,18 +1,20 @@
 ''' Main simulation-side stack functions. '''
 from pathlib import Path
 import traceback
+import numpy as np
 
 import bluesky as bs
 from bluesky.stack.stackbase import Stack, stack, checkscen, forward
 from bluesky.stack.cmdparser import Command, command
 from bluesky.stack.basecmds import initbasecmds
-from bluesky.stack import recorder
+from bluesky.stack import recorder, scncache
 from bluesky.stack import argparser, ArgumentError
 from bluesky import settings
 
 
 # Register settings defaults
-settings.set_variable_defaults(start_location="EHAM", scenario_path="scenario")
+settings.set_variable_defaults(start_location="EHAM", scenario_path="scenario",
+                               scenario_cache=True, scenario_window=0.0)
 
 # List of TMX commands not yet implemented in BlueSky
 tmxlist = ("BGPASAS", "DFFLEVEL", "FFLEVEL", "FILTCONF", "FILTTRED", "FILTTAMB",
@@ -41,6 +43,99 @@ def reset():
     recorder.reset()
 
 
+class CommandBatch:
+    ''' Run of consecutive scenario commands of the same type that is
+        dispatched as one vectorised call.
+
+        Batchable commands are listed in CommandBatch.batchcmds, by name,
+        as a tuple of two functions:
+        - accept(batch, args): returns the (possibly adapted) parsed arguments
+          when the command can be added to the batch, or None otherwise
+        - dispatch(arglist): executes the commands of a batch
+    '''
+    batchcmds = dict()
+
+    def __init__(self):
+        self.cmdu = ''
+        self.arglist = []
+        self.cmdlines = []
+        # Keys (e.g., aircraft ids) of the batched commands
+        self.keys = set()
+
+    def add(self, cmdu, argstring, cmdline):
+        ''' Try to add a command to the batch. Returns False when the
+            command should be processed individually. '''
+        funs = CommandBatch.batchcmds.get(cmdu)
+        # Only commands from scenario files are batched
+        if funs is None or Stack.sender_id is not None:
+            return False
+        if cmdu != self.cmdu:
+            self.flush()
+        try:
+            args = funs[0](self, Command.cmddict[cmdu].parse(argstring))
+        except Exception:
+            # Argument errors are reported by individual processing
+            args = None
+        if args is None:
+            self.flush()
+            return False
+        self.cmdu = cmdu
+        self.arglist.append(args)
+        self.cmdlines.append(cmdline)
+        return True
+
+    def flush(self):
+        ''' Execute the batched commands. '''
+        if not self.arglist:
+            return
+        try:
+            CommandBatch.batchcmds[self.cmdu][1](self.arglist)
+            for cmdline in self.cmdlines:
+                recorder.savecmd(self.cmdu, cmdline)
+        except Exception:
+            echo(f'Error calling function implementation of {self.cmdu} for '
+                 f'{len(self.arglist)} commands.\nTraceback printed to terminal.',
+                 bs.BS_FUNERR)
+            traceback.print_exc()
+        self.arglist = []
+        self.cmdlines = []
+        self.keys.clear()
+
+
+def acceptcre(batch, args):
+    ''' Batch CRE when the aircraft doesn't exist yet. '''
+    acid, actype, lat, lon, hdg, alt, spd = args
+    if acid in batch.keys or bs.traf.id2idx(acid) >= 0:
+        return None
+    batch.keys.add(acid)
+    # Default heading is taken from the reference of this command
+    return acid, actype, lat, lon, (bs.ref.hdg or 0.0) if hdg is None else hdg, alt, spd
+
+
+def dispatchcre(arglist):
+    ''' Create a batch of aircraft with one call to Traffic.cre. '''
+    acid, actype, lat, lon, hdg, alt, spd = zip(*arglist)
+    bs.traf.cre(list(acid), list(actype), np.array(lat, dtype=float),
+                np.array(lon, dtype=float), np.array(hdg, dtype=float),
+                np.array(alt, dtype=float), np.array(spd, dtype=float))
+
+
+def acceptdel(batch, args):
+    ''' Batch DEL of single aircraft. '''
+    if len(args) != 1 or not isinstance(args[0], int) or args[0] in batch.keys:
+        return None
+    batch.keys.add(args[0])
+    return args
+
+
+def dispatchdel(arglist):
+    ''' Delete a batch of aircraft with one call to Traffic.delete. '''
+    bs.traf.delete([args[0] for args in arglist])
+
+
+CommandBatch.batchcmds.update(CRE=(acceptcre, dispatchcre), DEL=(acceptdel, dispatchdel))
+
+
 def process(ext_cmds=None):
     ''' Sim-side stack processing. '''
     # If no commands are passed, check for commands in scenario file
@@ -48,6 +143,7 @@ def process(ext_cmds=None):
         checkscen()
 
     # Process stack of commands
+    batch = CommandBatch()
     for cmdline in Stack.commands(ext_cmds):
         success = True
         echotext = ''
@@ -56,10 +152,16 @@ def process(ext_cmds=None):
         # Get first argument from command line and check if it's a command
         cmd, argstring = argparser.getnextarg(cmdline)
         cmdu = cmd.upper()
+
+        # Runs of batchable commands are dispatched together
+        if batch.add(cmdu, argstring, cmdline):
+            continue
+        batch.flush()
+
         cmdobj = Command.cmddict.get(cmdu)
 
         # If no function is found for 'cmd', check if cmd is actually an aircraft id
-        if not cmdobj and cmdu in bs.traf.id:
+        if not cmdobj and cmdu not in ('#', '*') and bs.traf.id2idx(cmdu) >= 0:
             cmd, argstring = argparser.getnextarg(argstring)
             argstring = cmdu + " " + argstring
             # When no other args are parsed, command is POS
@@ -115,20 +217,73 @@ def process(ext_cmds=None):
         if echotext:
             echo(echotext, echoflags)
 
+    batch.flush()
+
     # Clear the processed commands
     if ext_cmds is None:
         Stack.clear()
 
 
-def readscn(fname):
-    ''' Read a scenario file. '''
-    if not fname:
-        return
-    # Ensure .scn suffix and specify path if necessary
+def scnpath(fname):
+    ''' Ensure .scn suffix and specify path if necessary. '''
     fname = Path(fname).with_suffix('.scn')
     if not fname.is_absolute():
         fname = bs.resource(settings.scenario_path) / fname
+    return fname
 
+
+def loadscn(fname):
+    ''' Load a scenario file.
+
+        When the scenario_cache setting is enabled, the parsed scenario is
+        stored in compiled form in the cache path, and subsequent
+        loads read the compiled file instead of parsing the scenario again.
+
+        Returns:
+        - (scentime, scencmd): lists of command times and command lines
+    '''
+    if not fname:
+        return [], []
+    fname = scnpath(fname)
+    if settings.scenario_cache:
+        data = scncache.load(fname)
+        if data is not None:
+            return data
+
+    scentime, scencmd = [], []
+    for cmdtime, cmd in parsescn(fname):
+        scentime.append(cmdtime)
+        scencmd.append(cmd)
+
+    if settings.scenario_cache:
+        scncache.save(fname, scentime, scencmd)
+    return scentime, scencmd
+
+
+def streamscn(fname):
+    ''' Open a scenario file for streaming. Uses the compiled version of
+        the scenario file when available.
+
+        Returns:
+        - Iterator over (time, command) tuples
+    '''
+    fname = scnpath(fname)
+    if not fname.is_file():
+        raise FileNotFoundError(2, 'No such file or directory', str(fname))
+    if settings.scenario_cache:
+        source = scncache.stream(fname)
+        if source is not None:
+            return source
+    return parsescn(fname)
+
+
+def readscn(fname):
+    ''' Read a scenario file. '''
+    yield from zip(*loadscn(fname))
+
+
+def parsescn(fname):
+    ''' Parse the scenario file with path fname. '''
     with open(fname, "r") as fscen:
         prevline = ''
         for line in fscen:
@@ -189,7 +344,7 @@ def pcall(fname, *pcall_arglst):
         pcall_arglst = pcall_arglst[1:]
 
     try:
-        merge(readscn(fname), *pcall_arglst, isrelative=isrelative)
+        merge(zip(*loadscn(fname)), *pcall_arglst, isrelative=isrelative)
 
     except FileNotFoundError as e:
         return False, f"PCALL: File not found'{e.filename}'"
@@ -202,10 +357,6 @@ def merge(source, *args, isrelative=True):
     # the current simtime to every timestamp
     t_offset = bs.sim.simt if isrelative else 0.0
 
-    # Read the scenario file
-    insidx = 0
-    instime = bs.sim.simt
-
     # All commands with timestamps at the current sim time or earlier should be called immediately
     callnow = []
     for (cmdtime, cmdline) in source:
@@ -220,18 +371,8 @@ def merge(source, *args, isrelative=True):
 
         if cmdtime <= bs.sim.simt:
             callnow.append((cmdline, None))
-        elif not Stack.scentime or cmdtime >= Stack.scentime[-1]:
-            Stack.scentime.append(cmdtime)
-            Stack.scencmd.append(cmdline)
         else:
-            if cmdtime > instime:
-                insidx, instime = next(
-                    ((j, t) for j, t in enumerate(Stack.scentime) if t >= cmdtime),
-                    (len(Stack.scentime), Stack.scentime[-1]),
-                )
-            Stack.scentime.insert(insidx, cmdtime)
-            Stack.scencmd.insert(insidx, cmdline)
-            insidx += 1
+            Stack.scen.insert(cmdtime, cmdline)
 
     # execute any commands that are already due
     if callnow:
@@ -276,9 +417,11 @@ def ic(filename : 'string' = ''):
 
     # Reset sim and open new scenario file
     try:
-        for (cmdtime, cmd) in readscn(filename):
-            Stack.scentime.append(cmdtime)
-            Stack.scencmd.append(cmd)
+        if settings.scenario_window > 0.0:
+            # Only keep commands within a look-ahead window in memory
+            Stack.scen.stream(streamscn(filename), settings.scenario_window, name=str(filename))
+        else:
+            Stack.scen.set(*loadscn(filename))
         Stack.scenname = filename.stem
 
         # Remember this filename in IC.scn in scenario folder
@@ -313,10 +456,7 @@ def schedule(time: 'time', cmdline: 'string'):
         Arguments:
         - time: the time at which the command should be executed
         - cmdline: the command line to be executed """
-    # Get index of first scentime greater than 'time' as insert position
-    idx = next((i for i, t in enumerate(Stack.scentime) if t > time), len(Stack.scentime))
-    Stack.scentime.insert(idx, time)
-    Stack.scencmd.insert(idx, cmdline)
+    Stack.scen.insert(time, cmdline)
     return True
 
 
@@ -327,11 +467,7 @@ def delay(time: 'time', cmdline: 'string'):
         Arguments:
         - time: the time with which the command should be delayed
         - cmdline: the command line to be executed after the delay """
-    # Get index of first scentime greater than 'time' as insert position
-    time += bs.sim.simt
-    idx = next((i for i, t in enumerate(Stack.scentime) if t > time), len(Stack.scentime))
-    Stack.scentime.insert(idx, time)
-    Stack.scencmd.insert(idx, cmdline)
+    Stack.scen.insert(time + bs.sim.simt, cmdline)
     return True
 
 
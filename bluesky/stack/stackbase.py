@@ -1,11 +1,154 @@
 ''' BlueSky Stack base data and functions. '''
-from itertools import repeat
+from heapq import heappush, heappop, merge
+from itertools import count, repeat, islice
+import numpy as np
 
 import bluesky as bs
 from bluesky.network import subscriber, context as ctx
 from bluesky.stack.cmdparser import command
 
 
+class ScenarioQueue:
+    ''' Time-ordered buffer of scenario commands.
+
+        Commands loaded from a scenario file are stored as a sorted array of
+        times with a read cursor, commands that are merged in later (PCALL,
+        SCHEDULE, DELAY) are stored in a heap. Commands with equal times are
+        returned in the order in which they were added.
+
+        Scenario commands can also be streamed from a (time, command)
+        iterator, in which case only the commands within a look-ahead window
+        of simulated time are kept in memory.
+    '''
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        ''' Remove all commands. '''
+        self.times = np.zeros(0)
+        self.cmds = []
+        self.cursor = 0
+        self.heap = []
+        self.seq = count()
+        # Streaming source, its first unread command, and the look-ahead window
+        self.source = None
+        self.nextcmd = None
+        self.window = 0.0
+        # Name of the streamed scenario, and the number of commands read from it
+        self.name = None
+        self.nread = 0
+
+    def __len__(self):
+        return len(self.cmds) - self.cursor + len(self.heap) + \
+            (self.nextcmd is not None)
+
+    def set(self, times, cmds):
+        ''' Replace the buffer contents with the commands of a scenario file.
+            As scenario files are processed in order, a command is never
+            executed before the commands preceding it in the file. '''
+        self.clear()
+        self.times = np.maximum.accumulate(np.asarray(times, dtype=np.float64))
+        self.cmds = list(cmds)
+
+    def stream(self, source, window, simt=0.0, name=None):
+        ''' Replace the buffer contents with commands streamed from source.
+
+            Arguments:
+            - source: Iterator over (time, command) tuples of a scenario file
+            - window: Look-ahead window of simulated time [s]. Commands are read
+              from source in blocks covering up to two windows ahead of simt.
+            - simt: Current simulation time
+            - name: Name of the scenario file, with which the stream can be
+              resumed (see position())
+        '''
+        self.clear()
+        self.resume(source, window, 0, name, simt)
+
+    def resume(self, source, window, nread, name=None, simt=0.0):
+        ''' Continue streaming from source after its first nread commands,
+            keeping the current buffer contents. '''
+        self.source = islice(source, nread, None)
+        self.nread = nread
+        self.name = name
+        self.window = window
+        self.nextcmd = next(self.source, None)
+        self.refill(simt)
+
+    def position(self):
+        ''' Return the name and look-ahead window of a streamed scenario, and
+            the number of commands that were read from it into the buffer,
+            or None when no scenario is streamed. '''
+        if self.nextcmd is None:
+            return None
+        return self.name, self.window, self.nread
+
+    def refill(self, simt):
+        ''' Read commands from the streaming source up to two look-ahead
+            windows ahead of simt. '''
+        if self.nextcmd is None or self.nextcmd[0] > simt + self.window:
+            return
+        horizon = simt + 2.0 * self.window
+        tmax = self.times[-1] if len(self.times) else -np.inf
+        times, cmds = [], []
+        cmdtime, cmdline = self.nextcmd
+        # Keep file order: commands never come before their predecessors
+        while max(tmax, cmdtime) <= horizon:
+            tmax = max(tmax, cmdtime)
+            times.append(tmax)
+            cmds.append(cmdline)
+            self.nread += 1
+            self.nextcmd = next(self.source, None)
+            if self.nextcmd is None:
+                break
+            cmdtime, cmdline = self.nextcmd
+        if self.nextcmd is not None and tmax > self.nextcmd[0]:
+            self.nextcmd = (tmax, self.nextcmd[1])
+
+        # Drop processed commands before appending new ones
+        self.times = np.concatenate((self.times[self.cursor:], times))
+        del self.cmds[:self.cursor]
+        self.cmds.extend(cmds)
+        self.cursor = 0
+
+    def insert(self, cmdtime, cmdline):
+        ''' Insert a single command. '''
+        heappush(self.heap, (cmdtime, next(self.seq), cmdline))
+
+    def pop(self, simt):
+        ''' Remove and return all commands with a time up to simt. '''
+        if self.source is not None:
+            self.refill(simt)
+        idx = self.cursor + int(np.searchsorted(self.times[self.cursor:], simt, 'right'))
+        due = self.cmds[self.cursor:idx]
+        if self.heap and self.heap[0][0] <= simt:
+            inserted = []
+            while self.heap and self.heap[0][0] <= simt:
+                cmdtime, _, cmdline = heappop(self.heap)
+                inserted.append((cmdtime, cmdline))
+            # Merge by time, keeping file commands first for equal times
+            due = [cmdline for _, cmdline in merge(zip(self.times[self.cursor:idx].tolist(), due),
+                                                     inserted, key=lambda tc: tc[0])]
+        self.cursor = idx
+
+        # Release processed commands when they make up most of the buffer
+        if self.cursor > 1024 and 2 * self.cursor > len(self.cmds):
+            self.times = self.times[self.cursor:]
+            del self.cmds[:self.cursor]
+            self.cursor = 0
+        return due
+
+    def data(self):
+        ''' Return lists of times and commands of all remaining commands.
+            For streamed scenarios only the commands read so far are returned. '''
+        remaining = merge(zip(self.times[self.cursor:].tolist(), self.cmds[self.cursor:]),
+                          ((t, c) for t, _, c in sorted(self.heap)), key=lambda tc: tc[0])
+        scentime, scencmd = [], []
+        for cmdtime, cmdline in remaining:
+            scentime.append(cmdtime)
+            scencmd.append(cmdline)
+        return scentime, scencmd
+
+
 class Stack:
     ''' Stack static-only namespace. '''
 
@@ -15,8 +158,7 @@ class Stack:
 
     # Scenario details
     scenname = ""  # Currently used scenario name (for reading)
-    scentime = []  # Times of the commands from the read scenario file
-    scencmd = []  # Commands from the scenario file
+    scen = ScenarioQueue()  # Time-ordered commands from the scenario file
 
     # Current command details
     sender_id = None  # bs net route to sender
@@ -26,8 +168,7 @@ class Stack:
         ''' Reset stack variables. '''
         cls.cmdstack = []
         cls.scenname = ""
-        cls.scentime = []
-        cls.scencmd = []
+        cls.scen.clear()
         cls.current = ''
         cls.sender_id = None
 
@@ -52,14 +193,9 @@ class Stack:
 
 def checkscen():
     """ Check if commands from the scenario buffer need to be stacked. """
-    if Stack.scencmd:
-        # Find index of first timestamp exceeding bs.sim.simt
-        idx = next((i for i, t in enumerate(
-            Stack.scentime) if t > bs.sim.simt), None)
-        # Stack all commands before that time, and remove from scenario
-        stack(*Stack.scencmd[:idx])
-        del Stack.scencmd[:idx]
-        del Stack.scentime[:idx]
+    if Stack.scen:
+        # Stack all commands up to the current time, and remove from scenario
+        stack(*Stack.scen.pop(bs.sim.simt))
 
 
 def stack(*cmdlines, sender_id=None):
@@ -104,13 +240,12 @@ def get_scenname():
 
 def get_scendata():
     """ Return the scenario data that was loaded from a scenario file. """
-    return Stack.scentime, Stack.scencmd
+    return Stack.scen.data()
 
 
 def set_scendata(newtime, newcmd):
     """ Set the scenario data. This is used by the batch logic. """
-    Stack.scentime = newtime
-    Stack.scencmd = newcmd
+    Stack.scen.set(newtime, newcmd)
 
 
 # Register subscriber for stack commands coming from the network
@@ -0,0 +1,194 @@
+''' In-process parameter sweeps.
+
+    Runs scenarios, or combinations of scenarios and parameter values, in
+    fast-time on a pool of detached simulation processes, without a
+    server or network connections. Each worker process initialises
+    BlueSky once, and is reused for all the runs it is given.
+
+    Example:
+
+        import bluesky as bs
+        metrics, logs = bs.sweep.run(['scen1.scn', 'scen2.scn'],
+                                     dict(simdt=[0.05, 0.1], RESO=['OFF', 'MVP']),
+                                     workers=4)
+
+    Parameters can be BlueSky settings (such as simdt), which are set before
+    a run starts, or stack commands (such as RESO), which are called with
+    the parameter value as argument before the scenario is started.
+
+    Each run is seeded with its own seed, which is listed in the metrics
+    table, so that the runs of a sweep are reproducible, and don't depend
+    on the worker they ran on.
+'''
+import os
+import time
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from pathlib import Path
+import pandas as pd
+
+import bluesky as bs
+
+
+class Sweep:
+    ''' Pool of detached simulation processes to run scenarios on.
+
+        Arguments:
+        - workers: The number of simulation processes (default: number of CPUs)
+        - configfile: Configuration file to initialise the workers with
+        - workdir: Working directory of the workers
+
+        The pool is kept alive between calls to run(), until it is closed.
+        A Sweep can be used as a context manager, which closes the pool
+        on exit.
+    '''
+    def __init__(self, workers=None, configfile=None, workdir=None):
+        # Forked workers can start from the already initialised simulation
+        # of this process, when it has one without network connections
+        from bluesky.network.detached import Node
+        if hasattr(os, 'fork') and (bs.sim is None or isinstance(bs.net, Node)):
+            ctx = multiprocessing.get_context('fork')
+        else:
+            ctx = multiprocessing.get_context('spawn')
+        self.pool = ProcessPoolExecutor(workers, ctx, initializer=initworker,
+                                        initargs=(configfile, workdir))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        ''' Stop the worker processes. '''
+        self.pool.shutdown()
+
+    def run(self, scenarios, params=None, duration=None, metrics=None, seed=0):
+        ''' Run all combinations of scenarios and parameter values.
+
+            Arguments:
+            - scenarios: List of scenario files, and/or scenarios as dicts
+              with name, scentime, and scencmd, like the scenarios in a batch
+            - params: Dict with a list of values per parameter. Each
+              combination of parameter values is run with each scenario.
+            - duration: Maximum simulated time per run [s]. Without a
+              duration, a run ends when the simulation holds, or when the
+              scenario is finished and all aircraft are deleted.
+            - metrics: Dict of functions that are called without arguments
+              in the worker at the end of each run. Their results are added
+              to the metrics table. The functions have to be picklable.
+            - seed: Random seed of the first run. Run i is seeded with seed + i.
+
+            Returns:
+            - DataFrame with one row per run, with the scenario name, the
+              parameter values, and the metrics of the run.
+            - List with per run a dict of DataFrames with the data of each
+              logger that was active during the run.
+        '''
+        params = params or dict()
+        names = list(params)
+        combinations = list(itertools.product(*params.values()))
+        logdir = Path(bs.settings.log_path if bs.sim else 'output') / \
+            datetime.now().strftime('sweep_%Y%m%d_%H-%M-%S')
+
+        runs = [(scen, dict(zip(names, values)), duration, metrics, str(logdir / f'run{i:04d}'),
+                 seed + i)
+                for i, (scen, values) in enumerate(itertools.product(scenarios, combinations))]
+        results = list(self.pool.map(runscenario, *zip(*runs))) if runs else []
+        table = pd.DataFrame([row for row, _ in results])
+        return table, [logs for _, logs in results]
+
+
+def run(scenarios, params=None, workers=None, duration=None, metrics=None, configfile=None,
+        seed=0):
+    ''' Run all combinations of scenarios and parameter values on a temporary
+        pool of detached simulation processes. See Sweep.run for a
+        description of the arguments and return values. '''
+    with Sweep(workers, configfile) as sweep:
+        return sweep.run(scenarios, params, duration, metrics, seed)
+
+
+def initworker(configfile, workdir):
+    ''' Initialise BlueSky in a worker process. '''
+    if bs.sim is None:
+        bs.init(mode='sim', detached=True, configfile=configfile, workdir=workdir)
+
+
+def runscenario(scen, params, duration, metrics, logdir, seed=0):
+    ''' Run a single scenario with the given parameters and random seed in this worker.
+        Returns a dict of metrics, and a dict of log data. '''
+    from bluesky.stack.simstack import Stack, loadscn, process
+    from bluesky.tools import datalog
+
+    # Parameters that are settings are restored after the run
+    settings = {name: value for name, value in params.items() if hasattr(bs.settings, name)}
+    saved = {name: getattr(bs.settings, name) for name in settings}
+    saved['log_path'] = bs.settings.log_path
+    try:
+        vars(bs.settings).update(settings)
+        bs.settings.log_path = logdir
+        bs.resource(logdir).mkdir(parents=True, exist_ok=True)
+
+        bs.sim.reset()
+        # Forked workers start with the same random state: seed each run
+        bs.sim.setseed(seed)
+        if isinstance(scen, dict):
+            name = scen['name']
+            Stack.scen.set(scen['scentime'], scen['scencmd'])
+        else:
+            name = Path(scen).stem
+            Stack.scen.set(*loadscn(scen))
+        Stack.scenname = name
+        process([(f'{cmd} {value}', None) for cmd, value in params.items()
+                 if cmd not in settings])
+
+        # Run in fast-time until the run is finished
+        bs.net.running = True
+        nsteps = 0
+        t0 = time.perf_counter()
+        while bs.net.running:
+            bs.net.update()
+            bs.sim.step()
+            nsteps += 1
+            if bs.sim.state == bs.INIT or bs.sim.state == bs.HOLD or \
+                    (duration is not None and bs.sim.simt >= duration) or \
+                    (bs.sim.state == bs.OP and bs.traf.ntraf == 0 and not Stack.scen):
+                break
+        runtime = time.perf_counter() - t0
+
+        row = dict(scenario=name, **params, seed=seed, simt=bs.sim.simt, nsteps=nsteps,
+                   runtime=runtime, ntraf=bs.traf.ntraf,
+                   nconf=len(bs.traf.cd.confpairs_all), nlos=len(bs.traf.cd.lospairs_all))
+        for key, func in (metrics or dict()).items():
+            row[key] = func()
+
+        # Close the log files, and read what was logged in this run
+        datalog.reset()
+        logs = dict()
+        for fname in sorted(bs.resource(logdir).glob('*.log')):
+            logname = max((name for name in datalog.allloggers if fname.name.startswith(name + '_')),
+                          key=len, default=fname.stem)
+            logs[logname] = readlog(fname)
+        return row, logs
+    finally:
+        vars(bs.settings).update(saved)
+
+
+def readlog(fname):
+    ''' Read a log file written by a BlueSky data logger into a DataFrame. '''
+    columns = []
+    with open(fname) as f:
+        for line in f:
+            if not line.startswith('#'):
+                break
+            # The last header line lists the column names
+            columns = [col.strip() for col in line[1:].split(',')]
+    try:
+        data = pd.read_csv(fname, comment='#', header=None)
+    except pd.errors.EmptyDataError:
+        return pd.DataFrame(columns=columns)
+    ncols = len(data.columns)
+    data.columns = columns[:ncols] + [f'col{i}' for i in range(len(columns), ncols)]
+    return data
@@ -0,0 +1,135 @@
+"""
+Tests cost-aware scheduling of batch scenarios.
+
+Checks that scenarios are scheduled longest-first using their estimated
+cost and recorded runtimes, that the server stops counting nodes that
+failed to start, and compares the makespan of a 64-scenario batch on
+16 nodes against first-in-first-out scheduling.
+"""
+import time
+import heapq
+import numpy as np
+from bluesky import settings
+from bluesky.network.server import Server, split_scenarios
+from bluesky.network.scheduler import BatchScheduler, estimate
+
+
+def batchfile(nscen, rng):
+    """ Create a batch file with scenarios of varying traffic and duration. """
+    scentime, scencmd = [], []
+    for i in range(nscen):
+        ntraf = int(rng.integers(5, 200))
+        duration = float(rng.choice([900., 1800., 3600., 7200.]))
+        scentime += [0.] * (ntraf + 1) + [duration]
+        scencmd += [f'SCEN SCEN{i}'] + [f'CRE KL{j},B744,52,4,0,FL100,250' for j in range(ntraf)]
+        scencmd += ['HOLD']
+    return scentime, scencmd
+
+
+def runtime(scen):
+    """ Simulated wall-clock runtime of a scenario. """
+    rng = np.random.default_rng(int(scen['name'][4:]))
+    return 1e-4 * estimate(scen) * rng.lognormal(0., 0.2)
+
+
+def makespan(scheduler, nnodes):
+    """ Simulate running the queued scenarios on nnodes nodes. """
+    clock = [0.0]
+    scheduler.clock = lambda: clock[0]
+    events = []
+    for node in (bytes([i]) for i in range(nnodes)):
+        scen = scheduler.next(node)
+        if scen:
+            heapq.heappush(events, (runtime(scen), node))
+    while events:
+        clock[0], node = heapq.heappop(events)
+        scheduler.done(node)
+        scen = scheduler.next(node)
+        if scen:
+            heapq.heappush(events, (clock[0] + runtime(scen), node))
+    return clock[0]
+
+
+class FifoScheduler(BatchScheduler):
+    """ Reference: scenarios in the order of the batch file. """
+    def add(self, scenarios):
+        for scen in scenarios:
+            scen['cost'] = estimate(scen)
+            self.queue.append(scen)
+
+
+def test_scheduler_order(tmp_path):
+    """ Scenarios are ordered by estimated cost, or recorded runtime. """
+    scentime = [0., 0., 0., 600., 0., 0., 1200., 0., 0., 0., 0., 100.]
+    scencmd = ['SCEN A', 'CRE KL1', 'CRE KL2', 'HOLD', 'SCEN B', 'MCRE 3', 'HOLD',
+               'SCEN C', 'CRE KL1', 'CRE KL2', 'CRE KL3', 'HOLD']
+    scheduler = BatchScheduler(tmp_path / 'hist.json')
+    scheduler.add(split_scenarios(scentime, scencmd))
+    assert [scen['name'] for scen in scheduler.queue] == ['B', 'A', 'C']
+    assert [scen['cost'] for scen in scheduler.queue] == [3600., 1200., 300.]
+
+    # Recorded runtimes take precedence over estimates
+    clock = [0.0]
+    scheduler.clock = lambda: clock[0]
+    nodes = [b'a', b'b', b'c']
+    for node in nodes:
+        scheduler.next(node)
+    status = scheduler.status()
+    assert status['nqueued'] == 0 and status['eta'] == 3600.
+    for node, t in zip(nodes, (1., 2., 30.)):
+        clock[0] = t
+        scheduler.done(node)
+    assert (tmp_path / 'hist.json').is_file()
+    scheduler = BatchScheduler(tmp_path / 'hist.json')
+    scheduler.add(split_scenarios(scentime, scencmd))
+    assert [scen['name'] for scen in scheduler.queue] == ['C', 'A', 'B']
+
+    # The scenario of a removed node is scheduled again
+    scen = scheduler.next(b'node')
+    scheduler.requeue(b'node')
+    assert scheduler.queue[0] is scen
+
+
+def test_scheduler_makespan(tmp_path):
+    """ Cost-ordered scheduling of 64 scenarios on 16 nodes finishes
+        earlier than first-in-first-out scheduling. """
+    scentime, scencmd = batchfile(64, np.random.default_rng(10))
+    fifo = FifoScheduler(tmp_path / 'fifo.json')
+    fifo.add(split_scenarios(scentime, scencmd))
+    tfifo = makespan(fifo, 16)
+
+    scheduler = BatchScheduler(tmp_path / 'hist.json')
+    scheduler.add(split_scenarios(scentime, scencmd))
+    tcost = makespan(scheduler, 16)
+    assert scheduler.ndone == 64
+    assert scheduler.status()['nodes'] and scheduler.eta() == 0.0
+
+    # Second run uses the recorded runtimes
+    scheduler = BatchScheduler(tmp_path / 'hist.json')
+    scheduler.add(split_scenarios(scentime, scencmd))
+    thist = makespan(scheduler, 16)
+
+    tlower = sum(runtime(scen) for scen in split_scenarios(scentime, scencmd)) / 16
+    assert tlower <= thist <= tcost < tfifo
+
+
+class Process:
+    """ A spawned node process that has, or hasn't, ended. """
+    def __init__(self, returncode):
+        self.returncode = returncode
+
+    def poll(self):
+        return self.returncode
+
+
+def test_server_nstarting():
+    """ Nodes that ended, or forked nodes that don't report their state
+        in time, no longer count as starting. """
+    server = Server.__new__(Server)
+    now = time.time()
+    server.spawned_processes = {b'SPAWN1': Process(None), b'SPAWN2': Process(1)}
+    server.forked_processes = {b'FORK1': None, b'FORK2': None}
+    server.starting = {b'SPAWN1': now - 100.0, b'SPAWN2': now, b'FORK1': now,
+                       b'FORK2': now - 2 * settings.node_starttimeout}
+    assert server.nstarting() == 2
+    assert set(server.starting) == {b'SPAWN1', b'FORK1'}
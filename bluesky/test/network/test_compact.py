@@ -0,0 +1,155 @@
+"""
+Tests the compact encoding of aircraft state messages.
+
+Checks that decoded messages reproduce the original data within the
+quantization resolution, that differences are only sent against frames
+that were acknowledged, and compares the message size with the
+full-precision encoding.
+"""
+import numpy as np
+from bluesky.network import compact, npcodec
+
+
+def acdata(rng, n, t):
+    """ Aircraft data of n aircraft flying straight at time t. """
+    lat0, lon0 = np.linspace(50., 54., n), np.linspace(2., 8., n)
+    return dict(simt=t, id=[f'KL{i}' for i in range(n)],
+                lat=lat0 + 1e-5 * t, lon=lon0 + 2e-5 * t,
+                alt=np.full(n, 3000.), tas=np.full(n, 150.), cas=np.full(n, 140.),
+                gs=np.full(n, 155.) + rng.normal(size=n), trk=np.full(n, 45.),
+                vs=np.zeros(n), ingroup=np.zeros(n, dtype=np.int64),
+                inconf=np.zeros(n, dtype=bool), tcpamax=np.zeros(n), rpz=np.full(n, 9260.),
+                translvl=1524.0, nconf_cur=0)
+
+
+def roundtrip(msg):
+    """ Send a message through the network codec. """
+    return npcodec.unpackb(npcodec.packb(msg))
+
+
+class Link:
+    """ An encoder and a decoder, with the replies of the decoder. """
+    def __init__(self):
+        self.encoder = compact.Encoder()
+        self.replies = []
+        self.decoder = compact.Decoder(lambda topic, data: self.replies.append((topic, data)))
+
+    def send(self, data, keyframe=False, ack=True):
+        msg = roundtrip(self.encoder.encode(data, keyframe))
+        result = self.decoder.decode('ACDATA', msg)
+        if ack:
+            for topic, data in self.replies:
+                if topic == 'ACKFRAME':
+                    self.encoder.ack(b'client', data[1])
+        self.replies.clear()
+        return msg, result
+
+
+def check(result, data):
+    assert result['id'] == data['id']
+    for name, resolution in compact.RESOLUTION.items():
+        if name in data:
+            np.testing.assert_allclose(result[name], data[name], rtol=0., atol=0.51 * resolution)
+    for name in compact.EXACT:
+        np.testing.assert_array_equal(result[name], data[name])
+    assert result['simt'] == data['simt'] and result['translvl'] == data['translvl']
+
+
+def test_compact_stream():
+    """ Decoded frames reproduce the original data within resolution. """
+    rng = np.random.default_rng(3)
+    link = Link()
+    msg, result = link.send(acdata(rng, 100, 0.))
+    assert msg['ref'] is None and 'id' in msg
+    check(result, acdata(np.random.default_rng(3), 100, 0.))
+
+    for t in np.arange(1., 20.):
+        data = acdata(rng, 100, t)
+        data['inconf'][5] = t > 10.
+        msg, result = link.send(data)
+        # Differences against the previous (acknowledged) frame
+        assert msg['ref'] == msg['compact'] - 1 and 'id' not in msg
+        # Unchanged fields are left out
+        assert 'alt' not in msg['fields'] and 'lat' in msg['fields']
+        assert ('inconf' in msg['fields']) == (t == 11.)
+        check(result, data)
+
+    # A changed set of aircraft gives a keyframe
+    data = acdata(rng, 101, 20.)
+    msg, result = link.send(data)
+    assert msg['ref'] is None and len(msg['id']) == 101
+    check(result, data)
+
+
+def test_compact_missed_frame():
+    """ Without acknowledgements, or with a missing reference frame. """
+    rng = np.random.default_rng(4)
+    link = Link()
+    link.send(acdata(rng, 10, 0.), ack=False)
+    # Nothing acknowledged: keyframes only
+    msg, _ = link.send(acdata(rng, 10, 1.))
+    assert msg['ref'] is None
+    link.send(acdata(rng, 10, 2.))
+
+    # The decoder misses a frame, and then receives a difference against it
+    missed = link.encoder.encode(acdata(rng, 10, 3.))
+    link.encoder.ack(b'client', missed['compact'])
+    msg = roundtrip(link.encoder.encode(acdata(rng, 10, 4.)))
+    assert msg['ref'] == missed['compact']
+    assert link.decoder.decode('ACDATA', msg) is None
+    assert link.replies == [('REQUEST', ['ACDATA'])]
+
+    # The requested keyframe can be decoded
+    link.replies.clear()
+    data = acdata(rng, 10, 5.)
+    msg, result = link.send(data, keyframe=True)
+    check(result, data)
+
+
+def test_compact_directed_keyframe():
+    """ A keyframe for one receiver isn't used as reference for the others. """
+    rng = np.random.default_rng(6)
+    encoder = compact.Encoder()
+    replies = {client: [] for client in (b'clnt1', b'clnt2')}
+    decoders = {client: compact.Decoder(lambda topic, data, client=client:
+                                        replies[client].append((topic, data)))
+                for client in replies}
+
+    def send(msg, clients):
+        msg = roundtrip(msg)
+        results = {client: decoders[client].decode('ACDATA', msg) for client in clients}
+        for client in clients:
+            for topic, data in replies[client]:
+                if topic == 'ACKFRAME':
+                    encoder.ack(client, data[1])
+            replies[client].clear()
+        return msg, results
+
+    for t in range(3):
+        send(encoder.encode(acdata(rng, 10, t)), replies)
+
+    # The second client receives a keyframe in response to a request, and
+    # the first client acknowledges the next frame before the second does
+    keyframe, _ = send(encoder.encode(acdata(rng, 10, 3.), keyframe=True), [b'clnt2'])
+    msg, _ = send(encoder.encode(acdata(rng, 10, 4.)), [b'clnt1'])
+    assert msg['ref'] != keyframe['compact']
+    data = acdata(rng, 10, 5.)
+    msg, results = send(encoder.encode(data), replies)
+    assert msg['ref'] != keyframe['compact']
+    for result in results.values():
+        check(result, data)
+
+
+def test_compact_size():
+    """ The compact encoding is much smaller than the full encoding. """
+    rng = np.random.default_rng(5)
+    n = 2000
+    link = Link()
+    link.send(acdata(rng, n, 0.))
+    data = acdata(rng, n, 0.2)
+    full = sum(len(frame) if isinstance(frame, bytes) else frame.nbytes
+               for frame in npcodec.packb(data))
+    msg = link.encoder.encode(data)
+    delta = sum(len(frame) if isinstance(frame, bytes) else frame.nbytes
+                for frame in npcodec.packb(msg))
+    assert delta < 0.2 * full
@@ -0,0 +1,73 @@
+"""
+Tests the keyed store of per-aircraft shared state data.
+
+Checks the persistent id to index lookup, bulk lookups, stable aircraft
+handles across updates, upgrading a topic that was created with a plain
+Store, and lookups of many aircraft.
+"""
+import numpy as np
+from bluesky.network import sharedstate
+from bluesky.network.sharedstate import KeyedStore
+
+
+def acdata(ids):
+    return dict(id=list(ids), lat=np.arange(len(ids), dtype=float))
+
+
+def test_keyedstore_lookup():
+    """ Single and bulk lookups of aircraft indices. """
+    store = KeyedStore()
+    store.replace(acdata(['KL1', 'KL2', 'KL3', 'KL1']))
+    assert store.id2idx('KL2') == 1 and store.id2idx('KL1') == 0
+    assert store.id2idx('XX') == -1
+    idx = store.id2idx(['KL3', 'XX', 'KL2'])
+    assert isinstance(idx, np.ndarray)
+    np.testing.assert_array_equal(idx, [2, -1, 1])
+    assert len(store.id2idx([])) == 0
+
+    # Changes through other actions are also reflected
+    store.delete(dict(id='KL2'))
+    assert store.id2idx('KL3') == 1 and store.id2idx('KL2') == -1
+    store.extend(dict(id=['KL4'], lat=[5.0]))
+    assert store.id2idx('KL4') == 3
+
+
+def test_keyedstore_handles():
+    """ Handles of aircraft stay the same when their index changes. """
+    store = KeyedStore()
+    store.replace(acdata(['KL1', 'KL2', 'KL3']))
+    handles = store.id2handle(['KL1', 'KL2', 'KL3'])
+    np.testing.assert_array_equal(store.handles, handles)
+    assert len(set(handles)) == 3
+
+    store.replace(acdata(['KL3', 'KL4', 'KL1']))
+    np.testing.assert_array_equal(store.handle2idx(handles), [2, -1, 0])
+    assert store.handle2idx(handles[2]) == 0
+    assert store.id2handle('KL4') not in handles
+    assert store.id2handle('KL2') == -1
+
+    # An aircraft that disappears and comes back gets a new handle
+    store.replace(acdata(['KL2']))
+    assert store.id2handle('KL2') not in handles
+
+
+def test_keyedstore_addtopic():
+    """ A topic created with a plain Store keeps its contents when upgraded. """
+    sharedstate.setdefault('lat', np.zeros(0), 'keytest')
+    remote = sharedstate.remotes[b'keytest']
+    remote.keytest.replace(acdata(['KL1', 'KL2']))
+    sharedstate.addtopic('KEYTEST', KeyedStore())
+    assert isinstance(sharedstate.defaults.keytest, KeyedStore)
+    assert isinstance(remote.keytest, KeyedStore)
+    assert remote.keytest.id2idx('KL2') == 1
+    # New remotes get an empty copy
+    assert sharedstate.remotes[b'other'].keytest.id2idx('KL2') == -1
+
+
+def test_keyedstore_large():
+    """ Lookup of each of 5000 aircraft, after one update. """
+    ids = [f'KL{i}' for i in range(5000)]
+    store = KeyedStore()
+    store.replace(acdata(ids))
+    assert [store.id2idx(acid) for acid in ids] == list(range(5000))
+    np.testing.assert_array_equal(store.id2idx(ids), np.arange(5000))
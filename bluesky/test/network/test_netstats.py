@@ -0,0 +1,100 @@
+"""
+Tests the network statistics per topic and peer.
+
+Checks the counted messages and bytes of sent and received messages, the
+latency of published messages as measured by receivers and reported back
+to the publisher, the formatted statistics, and that counting a message
+is cheap.
+"""
+import time
+import numpy as np
+import pytest
+import bluesky as bs
+from bluesky.network import context as ctx
+from bluesky.network import npcodec, sharedstate
+from bluesky.network.netstats import NetStats, format_stats, nbytes
+from bluesky.network.publisher import StatePublisher
+
+
+HEADER = b'*****ACDATASIM01'
+
+
+class Network:
+    """ Records sent messages instead of sending them. """
+    def __init__(self):
+        self.sent = []
+        self.subscribers = None
+        self.netstats = NetStats()
+
+    def send(self, topic, data='', to_group=''):
+        self.sent.append((topic, data, to_group))
+
+
+@pytest.fixture
+def net(monkeypatch):
+    net = Network()
+    monkeypatch.setattr(bs, 'net', net, raising=False)
+    return net
+
+
+def test_netstats_count():
+    """ Messages and bytes are counted per topic and peer. """
+    stats = NetStats()
+    frames = [HEADER] + npcodec.packb(dict(lat=np.zeros(1000), simt=1.0))
+    assert len(frames) == 3 and nbytes(frames) > 8000
+    for _ in range(3):
+        stats.count_sent(b'ACDATA', b'', frames, 1e-4)
+    stats.count_sent(b'ACDATA', b'CLNT1', frames)
+    stats.count_received(b'PUBACK', b'CLNT1', [HEADER, b'abc'])
+
+    result = stats.stats()
+    peers = result['sent']['ACDATA']
+    assert peers['*'] == dict(n=3, bytes=3 * nbytes(frames), tcodec=pytest.approx(0.3))
+    assert peers['434c4e5431']['n'] == 1
+    assert result['received']['PUBACK']['434c4e5431']['bytes'] == len(HEADER) + 3
+
+    lines = format_stats(result)
+    assert lines[1] == 'Sent:' and lines[2].startswith('  ACDATA: 4 msgs')
+    # One line per peer of topics with more than one peer
+    assert lines[3].startswith('    *: 3 msgs') and 'encode 0.100 ms/msg' in lines[3]
+    assert len(format_stats(result, perpeer=False)) == len(lines) - 2
+
+    stats.reset()
+    assert not stats.sent and not stats.received
+
+
+def test_netstats_latency(net):
+    """ Receivers measure the latency of published messages, and report it
+        to the publisher with their acknowledgements. """
+    pub = StatePublisher('NTEST1', dt=100)
+    pub.payload(lambda: dict(x=1))
+    pub.send_replace()
+    _, (_, _, seq, tsent), _ = net.sent[-1]
+    assert tsent <= time.time()
+
+    ctx.sender_id, ctx.topic, ctx.msg = b'SIM01', 'NTEST1', None
+    sharedstate.streams.clear()
+    latency = net.netstats.count_latency(b'NTEST1', ctx.sender_id, tsent - 0.05)
+    sharedstate.acknowledge(seq, latency)
+    topic, ack, _ = net.sent[-1]
+    assert topic == 'PUBACK' and ack[:4] == ['NTEST1', b'', 1, 0] and ack[4] == latency
+    ctx.sender_id = ctx.topic = None
+    assert net.netstats.latency[(b'NTEST1', b'SIM01')][2] == pytest.approx(latency)
+
+    pub.ack(b'CLNT1', *ack[1:])
+    receiver, = pub.receivers().values()
+    assert receiver['latency'] == pytest.approx(1e3 * latency) and receiver['latency'] >= 50.0
+    assert pub.stats()['latency'] == receiver['latency']
+
+
+def test_netstats_cost():
+    """ Counting is cheap enough to leave enabled. """
+    stats = NetStats()
+    frames = [HEADER] + npcodec.packb(dict(lat=np.zeros(1000), simt=1.0))
+    n = 10000
+    tstart = time.perf_counter()
+    for i in range(n):
+        stats.count_sent(b'ACDATA', b'', frames, 1e-4)
+    cost = (time.perf_counter() - tstart) / n
+    assert stats.sent[(b'ACDATA', b'')][0] == n
+    assert cost < 20e-6
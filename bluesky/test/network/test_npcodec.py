@@ -0,0 +1,69 @@
+"""
+Tests the numpy message codec.
+
+Checks round trips of messages with small and large arrays over a ZMQ
+socket, and decoding of messages in the original (inline) format.
+"""
+import msgpack
+import numpy as np
+import zmq
+from bluesky.network import npcodec
+
+
+def acdata(n):
+    """ Message with arrays for n aircraft, and some small values. """
+    rng = np.random.default_rng(1)
+    data = {name: rng.uniform(size=n) for name in
+            ('lat', 'lon', 'alt', 'trk', 'tas', 'gs', 'cas', 'vs', 'tcpamax', 'rpz')}
+    data.update(inconf=rng.uniform(size=n) > 0.9, ingroup=np.zeros(n, dtype=np.int64),
+                id=[f'KL{i}' for i in range(n)], translvl=5000.0, small=np.arange(3))
+    return data
+
+
+def old_packb(data):
+    """ The original encoding: all arrays inline, in a single frame. """
+    return msgpack.packb(data, default=npcodec.encode_ndarray, use_bin_type=True)
+
+
+def check(result, data):
+    assert result.keys() == data.keys()
+    for key, value in data.items():
+        if isinstance(value, np.ndarray):
+            np.testing.assert_array_equal(result[key], value)
+            assert result[key].dtype == value.dtype
+        else:
+            assert result[key] == value
+
+
+def test_roundtrip():
+    """ Messages survive a round trip over ZMQ, large arrays as separate frames. """
+    data = acdata(500)
+    data['matrix'] = np.arange(600.).reshape(20, 30)
+    frames = npcodec.packb(data)
+    assert len(frames) == 1 + 12
+    ctx = zmq.Context()
+    try:
+        sender, receiver = ctx.socket(zmq.PAIR), ctx.socket(zmq.PAIR)
+        sender.bind('inproc://npcodec')
+        receiver.connect('inproc://npcodec')
+        sender.send_multipart(frames, copy=False)
+        received = receiver.recv_multipart(copy=False)
+    finally:
+        ctx.destroy(linger=0)
+    result = npcodec.unpackb(received)
+    check(result, data)
+
+    # Large arrays are views on the received frames
+    assert np.shares_memory(result['lat'], np.frombuffer(received[1].buffer, dtype=np.uint8))
+
+    # Later changes to sent arrays don't affect the message
+    data['lon'][:] = 0.0
+    assert npcodec.unpackb(frames)['lon'].any()
+
+
+def test_old_format():
+    """ Messages in the original single-frame format are still decoded. """
+    data = acdata(500)
+    check(npcodec.unpackb([old_packb(data)]), data)
+    assert npcodec.unpackb([old_packb(['text', 1])]) == ['text', 1]
+
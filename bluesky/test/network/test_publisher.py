@@ -0,0 +1,117 @@
+"""
+Tests the adaptive publishing interval of state publishers.
+
+Checks sequence numbers and acknowledgements of published messages, the
+lag and missed messages that receivers report, and the adaptation of the
+publishing interval to lagging receivers and to the cost of publishing.
+"""
+import time
+import pytest
+import bluesky as bs
+from bluesky.network import context as ctx
+from bluesky.network import sharedstate
+from bluesky.network.publisher import StatePublisher, periodic_publishers
+
+
+class Network:
+    """ Records sent messages instead of sending them. """
+    def __init__(self, subscribers=None):
+        self.sent = []
+        self.subscribers = subscribers
+
+    def send(self, topic, data='', to_group=''):
+        self.sent.append((topic, data, to_group))
+
+
+@pytest.fixture
+def net(monkeypatch):
+    net = Network(subscribers={b'*****PTEST'})
+    monkeypatch.setattr(bs, 'net', net, raising=False)
+    return net
+
+
+def test_publisher_acknowledge(net):
+    """ Receivers acknowledge messages, and report missed messages. """
+    pub = StatePublisher('PTEST1', dt=100)
+    pub.payload(lambda: dict(x=1))
+    for _ in range(3):
+        pub.send_replace()
+    pub.send_replace(to_group=b'C1')
+    assert [data[2] for _, data, _ in net.sent] == [1, 2, 3, 1]
+
+    # The receiver misses message 2, and acknowledges message 3
+    ctx.sender_id, ctx.topic, ctx.msg = b'SIM01', 'PTEST1', None
+    sharedstate.streams.clear()
+    sharedstate.acknowledge(1)
+    sharedstate.acknowledge(3)
+    topic, ack, to_group = net.sent[-1]
+    assert (topic, to_group) == ('PUBACK', b'SIM01')
+    assert ack == ['PTEST1', b'', 1, 0]
+    assert sharedstate.streams[(b'SIM01', 'PTEST1', b'')][:2] == (3, 1)
+
+    ctx.sender_id = b'CLNT1'
+    pub.ack(b'CLNT1', b'', 3, 1)
+    ctx.sender_id = ctx.topic = None
+    assert pub.ndropped == 1 and pub.dropped
+    lag, _ = pub.lag[b'CLNT1']
+    assert 0.0 <= lag < 1.0
+    # Drops are reported as totals per receiver
+    pub.ack(b'CLNT1', b'', 3, 1)
+    assert pub.ndropped == 1
+    assert 'PTEST1' in periodic_publishers()
+
+
+def test_publisher_adapt(net):
+    """ The interval grows while receivers miss messages, and shrinks again
+        when they keep up. """
+    pub = StatePublisher('PTEST2', dt=100)
+    assert (pub.dtmin, pub.dtmax) == (100, 100 * bs.settings.publish_maxfactor)
+    now = time.perf_counter()
+    for i in range(1, 6):
+        pub.ack(b'CLNT1', b'', 1, i)
+        pub.adapt(now + 2.0 * i)
+    assert pub.interval == pub.dtmax
+
+    # A receiver that keeps up
+    for i in range(6, 30):
+        pub.lag[b'CLNT1'] = (0.001, now + 2.0 * i)
+        pub.adapt(now + 2.0 * i)
+    assert pub.interval == pub.dtmin
+
+    # Publishing takes too much time
+    pub.cost = pub.interval * 1e-3
+    pub.adapt(now + 100.0)
+    assert pub.interval == 2 * pub.dtmin
+
+    # Receivers that stop acknowledging are removed
+    pub.adapt(now + 200.0)
+    assert not pub.lag and pub.stats()['nreceivers'] == 0
+
+
+def test_publisher_publish(net):
+    """ Periodic publication skips timer ticks, and skips encoding replace
+        data when there are no subscribers. """
+    calls = []
+    pub = StatePublisher('PTEST3', dt=100)
+    pub.payload(lambda: calls.append(1) or dict(x=len(calls)))
+    pub.interval = 300
+    for _ in range(6):
+        pub.publish()
+        time.sleep(0.1)
+    assert 2 <= len(calls) <= 3 and pub.nskipped >= 3
+
+    nosub = StatePublisher('NOSUB', dt=100)
+    nosub.payload(lambda: calls.append(1) or dict(x=1))
+    ncalls = len(calls)
+    nosub.publish()
+    assert len(calls) == ncalls
+
+
+def test_publisher_broadcast_subscribers(net):
+    """ Subscriptions to messages sent directly to a client don't count as
+        subscriptions to the broadcasts of a topic. """
+    pub = StatePublisher('PTEST')
+    net.subscribers = {b'C1234PTEST'}
+    assert pub.hassubscribers() and not pub.hassubscribers(broadcast=True)
+    net.subscribers.add(b'M****PTEST')
+    assert pub.hassubscribers(broadcast=True)
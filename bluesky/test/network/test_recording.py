@@ -0,0 +1,207 @@
+"""
+Tests the recording and indexed replay of state streams.
+
+Records synthetic aircraft, trail, and simulation info messages, and checks
+the keyframe index, reconstructing the state at arbitrary times from the
+last keyframe, simulation resets, storing compact aircraft data decoded,
+reading a recording that is still in progress, and recording in a separate
+thread of the server.
+"""
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pytest
+import bluesky as bs
+from bluesky.network import compact, npcodec
+from bluesky.network.recording import Recorder, Reader, KEYFRAME, merge
+from bluesky.network.replay import ReplayNode, txt2simt
+from bluesky.network.server import Server
+
+
+NAC = 200
+
+
+def acdata(simt):
+    """ Aircraft data of NAC aircraft at simt. """
+    idx = np.arange(NAC, dtype=float)
+    return dict(simt=simt, id=[f'KL{i}' for i in range(NAC)],
+                lat=52.0 + 1e-3 * idx + 1e-4 * simt, lon=4.0 + 1e-3 * idx,
+                alt=np.full(NAC, 3000.0), tas=np.full(NAC, 120.0))
+
+
+def trails(simt):
+    """ One trail segment per aircraft at simt. """
+    lat = 52.0 + 1e-4 * simt + np.zeros(NAC)
+    return dict(traillat0=lat, traillon0=lat, traillat1=lat, traillon1=lat,
+                trailtime=np.full(NAC, simt))
+
+
+def record(fname, duration, recorder=None):
+    """ Record one message per topic per second for duration seconds. """
+    recorder = recorder or Recorder(fname)
+    for simt in np.arange(0.0, duration):
+        recorder.record(b'ACDATA', npcodec.packb([b'R', acdata(simt), 1]))
+        recorder.record(b'TRAILS', npcodec.packb([b'E', trails(simt), 1]))
+        recorder.record(b'SIMINFO', npcodec.packb([1.0, 1.0, simt, '', 0, NAC, 0, '']))
+    return recorder
+
+
+def replaystate(fname, simt):
+    """ The state that a replay node reconstructs at simt. """
+    node = ReplayNode.__new__(ReplayNode)
+    node.reader = Reader(fname)
+    ReplayNode.seek(node, simt)
+    return node
+
+
+def test_recording_index(tmp_path, monkeypatch):
+    """ Keyframes are written every record_keyinterval seconds, and seeking
+        starts at the last keyframe before the requested time. """
+    monkeypatch.setattr(bs.settings, 'record_keyinterval', 60.0, raising=False)
+    fname = tmp_path / 'test.bsr'
+    stats = record(fname, 300).close()
+    reader = Reader(fname)
+    # Closing the recording adds a keyframe at its end
+    np.testing.assert_array_equal(reader.index['simt'], [0.0, 60.0, 120.0, 180.0, 240.0, 299.0])
+    assert reader.index['acsec'][-1] == pytest.approx(NAC * 299.0)
+    assert stats['achours'] == pytest.approx(NAC * 299.0 / 3600.0)
+    assert reader.stats()['bytes_per_achour'] == pytest.approx(stats['bytes_per_achour'])
+
+    reader.seek(reader.find(130.0))
+    simt, topic, action, frames = reader.read()
+    assert (simt, topic, action) == (120.0, b'', KEYFRAME)
+    assert {item[0] for item in frames} == {b'ACDATA', b'TRAILS', b'SIMINFO'}
+    assert reader.find(-1.0) == reader.index['offset'][0]
+
+
+def test_recording_seek(tmp_path, monkeypatch):
+    """ The state after seeking equals the recorded state at that time. """
+    monkeypatch.setattr(bs.settings, 'record_keyinterval', 60.0, raising=False)
+    fname = tmp_path / 'test.bsr'
+    record(fname, 200).close()
+
+    node = replaystate(fname, 150.5)
+    assert node.next[0] == 151.0
+    (action, frames), = node.state[b'ACDATA']
+    _, data, *_ = npcodec.unpackb(frames)
+    assert data['simt'] == 150.0
+    np.testing.assert_array_equal(data['lat'], acdata(150.0)['lat'])
+
+    # Trails up to the keyframe are one merged replace, followed by extends
+    trailmsgs = node.state[b'TRAILS']
+    assert trailmsgs[0][0] == b'R' and len(trailmsgs) == 1 + 31
+    store = npcodec.unpackb(merge(trailmsgs))[1]
+    np.testing.assert_array_equal(np.unique(store['trailtime']), np.arange(151.0))
+
+    assert txt2simt('1:02:30') == 3750.0 and txt2simt('90') == 90.0
+
+
+def test_recording_reset(tmp_path, monkeypatch):
+    """ A simulation reset starts a new run with a keyframe, and seeking
+        goes to the latest run. """
+    monkeypatch.setattr(bs.settings, 'record_keyinterval', 60.0, raising=False)
+    fname = tmp_path / 'reset.bsr'
+    recorder = record(fname, 100)
+    recorder.record(b'RESET', npcodec.packb(''))
+    record(fname, 30, recorder).close()
+
+    reader = Reader(fname)
+    np.testing.assert_array_equal(reader.index['simt'], [0.0, 60.0, 0.0, 29.0])
+    assert reader.find(20.0) == reader.index['offset'][2]
+    assert reader.find(80.0) == reader.index['offset'][3]
+
+    # The state after the reset doesn't contain the trails from before it
+    node = replaystate(fname, 20.5)
+    store = npcodec.unpackb(merge(node.state[b'TRAILS']))[1]
+    np.testing.assert_array_equal(np.unique(store['trailtime']), np.arange(21.0))
+
+
+def test_recording_trails_bounded(tmp_path, monkeypatch):
+    """ Keyframes only contain the trails within the maximum length and age. """
+    monkeypatch.setattr(bs.settings, 'record_keyinterval', 10.0, raising=False)
+    monkeypatch.setattr(bs.settings, 'trails_maxlen', 20 * NAC, raising=False)
+    monkeypatch.setattr(bs.settings, 'trails_maxage', 0.0, raising=False)
+    fname = tmp_path / 'test.bsr'
+    record(fname, 100).close()
+
+    reader = Reader(fname)
+    # The first keyframe precedes the first trails
+    for offset in reader.index['offset'][1:]:
+        reader.seek(offset)
+        _, _, _, items = reader.read()
+        (_, _, frames), = [item for item in items if item[0] == b'TRAILS']
+        _, data = npcodec.unpackb(frames)
+        assert len(data['trailtime']) <= 20 * NAC
+    # The final keyframe has the trails of the last 20 seconds
+    np.testing.assert_array_equal(np.unique(data['trailtime']), np.arange(80.0, 100.0))
+
+    monkeypatch.setattr(bs.settings, 'trails_maxlen', 0, raising=False)
+    monkeypatch.setattr(bs.settings, 'trails_maxage', 5.0, raising=False)
+    node = replaystate(fname, 50.5)
+    store = npcodec.unpackb(merge(node.state[b'TRAILS']))[1]
+    np.testing.assert_array_equal(np.unique(store['trailtime']), np.arange(45.0, 51.0))
+
+
+def test_recording_compact(tmp_path):
+    """ Compact aircraft data is recorded decoded. """
+    fname = tmp_path / 'compact.bsr'
+    recorder = Recorder(fname)
+    encoder = compact.Encoder()
+    for simt in range(5):
+        msg = encoder.encode(acdata(float(simt)), keyframe=simt == 0)
+        recorder.record(b'ACDATA', npcodec.packb([b'R', msg, 1]))
+    recorder.close()
+
+    reader = Reader(fname)
+    records = [record for record in iter(reader.read, None) if record[2] != KEYFRAME]
+    assert len(records) == 5
+    _, data, *_ = npcodec.unpackb(records[-1][3])
+    assert not compact.iscompact(data)
+    np.testing.assert_allclose(data['lat'], acdata(4.0)['lat'], atol=1e-5)
+
+
+def test_recording_in_progress(tmp_path, monkeypatch):
+    """ A recording can be read while it is still being written. """
+    monkeypatch.setattr(bs.settings, 'record_keyinterval', 10.0, raising=False)
+    fname = tmp_path / 'live.bsr'
+    recorder = record(fname, 25)
+    recorder.file.flush()
+    reader = Reader(fname)
+    assert len(reader.index) == 3
+    nread = len(list(iter(reader.read, None)))
+    assert nread == 3 * 25 + 3
+
+    # Records that are written later become available
+    recorder.record(b'ACDATA', npcodec.packb([b'R', acdata(25.0), 1]))
+    recorder.file.flush()
+    assert reader.read()[0] == 25.0
+    assert reader.read() is None
+    recorder.close()
+
+
+class Socket:
+    """ Ignores (un)subscription messages of the server. """
+    def send_multipart(self, frames):
+        pass
+
+
+def test_recording_server(tmp_path):
+    """ The server records in a separate thread, and closing a recording
+        waits for the records that are still queued. """
+    server = Server.__new__(Server)
+    server.recorders = dict()
+    server.recordwriter = ThreadPoolExecutor(max_workers=1)
+    server.recordreplies = deque()
+    server.sock_recv = Socket()
+    echoes = []
+    server.send = lambda topic, data='', dest=b'': echoes.append(data['text'])
+    fname = tmp_path / 'server.bsr'
+    server.record(b'NODE1', str(fname))
+    recorder = server.recorders[b'NODE1']
+    for simt in np.arange(0.0, 20.0):
+        frames = npcodec.packb([b'R', acdata(simt), 1])
+        server.recordwriter.submit(recorder.record, b'ACDATA', frames)
+    server.record(b'NODE1')
+    server.recordwriter.shutdown()
+    assert not server.recorders and echoes[-1].startswith('Recorded 19 s')
+    assert Reader(fname).index['simt'][-1] == 19.0
@@ -0,0 +1,165 @@
+"""
+Tests the shared-memory transport of published arrays.
+
+Checks round trips of messages with arrays in shared memory, detection
+of messages that were overwritten by newer ones, growing and retiring of
+shared memory blocks, that received data that is kept doesn't reference
+shared memory, and that messages arrive the same as when they are sent
+over a TCP socket.
+"""
+import numpy as np
+import pytest
+import zmq
+from bluesky.network import compact, npcodec, shmem, sharedstate
+
+
+def acdata(n, t=0.0):
+    """ Message with arrays for n aircraft, and some small values. """
+    rng = np.random.default_rng(1)
+    data = {name: rng.uniform(size=n) + t for name in
+            ('lat', 'lon', 'alt', 'trk', 'tas', 'gs', 'cas', 'vs', 'tcpamax', 'rpz')}
+    data.update(inconf=rng.uniform(size=n) > 0.9, ingroup=np.zeros(n, dtype=np.int64),
+                id=[f'KL{i}' for i in range(n)], simt=t, small=np.arange(3))
+    return data
+
+
+def check(result, data):
+    assert result.keys() == data.keys()
+    for key, value in data.items():
+        if isinstance(value, np.ndarray):
+            np.testing.assert_array_equal(result[key], value)
+            assert result[key].dtype == value.dtype
+        else:
+            assert result[key] == value
+
+
+def test_shmem_roundtrip():
+    """ Large arrays are sent through shared memory, and mapped without copying. """
+    writer = shmem.Writer()
+    try:
+        data = acdata(500)
+        frames = npcodec.packb(data, writer)
+        # The payload, and the location of the arrays
+        assert len(frames) == 2 and sum(len(f) for f in frames) < 8000
+        result = npcodec.unpackb(frames)
+        check(result, data)
+        assert not result['lat'].flags.writeable
+        block = shmem.blocks[writer.blocks[1].name]
+        assert np.shares_memory(result['lat'], np.ndarray(block.size, np.uint8, block.buf))
+
+        # Messages without large arrays don't use shared memory
+        assert len(npcodec.packb(dict(small=np.arange(3)), writer)) == 1
+    finally:
+        writer.close()
+
+
+def test_shmem_stale():
+    """ Buffers are reused after two messages: older messages are detected. """
+    writer = shmem.Writer()
+    try:
+        frames = [npcodec.packb(acdata(200, t), writer) for t in range(3)]
+        with pytest.raises(shmem.StaleError):
+            npcodec.unpackb(frames[0])
+        check(npcodec.unpackb(frames[1]), acdata(200, 1))
+        check(npcodec.unpackb(frames[2]), acdata(200, 2))
+
+        # More aircraft: a larger block is created, the old one is retired,
+        # and unmapped when its arrays are no longer used
+        old = npcodec.unpackb(frames[2])
+        oldname = writer.blocks[1].name
+        for t in (3, 4):
+            result = npcodec.unpackb(npcodec.packb(acdata(1000, t), writer))
+        check(result, acdata(1000, 4))
+        assert oldname in shmem.retired
+        del old
+        shmem.release()
+        assert oldname not in shmem.retired and oldname in shmem.closed
+        # Messages in a retired block are stale
+        with pytest.raises(shmem.StaleError):
+            npcodec.unpackb(frames[2])
+    finally:
+        writer.close()
+    del result
+    shmem.release()
+    assert not shmem.blocks and not shmem.retired
+
+
+def test_shmem_removed(monkeypatch):
+    """ Only a missing first block means that shared memory isn't accessible. """
+    monkeypatch.setattr(shmem, 'blocks', dict())
+    monkeypatch.setattr(shmem, 'retired', dict())
+    monkeypatch.setattr(shmem, 'closed', set())
+    with pytest.raises(FileNotFoundError):
+        shmem.attach('bs_test_missing')
+
+    writer = shmem.Writer()
+    try:
+        result = npcodec.unpackb(npcodec.packb(acdata(200), writer))
+        # A block that was removed by its writer before it was mapped
+        with pytest.raises(shmem.StaleError):
+            shmem.attach('bs_test_missing')
+    finally:
+        writer.close()
+    del result
+    shmem.release()
+
+
+def test_shmem_keep():
+    """ Decoded and stored arrays remain valid when their block is reused. """
+    writer = shmem.Writer()
+    encoder = compact.Encoder()
+    decoder = compact.Decoder(lambda topic, data: encoder.ack(b'client', data[1])
+                              if topic == 'ACKFRAME' else None)
+    store = sharedstate.Store()
+    try:
+        first = acdata(2000)
+        first['ingroup'][:10] = 3
+        frames = npcodec.packb(encoder.encode(first), writer)
+        message = npcodec.unpackb(frames)
+        assert shmem.isshared(message['fields']['ingroup'][1])
+        store.replace(decoder.decode('ACDATA', message))
+        assert not shmem.isshared(store.ingroup) and not shmem.isshared(store.inconf)
+        assert not shmem.isshared(np.arange(3)) and shmem.keep(store.small) is store.small
+
+        # Later frames only contain the changed fields, and overwrite the
+        # block of the first frame
+        for t in (1, 2, 3):
+            data = acdata(2000, t)
+            data['ingroup'][:10] = 3
+            message = npcodec.unpackb(npcodec.packb(encoder.encode(data), writer))
+            assert 'ingroup' not in message['fields']
+            result = decoder.decode('ACDATA', message)
+            np.testing.assert_array_equal(result['ingroup'], first['ingroup'])
+            np.testing.assert_array_equal(result['inconf'], first['inconf'])
+        np.testing.assert_array_equal(store.ingroup, first['ingroup'])
+    finally:
+        writer.close()
+    del message, result
+    shmem.release()
+
+
+def test_shmem_tcp():
+    """ Messages sent through shared memory arrive the same as over TCP. """
+    data = acdata(2000)
+    ctx = zmq.Context()
+    writer = shmem.Writer()
+    try:
+        sender, receiver = ctx.socket(zmq.PUB), ctx.socket(zmq.SUB)
+        port = sender.bind_to_random_port('tcp://127.0.0.1')
+        receiver.connect(f'tcp://127.0.0.1:{port}')
+        receiver.setsockopt(zmq.SUBSCRIBE, b'')
+        # Wait for the subscription to arrive
+        while not receiver.poll(10):
+            sender.send_multipart([b'sync'])
+        while receiver.poll(100):
+            receiver.recv_multipart()
+
+        for shm in (None, writer, writer):
+            sender.send_multipart(npcodec.packb(data, shm), copy=False)
+            result = npcodec.unpackb(receiver.recv_multipart(copy=False))
+            for key in ('lat', 'lon', 'id'):
+                np.testing.assert_array_equal(result[key], data[key])
+            del result
+    finally:
+        ctx.destroy(linger=0)
+        writer.close()
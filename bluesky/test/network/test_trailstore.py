@@ -0,0 +1,93 @@
+"""
+Tests the ring-buffer storage of trails.
+
+Checks bounding of the ring buffer by length and age, removal of whole
+chunks, retrieval of new rows by global index, extending a RingStore
+through the shared state, and that extending trails gives the same data
+as concatenating numpy arrays.
+"""
+import numpy as np
+import pytest
+from bluesky.network import sharedstate
+from bluesky.tools.ringbuffer import RingBuffer
+
+
+def segments(t0, n):
+    """ n trail segments, one per second from t0. """
+    t = np.arange(t0, t0 + n, dtype=float)
+    return dict(lat0=t, lon0=t + 1.0, lat1=t + 2.0, lon1=t + 3.0, time=t)
+
+
+def test_ringbuffer_maxlen():
+    """ The oldest rows are removed, and chunks with only removed rows are freed. """
+    buffer = RingBuffer(maxlen=100, chunksize=16)
+    for t0 in range(0, 250, 25):
+        buffer.extend(segments(t0, 25))
+    assert len(buffer) == 100 and (buffer.start, buffer.end) == (150, 250)
+    np.testing.assert_array_equal(buffer.column('time'), np.arange(150.0, 250.0))
+    np.testing.assert_array_equal(buffer.column('lon1'), np.arange(153.0, 253.0))
+    assert buffer.column('col').size == 0
+    assert len(buffer.chunks['time']) <= 100 // 16 + 2
+
+    # Rows since a global index, also when that index was already removed
+    np.testing.assert_array_equal(buffer.since(240)['lat1'], np.arange(242.0, 252.0))
+    assert len(buffer.since(10)['lat0']) == 100
+    assert len(buffer.since(250)['lat0']) == 0
+
+    # Clearing keeps the global index increasing
+    buffer.clear()
+    assert len(buffer) == 0 and buffer.start == 250
+    assert buffer.column('time').size == 0
+    buffer.extend(segments(0, 5))
+    assert (buffer.start, buffer.end) == (250, 255)
+
+    with pytest.raises(KeyError):
+        buffer.extend(dict(lat0=[1.0]))
+
+
+def test_ringbuffer_maxage():
+    """ Rows older than maxage relative to the newest row are removed. """
+    buffer = RingBuffer(maxage=30.0, timekey='time', chunksize=8)
+    buffer.extend(segments(0, 50))
+    np.testing.assert_array_equal(buffer.column('time'), np.arange(19.0, 50.0))
+    buffer.extend(segments(100, 1))
+    np.testing.assert_array_equal(buffer.column('time'), [100.0])
+    assert buffer.search('time', 100.0) == buffer.start
+
+
+def test_ringstore_sharedstate():
+    """ A RingStore topic is extended and replaced by TRAILS messages. """
+    sharedstate.addtopic('RINGTEST', sharedstate.RingStore(maxlen=10))
+    store = sharedstate.RingStore(maxlen=10)
+    store.extend(segments(0, 8))
+    store.extend(segments(8, 8))
+    assert store.valid()
+    np.testing.assert_array_equal(store.time, np.arange(6.0, 16.0))
+    start = store.buffer.end
+    store.append(dict(lat0=1.0, lon0=2.0, lat1=3.0, lon1=4.0, time=16.0))
+    assert list(store.buffer.since(start)['time']) == [16.0]
+
+    store.replace(segments(100, 3))
+    np.testing.assert_array_equal(store.lat0, [100.0, 101.0, 102.0])
+    with pytest.raises(AttributeError):
+        store.notacolumn
+
+    # Each remote gets its own copy of the (empty) store
+    remote = sharedstate.remotes[b'']
+    assert isinstance(remote.ringtest, sharedstate.RingStore)
+    assert remote.ringtest is not sharedstate.defaults.ringtest
+    assert not remote.ringtest.valid()
+
+
+def test_ringbuffer_extend():
+    """ Extending in small batches gives the same columns as concatenating arrays. """
+    n, batch = 20000, 100
+    buffer = RingBuffer()
+    data = {name: np.array([]) for name in segments(0, 0)}
+    for i in range(0, n, batch):
+        buffer.extend(segments(i, batch))
+        data = {name: np.concatenate((data[name], values))
+                for name, values in segments(i, batch).items()}
+    assert len(buffer) == n
+    for name, values in data.items():
+        np.testing.assert_array_equal(buffer.column(name), values)
@@ -0,0 +1,81 @@
+"""
+Tests the per-client viewport selection of aircraft data.
+
+Checks the vectorised viewport mask (with margin, and across the date
+line), the selection of per-aircraft fields, grouping of clients with
+identical viewports, and the reduced update rate of zoomed-out viewports.
+"""
+import numpy as np
+import bluesky as bs
+from bluesky.simulation.viewport import Viewports
+
+
+def acdata(lat, lon):
+    n = len(lat)
+    return dict(simt=10.0, id=[f'KL{i}' for i in range(n)], lat=np.asarray(lat),
+                lon=np.asarray(lon), alt=np.arange(n, dtype=float),
+                translvl=1524.0, custacclr={'KL0': (255, 0, 0)})
+
+
+def test_viewport_mask():
+    """ Aircraft inside the viewport plus margin are selected. """
+    lat = np.array([52.0, 52.0, 55.5, 49.5, 52.0, 52.0])
+    lon = np.array([4.0, 6.5, 4.0, 4.0, 10.0, -179.0])
+    viewport = (50.0, 55.0, 2.0, 6.0, 1.0)
+    # Margin of 10% of the viewport size: [49.5, 55.5] x [1.6, 6.4]
+    np.testing.assert_array_equal(Viewports.mask(viewport, lat, lon),
+                                  [True, False, True, True, False, False])
+
+    # A viewport across the date line, given as west lon > east lon
+    viewport = (40.0, 60.0, 170.0, -170.0, 1.0)
+    np.testing.assert_array_equal(Viewports.mask(viewport, lat, lon),
+                                  [False, False, False, False, False, True])
+    # The same viewport, with the east edge beyond 180 degrees
+    viewport = (40.0, 60.0, 170.0, 190.0, 1.0)
+    np.testing.assert_array_equal(Viewports.mask(viewport, lat, lon),
+                                  [False, False, False, False, False, True])
+
+
+def test_viewport_select():
+    """ Only per-aircraft fields are filtered. """
+    data = acdata([52.0, 60.0, 51.0], [4.0, 4.0, 5.0])
+    selection = Viewports.select(data, Viewports.mask((50.0, 55.0, 2.0, 6.0, 1.0),
+                                                      data['lat'], data['lon']))
+    assert selection['id'] == ['KL0', 'KL2']
+    np.testing.assert_array_equal(selection['alt'], [0.0, 2.0])
+    assert selection['simt'] == data['simt'] and selection['translvl'] == data['translvl']
+    assert selection['custacclr'] == data['custacclr']
+
+
+def test_viewport_groups():
+    """ Clients with identical viewports share a group, and an encoder. """
+    viewports = Viewports()
+    viewports.set(b'c1', 55.0, 50.0, 2.0, 6.0, 1.0)
+    viewports.set(b'c2', 50.0, 55.0, 2.0, 6.0, 1.0)
+    viewports.set(b'c3', 40.0, 60.0, -10.0, 20.0, 0.05)
+    assert viewports.groups() == {(50.0, 55.0, 2.0, 6.0, 1.0): [b'c1', b'c2'],
+                                  (40.0, 60.0, -10.0, 20.0, 0.05): [b'c3']}
+    assert viewports.encoder(b'c1') is viewports.encoder(b'c2')
+    assert viewports.encoder(b'c4') is None
+
+    # The zoomed-out viewport is updated at a reduced rate
+    nupdates = dict()
+    for _ in range(10 * bs.settings.viewport_lod_interval):
+        for viewport, clients in viewports.due().items():
+            nupdates[tuple(clients)] = nupdates.get(tuple(clients), 0) + 1
+    assert nupdates == {(b'c1', b'c2'): 10 * bs.settings.viewport_lod_interval, (b'c3',): 10}
+
+    viewports.remove(b'c3')
+    viewports.remove(b'c1')
+    assert list(viewports.groups().values()) == [[b'c2']]
+    assert len(viewports.encoders) == 1
+
+
+def test_viewport_mask_large():
+    """ A viewport selects a few of many aircraft. """
+    rng = np.random.default_rng(2)
+    data = acdata(rng.uniform(-60.0, 60.0, 30000), rng.uniform(-180.0, 180.0, 30000))
+    viewport = (50.0, 55.0, 2.0, 6.0, 1.0)
+    selection = Viewports.select(data, Viewports.mask(viewport, data['lat'], data['lon']))
+    assert 0 < len(selection['id']) < 100
+    assert np.all((selection['lat'] > 49.0) & (selection['lat'] < 56.0))
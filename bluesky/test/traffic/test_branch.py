@@ -0,0 +1,108 @@
+"""
+Tests forking a running simulation into branches.
+
+Runs a server in a thread and connects the network node of this process
+to it. Checks that a BRANCH request gets a node id from the server, that the
+forked branch continues with the same traffic as the parent, as a new node
+with that id, and that the server registers the branch as one of its nodes.
+"""
+import os
+import time
+import pickle
+import signal
+import numpy as np
+import zmq
+import bluesky
+from bluesky.network.common import genid
+from bluesky.network.server import Server
+from bluesky.stack import simstack
+
+
+def wait(condition, node=None, timeout=10.0):
+    """ Wait until condition() is true, while receiving on node. """
+    tstart = time.time()
+    while not condition() and time.time() - tstart < timeout:
+        if node is not None:
+            node.receive(50)
+        else:
+            time.sleep(0.05)
+    return condition()
+
+
+def test_branch(traffic_, monkeypatch):
+    """ A branch continues with the traffic of its parent, as a new node. """
+    monkeypatch.setattr(bluesky.settings, 'recv_port', 12100)
+    monkeypatch.setattr(bluesky.settings, 'send_port', 12101)
+    # The server shouldn't start simulation nodes of its own
+    monkeypatch.setattr(Server, 'addnodes', lambda self, *args, **kwargs: None)
+    handlers = signal.getsignal(signal.SIGINT), signal.getsignal(signal.SIGTERM)
+
+    server = Server(discovery=False)
+    server.daemon = True
+    server.start()
+    # Connect the network node of the simulation as the first node of the server
+    node = bluesky.net
+    ids = node.node_id, node.group_id, node.server_id
+    node.node_id = genid(server.server_id[:-1], seqidx=1)
+    node.group_id, node.server_id = node.node_id[:-1], server.server_id
+    server.max_group_idx = 1
+    server.forked_processes[node.node_id] = None
+    node.connect()
+    # Pipes to receive the state of the branch, and to stop it
+    rfd, wfd = os.pipe()
+    rstop, wstop = os.pipe()
+    try:
+        # Wait until the server registered this node, and subscribed to it
+        assert wait(lambda: node.node_id in server.sim_nodes and server.server_id in node.subscribers, node)
+        bluesky.sim.reset()
+        simstack.process([(f'CRE KL{i},B744,52,{4 + 0.01 * i},{10 * i},FL100,250', None)
+                          for i in range(20)])
+        bluesky.sim.op()
+        for _ in range(50):
+            bluesky.sim.step()
+
+        simstack.process([('BRANCH 1', None)])
+        assert wait(lambda: bluesky.sim.branchids, node)
+        branchid, = bluesky.sim.branchids
+        bluesky.sim.forkbranches()
+        if node.forked:
+            # This is the branch: report its state to the parent, and stay
+            # connected until the parent is done
+            os.close(rfd)
+            os.close(wstop)
+            with os.fdopen(wfd, 'wb') as f:
+                f.write(pickle.dumps((node.node_id, bluesky.sim.state, bluesky.sim.simt,
+                                      list(bluesky.traf.id), bluesky.traf.lat.copy())))
+            os.read(rstop, 1)
+            os._exit(0)
+
+        pid, = bluesky.sim.branchpids
+        os.close(wfd)
+        os.close(rstop)
+        with os.fdopen(rfd, 'rb') as f:
+            child_id, state, simt, acid, lat = pickle.loads(f.read())
+        assert child_id == branchid
+        assert state == bluesky.OP and simt == bluesky.sim.simt
+        assert acid == list(bluesky.traf.id)
+        np.testing.assert_array_equal(lat, bluesky.traf.lat)
+
+        # The server knows the process id of the branch, and registered it
+        assert wait(lambda: server.forked_processes.get(branchid) == pid, node)
+        assert wait(lambda: branchid in server.sim_nodes, node)
+        os.close(wstop)
+        os.waitpid(pid, 0)
+    finally:
+        node.send(b'QUIT', '', server.server_id)
+        server.join(10.0)
+        # Stopping the server closes all sockets of this process: continue
+        # with new, unconnected sockets
+        zmqctx = zmq.Context.instance()
+        node.sock_recv = zmqctx.socket(zmq.SUB)
+        node.sock_send = zmqctx.socket(zmq.XPUB)
+        node.poller = zmq.Poller()
+        node.node_id, node.group_id, node.server_id = ids
+        node.conninfo = None
+        node.subscribers = set()
+        signal.signal(signal.SIGINT, handlers[0])
+        signal.signal(signal.SIGTERM, handlers[1])
+        bluesky.sim.reset()
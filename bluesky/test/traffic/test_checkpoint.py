@@ -0,0 +1,138 @@
+"""
+Tests binary checkpoints of the simulation state.
+
+Checks that a simulation that is continued from a checkpoint gives
+exactly the same traffic as the original simulation, that attributes that
+can't be stored are reported, that a checkpoint that can't be decoded
+leaves the simulation intact, and that a streamed scenario continues from
+the same position.
+"""
+import threading
+import numpy as np
+import bluesky
+from bluesky.core.entity import getproxied
+from bluesky.simulation import checkpoint
+from bluesky.stack import simstack
+from bluesky.stack.stackbase import Stack
+from bluesky.traffic.route import Route
+
+
+def setup_traffic(n):
+    """ Create n aircraft, some of which fly a route. """
+    rng = np.random.default_rng(9)
+    lat, lon = rng.uniform(51., 53., n), rng.uniform(3., 6., n)
+    bluesky.sim.reset()
+    cmds = [f'CRE KL{i},B744,{lat[i]:.4f},{lon[i]:.4f},{i % 360},FL{100 + i % 200},250'
+            for i in range(n)]
+    cmds += [f'ADDWPT KL{i} {lat[i] + 0.5:.4f} {lon[i]:.4f} FL200' for i in range(0, n, 2)]
+    cmds += [f'ADDWPT KL{i} EHAM' for i in range(0, n, 2)]
+    cmds += [f'VNAV KL{i} ON' for i in range(0, n, 4)]
+    simstack.process([(cmd, None) for cmd in cmds])
+
+
+def run(nsteps):
+    """ Perform nsteps simulation steps, return traffic state. """
+    for _ in range(nsteps):
+        bluesky.sim.step()
+    traf = bluesky.traf
+    return (bluesky.sim.simt, list(traf.id), traf.lat.copy(), traf.lon.copy(), traf.alt.copy(),
+            traf.tas.copy(), traf.hdg.copy(), traf.actwp.lat.copy(),
+            [route.iactwp for route in traf.ap.route], np.random.random())
+
+
+def test_checkpoint_restore(traffic_, tmp_path):
+    """ Continuing from a checkpoint gives the same simulation. """
+    setup_traffic(100)
+    simstack.merge([(30.0, 'DEL KL3'), (60.0, 'ALT KL5,FL300')])
+    run(200)
+    fname = tmp_path / 'test.chk'
+    checkpoint.save(fname)
+    ref = run(1000)
+
+    assert checkpoint.load(fname) == []
+    # The checkpoint can be saved again while its arrays are in use: they
+    # are copied out of the memory map of the file first
+    _, mm = checkpoint._mapped
+    checkpoint.save(fname)
+    assert mm.closed
+    assert checkpoint.load(fname) == []
+    assert bluesky.traf.ntraf == 100 and len(Stack.scen) == 2
+    assert Route._routes['KL10'] is bluesky.traf.ap.route[10]
+    state = run(1000)
+    assert state[0] == ref[0] and state[1] == ref[1] and state[-2:] == ref[-2:]
+    for a, b in zip(state[2:-2], ref[2:-2]):
+        np.testing.assert_array_equal(a, b)
+
+    # Restored arrays are writable, and can be resized
+    bluesky.traf.lat[0] = 0.0
+    simstack.process([('DEL KL0', None), ('CRE KL0,A320,52,4,0,FL100,250', None)])
+    assert bluesky.traf.ntraf == 99
+    bluesky.sim.reset()
+
+
+def test_checkpoint_skipped(traffic_, tmp_path):
+    """ Attributes that can't be pickled are reported by save. """
+    setup_traffic(10)
+    cd = getproxied(bluesky.traf.cd)
+    cd.lock = threading.Lock()
+    try:
+        skipped = checkpoint.save(tmp_path / 'skipped.chk')
+    finally:
+        del cd.lock
+    assert skipped == [next(path for path, node in checkpoint.walk(bluesky.traf, 'Traffic')
+                            if node is cd) + '.lock']
+    assert checkpoint.save(tmp_path / 'skipped.chk') == []
+    bluesky.sim.reset()
+
+
+class Marker:
+    """ A stored value of which the class can be removed. """
+
+
+def test_checkpoint_invalid(traffic_, tmp_path, monkeypatch):
+    """ A checkpoint that can't be decoded is reported by CHECKPOINT LOAD,
+        and leaves the current simulation intact. """
+    setup_traffic(10)
+    fname = tmp_path / 'invalid.chk'
+    bluesky.traf.marker = Marker()
+    try:
+        checkpoint.save(fname)
+    finally:
+        del bluesky.traf.marker
+    ref = run(10)
+
+    # A checkpoint of another code version, without this class
+    monkeypatch.delitem(globals(), 'Marker')
+    success, msg = checkpoint.load_checkpoint(str(fname))
+    assert not success and msg.startswith('CHECKPOINT: Error reading')
+    assert bluesky.sim.simt == ref[0] and list(bluesky.traf.id) == ref[1]
+    np.testing.assert_array_equal(bluesky.traf.lat, ref[2])
+    bluesky.sim.reset()
+
+
+def test_checkpoint_stream(traffic_, tmp_path, monkeypatch):
+    """ A streamed scenario is stored as its position, and continues from
+        there when the checkpoint is loaded. """
+    fname = tmp_path / 'stream.scn'
+    with open(fname, 'w') as f:
+        for i in range(200):
+            f.write(f'00:00:{i // 4:02d}.{25 * (i % 4):02d}>CRE KL{i},B744,52,4,{i},FL100,250\n')
+    monkeypatch.setattr(bluesky.settings, 'scenario_window', 5.0)
+    monkeypatch.setattr(bluesky.settings, 'scenario_cache', False)
+    simstack.ic(str(fname))
+    bluesky.sim.op()
+    run(100)
+    chkname = tmp_path / 'stream.chk'
+    checkpoint.save(chkname)
+    # Only the look-ahead window is in memory
+    assert len(Stack.scen.cmds) - Stack.scen.cursor < 100
+    ref = run(1100)
+    assert bluesky.traf.ntraf == 200
+
+    assert checkpoint.load(chkname) == []
+    assert Stack.scen.position()[0] == str(fname)
+    state = run(1100)
+    assert state[1] == ref[1]
+    np.testing.assert_array_equal(state[2], ref[2])
+    bluesky.sim.reset()
+
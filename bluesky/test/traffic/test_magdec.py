@@ -0,0 +1,50 @@
+"""
+Tests the vectorised magnetic declination lookup.
+
+Checks that scalar and array positions give the same declination, and that
+the values match the previous scalar implementation on a float64 table.
+"""
+import numpy as np
+import bluesky as bs
+from bluesky.tools import geo
+
+
+def magdec_reference(table, latd, lond):
+    """ The previous scalar implementation of geo.magdec. Its index at
+        lon = 180 is clamped here, where the original indexed outside the table. """
+    i_lat = min(max(0, int(90. - latd)), 180)
+    f_lat = (90. - latd) - int(90. - latd)
+    i_lon = min(max(0, int(lond + 180)), 360)
+    f_lon = lond + 180. - int(lond + 180)
+    declon0 = table[i_lat, i_lon] * (1. - f_lat) + f_lat * table[min(180, i_lat + 1), i_lon]
+    declon1 = table[i_lat, min(i_lon + 1, 360)] * (1. - f_lat) + \
+        f_lat * table[min(180, i_lat + 1), min(i_lon + 1, 360)]
+    return declon0 * (1. - f_lon) + f_lon * declon1
+
+
+def reference_table():
+    """ The declination table as read by the previous implementation. """
+    dec_table = np.genfromtxt(bs.resource(bs.settings.navdata_path) / 'geo_declination_data.csv',
+                              comments='#', delimiter=',')
+    table = dec_table[:, 4].reshape((180, 360))
+    table = np.vstack((table[0:1, :], table))
+    return np.hstack((table, table[:, 0:1]))
+
+
+def test_magdec(traffic_):
+    """ Scalar and array lookups agree, and match the previous implementation. """
+    rng = np.random.default_rng(7)
+    lat = np.concatenate((rng.uniform(-90., 90., 500), [90., -90., 0., 52.3]))
+    lon = np.concatenate((rng.uniform(-180., 180., 500), [180., -180., 0., 4.76]))
+
+    result = geo.magdec(lat, lon)
+    assert result.shape == lat.shape
+    scalars = [geo.magdec(la, lo) for la, lo in zip(lat, lon)]
+    assert all(isinstance(value, float) for value in scalars)
+    np.testing.assert_array_equal(result, scalars)
+
+    table = reference_table()
+    assert table.shape == geo._geo.decl_lat_lon.shape
+    np.testing.assert_allclose(geo._geo.decl_lat_lon, table, atol=1e-5)
+    reference = [magdec_reference(table, la, lo) for la, lo in zip(lat, lon)]
+    np.testing.assert_allclose(result, reference, atol=1e-5)
@@ -0,0 +1,247 @@
+"""
+Tests the partitioning of a simulation into geographic tiles.
+
+Checks the tile grid and halos, that an aircraft that migrates to another
+partition continues exactly as it would have without migrating, that
+conflict detection per tile, with the aircraft in the halo as ghosts, finds
+the same conflicts as conflict detection over all traffic, and that a
+partitioned simulation with in-process message passing between its
+partitions and the synchronisation barrier of the server counts the same
+conflicts over many steps as a simulation on a single node.
+"""
+import numpy as np
+import bluesky
+from bluesky.network import npcodec
+from bluesky.network import context as ctx
+from bluesky.network.server import Server
+from bluesky.simulation import checkpoint, partition
+from bluesky.simulation.partition import Partition, ghostdata, migrate, insert
+from bluesky.stack import simstack
+from bluesky.tools.aero import nm
+
+
+def setup_traffic(n, seed=3):
+    """ Create n aircraft around a point, half of which fly a route. """
+    rng = np.random.default_rng(seed)
+    lat, lon = rng.uniform(51.5, 52.5, n), rng.uniform(3.5, 5.0, n)
+    hdg, alt = rng.integers(0, 360, n), rng.choice([100, 110, 120], n)
+    bluesky.sim.reset()
+    cmds = [f'CRE KL{i},B744,{lat[i]:.4f},{lon[i]:.4f},{hdg[i]},FL{alt[i]},250' for i in range(n)]
+    cmds += [f'ADDWPT KL{i} {lat[i] + 0.5:.4f} {lon[i]:.4f} FL200' for i in range(0, n, 2)]
+    cmds += [f'VNAV KL{i} ON' for i in range(0, n, 4)]
+    simstack.process([(cmd, None) for cmd in cmds])
+
+
+def run(nsteps):
+    for _ in range(nsteps):
+        bluesky.sim.step()
+
+
+def pairs(conflicts):
+    """ Conflict pairs in a comparable order. """
+    return sorted(sorted(pair) for pair in conflicts)
+
+
+def clearconflicts():
+    """ Forget the conflicts detected so far. """
+    cd = bluesky.traf.cd
+    cd.clearconfdb()
+    cd.confpairs_all.clear()
+    cd.lospairs_all.clear()
+
+
+def test_partition_tiles():
+    """ Tile lookup, tile boundaries, and halos. """
+    part = Partition()
+    part.latbounds = np.array([52.0])
+    part.lonbounds = np.array([4.0, 5.0])
+    lat, lon = np.array([51.0, 51.0, 53.0, 53.0]), np.array([3.0, 4.5, 4.5, 6.0])
+    np.testing.assert_array_equal(part.owner(lat, lon), [0, 1, 4, 5])
+    assert part.box(4) == (52.0, np.inf, 4.0, 5.0)
+
+    # 30 nm from tile 4, at 52 degrees latitude
+    dist = 30 * nm
+    lat, lon = np.array([51.6, 51.4, 52.5, 52.5]), np.array([4.5, 4.5, 5.7, 5.9])
+    np.testing.assert_array_equal(part.inhalo(4, lat, lon, dist), [True, False, True, False])
+
+
+def test_partition_migrate(traffic_, tmp_path):
+    """ An aircraft that migrates continues exactly as without migrating. """
+    setup_traffic(20)
+    run(100)
+    fname = tmp_path / 'migrate.chk'
+    checkpoint.save(fname)
+    traf = bluesky.traf
+    wpname = list(traf.ap.route[4].wpname)
+    run(2000)
+    ref = [(traf.lat[i], traf.lon[i], traf.alt[i], traf.actwp.lat[i]) for i in (4, 7)]
+
+    checkpoint.load(fname)
+    # Send KL4 and KL7 through the network encoding, and create them again
+    data = npcodec.unpackb(npcodec.packb(migrate([4, 7])))
+    traf.delete([4, 7])
+    assert traf.id2idx('KL4') < 0 and traf.ntraf == 18
+    insert(data['n'], data['rows'])
+    assert traf.id[-2:] == ['KL4', 'KL7'] and traf.ntraf == 20
+    assert traf.ap.route[-2].acid == 'KL4' and traf.ap.route[-2].wpname == wpname
+    run(2000)
+    for acid, values in zip(('KL4', 'KL7'), ref):
+        i = traf.id2idx(acid)
+        np.testing.assert_array_equal((traf.lat[i], traf.lon[i], traf.alt[i], traf.actwp.lat[i]),
+                                      values)
+    bluesky.sim.reset()
+
+
+def test_partition_conflicts(traffic_, tmp_path):
+    """ Conflict detection per tile gives the same conflicts as conflict
+        detection over all traffic. """
+    setup_traffic(400, seed=5)
+    simstack.process([('CDMETHOD STATEBASED', None)])
+    run(20)
+    traf = bluesky.traf
+    fname = tmp_path / 'conflicts.chk'
+    checkpoint.save(fname)
+    clearconflicts()
+    traf.cd.update(traf, traf)
+    refconf, reflos = set(traf.cd.confpairs_all), set(traf.cd.lospairs_all)
+    assert len(refconf) > 10
+
+    part = Partition()
+    part.latbounds = np.quantile(traf.lat, [0.5])
+    part.lonbounds = np.quantile(traf.lon, [1 / 3, 2 / 3])
+    confs, losses = [], []
+    for tile in range(6):
+        checkpoint.load(fname)
+        clearconflicts()
+        owner = part.owner(traf.lat, traf.lon)
+        # The halo of this tile, from all other tiles
+        dist = part.halodist()
+        others = np.flatnonzero(owner != tile)
+        sel = part.inhalo(tile, traf.lat[others], traf.lon[others], dist)
+        ghosts = ghostdata(others[sel])
+        traf.delete(others)
+        traf.cd.ghosts = ghosts
+        traf.cd.update(traf, traf)
+        confs.extend(traf.cd.confpairs_all)
+        losses.extend(traf.cd.lospairs_all)
+
+    # Each conflict is counted by exactly one tile
+    assert len(confs) == len(refconf) and set(confs) == refconf
+    assert len(losses) == len(reflos) and set(losses) == reflos
+    bluesky.sim.reset()
+
+
+class Exchange:
+    """ In-process message passing between partitions and the server. """
+    def __init__(self, members, server_id):
+        self.server_id = server_id
+        self.inbox = {member: [] for member in members}
+        self.sender = None
+        # The partition bookkeeping of the server
+        self.server = Server.__new__(Server)
+        self.server.partitions = dict()
+        self.server.send = lambda topic, data, dest: self.inbox[dest].append(
+            (server_id, topic, npcodec.unpackb(npcodec.packb(data))))
+
+    def send(self, topic, data='', to_group=b''):
+        topic = topic if isinstance(topic, bytes) else topic.encode()
+        if to_group == self.server_id:
+            if topic == b'PARTITION':
+                Server.partition(self.server, self.sender, data)
+            elif topic == b'PSYNC':
+                group = self.server.partitions[self.sender]
+                group['ready'].setdefault(data, set()).add(self.sender)
+                Server.syncpartitions(self.server, group)
+        elif topic in (b'HALO', b'MIGRATE'):
+            self.inbox[to_group].append((self.sender, topic, npcodec.unpackb(npcodec.packb(data))))
+
+    def deliver(self, member):
+        """ Process the messages to member. Returns False if there were none. """
+        handlers = {b'HALO': partition.on_halo, b'MIGRATE': partition.on_migrate,
+                    b'PSYNC': partition.on_psync}
+        messages, self.inbox[member] = self.inbox[member], []
+        for sender, topic, data in messages:
+            ctx.sender_id = sender
+            if isinstance(data, dict):
+                handlers[topic](**data)
+            else:
+                handlers[topic](data)
+        ctx.sender_id = None
+        return bool(messages)
+
+
+def test_partition_exchange(traffic_, tmp_path, monkeypatch):
+    """ Partitions that exchange migrants and halos, and synchronise at each
+        conflict detection step, count the same conflicts as one node. """
+    setup_traffic(120, seed=7)
+    simstack.process([('CDMETHOD STATEBASED', None)])
+    run(20)
+    traf, net = bluesky.traf, bluesky.net
+    tend = bluesky.sim.simt + 30.0
+    base = tmp_path / 'base.chk'
+    checkpoint.save(base)
+
+    # The same traffic on a single node
+    run(int(round((tend - bluesky.sim.simt) / bluesky.sim.simdt)))
+    refconf, reflos = pairs(traf.cd.confpairs_all), pairs(traf.cd.lospairs_all)
+    assert len(refconf) > 10
+
+    # Partitions of a 2 x 2 grid, with the tile boundaries of PARTITION
+    members = [f'TILE{tile}'.encode() for tile in range(4)]
+    exchange = Exchange(members, net.server_id)
+    monkeypatch.setattr(net, 'send', exchange.send)
+    # Partitions are activated by loading a checkpoint, which resets the
+    # simulation. The navigation data doesn't change, don't load it again
+    monkeypatch.setattr(bluesky.navdb, 'reset', lambda: None)
+    monkeypatch.setattr(net, 'node_id', net.node_id)
+    parts = dict()
+    for member in members:
+        part = parts[member] = Partition()
+        part.latbounds = np.quantile(traf.lat, [0.5])
+        part.lonbounds = np.quantile(traf.lon, [0.5])
+        part.members = members
+    exchange.sender = members[0]
+    net.send(b'PARTITION', members, net.server_id)
+    states = {member: base for member in members}
+
+    def activate(member):
+        # Loading a checkpoint resets the simulation, which ends the
+        # participation of the current partition: activate it afterwards
+        monkeypatch.setattr(partition, '_partition', Partition())
+        checkpoint.load(states[member])
+        partition._partition = parts[member]
+        net.node_id = exchange.sender = member
+
+    # Each partition runs until it waits for the others
+    try:
+        for _ in range(10000):
+            done = True
+            for member in members:
+                activate(member)
+                while bluesky.sim.simt < tend - 1e-6:
+                    simt = bluesky.sim.simt
+                    exchange.deliver(member)
+                    bluesky.sim.step()
+                    if bluesky.sim.simt == simt and not exchange.inbox[member]:
+                        done = False
+                        break
+                states[member] = tmp_path / f'{member.decode()}.chk'
+                checkpoint.save(states[member])
+            if done:
+                break
+
+        confs, losses, ntraf = [], [], 0
+        for member in members:
+            activate(member)
+            confs.extend(traf.cd.confpairs_all)
+            losses.extend(traf.cd.lospairs_all)
+            ntraf += traf.ntraf
+    finally:
+        monkeypatch.setattr(partition, '_partition', Partition())
+        ctx.sender_id = None
+
+    assert ntraf == 120
+    assert all(part.nsync == parts[members[0]].nsync > 25 for part in parts.values())
+    assert sum(part.nout for part in parts.values()) > 0
+    assert pairs(confs) == refconf and pairs(losses) == reflos
+    bluesky.sim.reset()
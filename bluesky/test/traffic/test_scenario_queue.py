@@ -0,0 +1,86 @@
+"""
+Tests the time-ordered scenario command buffer of the stack.
+
+Checks that commands are returned in the same order as with the
+original list-based buffer, in which commands from a scenario file are
+processed in file order, and merged commands are inserted after
+commands with the same time. Also checks streaming of scenarios.
+"""
+import numpy as np
+from bluesky.stack.stackbase import ScenarioQueue
+
+
+class ListQueue:
+    """ Reference implementation with plain lists. """
+    def __init__(self, times, cmds):
+        self.times, self.cmds = list(times), list(cmds)
+
+    def insert(self, cmdtime, cmdline):
+        idx = next((i for i, t in enumerate(self.times) if t > cmdtime), len(self.times))
+        self.times.insert(idx, cmdtime)
+        self.cmds.insert(idx, cmdline)
+
+    def pop(self, simt):
+        idx = next((i for i, t in enumerate(self.times) if t > simt), len(self.times))
+        due = self.cmds[:idx]
+        del self.times[:idx], self.cmds[:idx]
+        return due
+
+
+def test_scenario_queue_order():
+    rng = np.random.default_rng(6)
+    times = np.round(np.sort(rng.uniform(0., 100., 3000)))
+    # Scenario files are not necessarily sorted
+    times[rng.integers(0, 3000, 50)] = 0.
+    cmds = [f'CMD{i}' for i in range(3000)]
+
+    queue, ref = ScenarioQueue(), ListQueue(times, cmds)
+    queue.set(times, cmds)
+    for simt in np.arange(0., 120., 0.5):
+        if simt % 10 == 0:
+            for i, t in enumerate(np.round(simt + rng.uniform(0., 50., 40))):
+                queue.insert(t, f'INS{simt}-{i}')
+                ref.insert(t, f'INS{simt}-{i}')
+        if simt == 60.:
+            assert queue.data()[1] == ref.cmds
+        assert queue.pop(simt) == ref.pop(simt)
+    assert len(queue) == len(ref.cmds)
+
+
+def test_scenario_queue_stream():
+    """
+    Streamed scenarios give the same commands as fully loaded scenarios,
+    while only keeping commands within the look-ahead window in memory.
+    """
+    rng = np.random.default_rng(7)
+    times = np.round(np.sort(rng.uniform(0., 1000., 20000)), 1)
+    times[rng.integers(0, 20000, 50)] = 0.
+    cmds = [f'CMD{i}' for i in range(20000)]
+
+    full, streamed = ScenarioQueue(), ScenarioQueue()
+    full.set(times, cmds)
+    streamed.stream(zip(times.tolist(), cmds), window=10.)
+    for simt in np.arange(0., 1100., 0.5):
+        if simt % 50 == 0:
+            for i, t in enumerate(simt + rng.uniform(0., 100., 20)):
+                full.insert(t, f'INS{simt}-{i}')
+                streamed.insert(t, f'INS{simt}-{i}')
+        assert streamed.pop(simt) == full.pop(simt)
+        assert bool(streamed) == bool(full)
+        # At most three windows of commands are in memory
+        assert len(streamed.cmds) < 800
+    assert streamed.data() == full.data()
+
+
+def test_scenario_queue_steps():
+    """ Step through a large scenario, with merges. """
+    n = 100000
+    queue = ScenarioQueue()
+    queue.set(np.linspace(0., 3600., n), [f'CMD{i}' for i in range(n)])
+    ndue = 0
+    for simt in np.arange(0., 3600.05, 0.05):
+        if simt % 60 == 0:
+            for t in simt + np.linspace(1., 600., 100):
+                queue.insert(t, 'PCALLED')
+        ndue += len(queue.pop(simt))
+    assert len(queue) + ndue == n + 6100
@@ -0,0 +1,48 @@
+"""
+Tests compiled scenario files.
+
+Checks that scenarios loaded from their compiled (.scnc) version are
+identical to the parsed scenario, that compiled files are stored in the
+cache path, and that compiled files are refreshed when the scenario file
+changes.
+"""
+import os
+from bluesky import settings
+from bluesky.stack import simstack, scncache
+
+
+SCENARIO = """# Test scenario
+00:00:00.00>CRE KL204 B744 52 4 90 FL100 250
+00:00:00.00>KL204 ADDWPT SPY \\
+                   FL100 250 SPD 250
+00:00:01.50>HDG KL204 100 # comment
+00:01:00.00>HDG KL204 100
+0:10:00>ALT KL204 FL200
+this is not a command line
+"""
+
+
+def test_scncache(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, 'cache_path', str(tmp_path / 'cache'))
+    fname = tmp_path / 'test.scn'
+    fname.write_text(SCENARIO)
+    parsed = list(zip(*simstack.parsescn(fname)))
+    assert parsed[0] == (0.0, 0.0, 1.5, 60.0, 600.0)
+    assert parsed[1][1] == 'KL204 ADDWPT SPY FL100 250 SPD 250'
+
+    # First load compiles, second load reads the compiled file
+    scendata = simstack.loadscn(fname)
+    assert tuple(map(tuple, scendata)) == tuple(parsed)
+    assert scncache.cachename(fname).is_file()
+    assert scncache.cachename(fname).parent == tmp_path / 'cache' / 'scenario'
+    assert list(tmp_path.glob('*.scnc')) == []
+    assert simstack.loadscn(fname) == scendata
+    assert list(scncache.stream(fname)) == list(zip(*scendata))
+
+    # Touching the scenario keeps the compiled file valid, changing it doesn't
+    os.utime(fname, ns=(0, 0))
+    assert scncache.load(fname) == scendata
+    fname.write_text(SCENARIO.replace('FL200', 'FL300'))
+    assert scncache.load(fname) is None
+    assert simstack.loadscn(fname)[1][-1] == 'ALT KL204 FL300'
+    assert scncache.load(fname)[1][-1] == 'ALT KL204 FL300'
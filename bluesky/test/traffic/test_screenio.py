@@ -0,0 +1,57 @@
+"""
+Tests that a simulation node forgets the viewports of disconnected clients.
+
+A client registers with a node by subscribing to messages targeted at its
+id. The node receives the unsubscription of a client that disconnects, and
+removes its viewport and its route selection. Also tests that the broadcast
+aircraft data is skipped when no client subscribed to it.
+"""
+import zmq
+import bluesky
+from bluesky.network import context as ctx
+from bluesky.network.common import genid, GROUPID_CLIENT
+
+
+def test_client_removed(traffic_):
+    """ The viewport of a client is removed when the client disconnects. """
+    node, scr = bluesky.net, bluesky.scr
+    client_id = genid(GROUPID_CLIENT)
+    scr.viewports.set(client_id, 50.0, 55.0, 2.0, 6.0, 1.0)
+    scr.viewports.set(b'other', 40.0, 60.0, -10.0, 20.0, 0.5)
+    encoder = scr.viewports.encoder(b'other')
+    assert scr.viewports.encoder(client_id) is not encoder
+    scr.client_route[client_id] = 'KL204'
+
+    node.sock_send.bind('inproc://test-client-removed')
+    node.poller.register(node.sock_send, zmq.POLLIN)
+    client = zmq.Context.instance().socket(zmq.SUB)
+    try:
+        client.connect('inproc://test-client-removed')
+        client.setsockopt(zmq.SUBSCRIBE, client_id)
+        node.receive(1000)
+        assert client_id in node.subscribers
+        assert client_id in scr.viewports.clients
+
+        client.setsockopt(zmq.UNSUBSCRIBE, client_id)
+        node.receive(1000)
+        assert client_id not in scr.viewports.clients and client_id not in scr.client_route
+        assert list(scr.viewports.clients) == [b'other']
+        assert list(scr.viewports.encoders.values()) == [encoder]
+    finally:
+        client.close(0)
+        node.poller.unregister(node.sock_send)
+        node.sock_send.unbind('inproc://test-client-removed')
+        scr.viewports.remove(b'other')
+        scr.client_route.pop(client_id, None)
+
+
+def test_broadcast_unsubscribed(traffic_, monkeypatch):
+    """ The broadcast aircraft data isn't encoded when all clients only
+        subscribed to the data of their viewport. """
+    client_id = genid(GROUPID_CLIENT)
+    monkeypatch.setattr(ctx, 'sender_id', None)
+    monkeypatch.setattr(bluesky.net, 'subscribers', {client_id + b'ACDATA'})
+    assert bluesky.scr.send_aircraft_data() is None
+
+    bluesky.net.subscribers.add(b'*****ACDATA')
+    assert bluesky.scr.send_aircraft_data() is not None
@@ -0,0 +1,66 @@
+"""
+Tests batched dispatch of scenario commands.
+
+Checks that runs of CRE and DEL commands that are dispatched as one
+vectorised call give the same traffic as individual processing. Also
+checks that SAVEIC snapshots recreate the traffic.
+"""
+import numpy as np
+import bluesky
+from bluesky.stack import simstack
+from bluesky.stack.simstack import CommandBatch
+
+
+def scenario(n):
+    """ Typical scenario commands for n aircraft. """
+    rng = np.random.default_rng(8)
+    lat, lon = rng.uniform(50., 54., n), rng.uniform(2., 7., n)
+    cmds = [f'CRE KL{i},B744,{lat[i]:.4f},{lon[i]:.4f},{i % 360},FL{100 + i % 200},250'
+            for i in range(n)]
+    cmds += [f'ALT KL{i},FL{150 + i % 100}' for i in range(0, n, 2)]
+    cmds += [f'SPD KL{i},{200 + i % 100}' for i in range(0, n, 3)]
+    cmds += [f'HDG KL{i},{(2 * i) % 360}' for i in range(0, n, 5)]
+    cmds += [f'MOVE KL{i},52,4,FL100' for i in range(0, n, 7)]
+    # Duplicates and unknown aircraft are processed individually
+    cmds += ['CRE KL1,A320,52,4', 'DEL KL99999']
+    cmds += [f'DEL KL{i}' for i in range(0, n, 4)] + [f'DEL KL{i}' for i in range(0, n, 8)]
+    return cmds
+
+
+def run(cmds):
+    """ Process commands as a run of scenario commands, return traffic state. """
+    bluesky.traf.reset()
+    simstack.process([(cmd, None) for cmd in cmds])
+    traf = bluesky.traf
+    return (list(traf.id), list(traf.type), traf.lat.copy(), traf.lon.copy(),
+            traf.hdg.copy(), traf.alt.copy(), traf.cas.copy(),
+            traf.selalt.copy(), traf.ap.trk.copy(), traf.selspd.copy())
+
+
+def test_stack_batch_parity(traffic_, monkeypatch):
+    cmds = scenario(200)
+    batched = run(cmds)
+    monkeypatch.setattr(CommandBatch, 'batchcmds', dict())
+    individual = run(cmds)
+    assert batched[:2] == individual[:2]
+    assert len(batched[0]) == 200 - 50
+    for a, b in zip(batched[2:], individual[2:]):
+        np.testing.assert_allclose(a, b)
+
+
+def test_saveic_snapshot(traffic_):
+    """ The SAVEIC snapshot recreates traffic, autopilot state and routes. """
+    from bluesky.stack.recorder import snapshot
+    cmds = [cmd for cmd in scenario(50)[:-20] if not cmd.startswith('MOVE')]
+    ref = run(cmds + ['KL1 ADDWPT SPY', 'KL1 ADDWPT 52.5 4.5 FL250',
+                      'KL1 ADDWPT EHAM', 'KL1 VNAV ON', 'KL3 DEST EHAM',
+                      'KL3 LNAV OFF'])
+    route = bluesky.traf.ap.route[1]
+    state = run(snapshot())
+    # Autopilot targets are only updated in the next simulation step
+    assert state[:2] == ref[:2]
+    for a, b in zip(state[2:7], ref[2:7]):
+        np.testing.assert_allclose(a, b)
+    assert bluesky.traf.ap.route[1].wpname == route.wpname
+    assert bluesky.traf.swvnav[1] and not bluesky.traf.swlnav[3]
+    bluesky.traf.reset()
@@ -0,0 +1,65 @@
+"""
+Tests the in-process parameter sweep runner.
+"""
+import numpy as np
+import bluesky
+from bluesky import sweep
+
+
+def scenario(name, n):
+    """ Scenario with n aircraft on a head-on course, that ends after 300 s. """
+    cmds = ['CRELOG TESTLOG 10.0', 'TESTLOG ADD traf.id, traf.alt', 'TESTLOG ON']
+    for i in range(n):
+        cmds.append(f'CRE {name}{i},B744,52,{4 + 0.01 * i},{180 * (i % 2)},FL100,250')
+    return dict(name=name, scentime=[0.0] * len(cmds) + [300.0], scencmd=cmds + ['HOLD'])
+
+
+def ntraf():
+    """ Metric: number of aircraft at the end of a run. """
+    return bluesky.traf.ntraf
+
+
+def test_sweep(traffic_):
+    """ Each combination of scenario and parameter values is run once. """
+    scenarios = [scenario('SWA', 2), scenario('SWB', 4)]
+    with sweep.Sweep(workers=2) as pool:
+        metrics, logs = pool.run(scenarios, dict(simdt=[0.5, 1.0], ASAS=['OFF']),
+                                 metrics=dict(final=ntraf))
+        # Workers are reused for the next run
+        again, _ = pool.run(scenarios[:1], duration=60.0)
+
+    assert len(metrics) == len(logs) == 4
+    assert list(metrics.scenario) == ['SWA', 'SWA', 'SWB', 'SWB']
+    assert list(metrics.simdt) == [0.5, 1.0, 0.5, 1.0]
+    assert list(metrics.final) == [2, 2, 4, 4]
+    np.testing.assert_allclose(metrics.simt, 300.0, atol=1.0)
+    assert metrics.nsteps[0] > 1.9 * metrics.nsteps[1]
+
+    log = logs[2]['TESTLOG']
+    assert list(log.columns) == ['simt', 'id', 'alt']
+    assert set(log.id) == {f'SWB{i}' for i in range(4)}
+    assert len(log) == 4 * 30
+
+    assert again.simt[0] >= 60.0 and again.simt[0] < 61.0
+
+
+def draw():
+    """ Metric: a random number drawn at the end of a run. """
+    return np.random.rand()
+
+
+def test_sweep_seed(traffic_):
+    """ Runs are seeded by their index, independently of their worker. """
+    scenarios = [scenario('SWA', 2)]
+    with sweep.Sweep(workers=2) as pool:
+        first, _ = pool.run(scenarios, dict(simdt=[0.5, 1.0]), duration=10.0,
+                            metrics=dict(draw=draw))
+        second, _ = pool.run(scenarios, dict(simdt=[0.5, 1.0]), duration=10.0,
+                             metrics=dict(draw=draw))
+        other, _ = pool.run(scenarios, dict(simdt=[0.5, 1.0]), duration=10.0,
+                            metrics=dict(draw=draw), seed=2)
+
+    assert list(first.seed) == [0, 1] and list(other.seed) == [2, 3]
+    assert first.draw[0] != first.draw[1]
+    assert list(first.draw) == list(second.draw)
+    assert not set(first.draw) & set(other.draw)
@@ -7,8 +7,9 @@ GNU General Public License v3.
 Author <ahfarrell@sparkl.com> Andrew Farrell
 Tests traffic module
 """
-
-from bluesky.tools.aero import casormach
+import pytest
+import bluesky
+from bluesky.tools.aero import casormach, vdensity, ft, kts
 
 
 def test_traffic_create_missingarg_fail(traffic_):
@@ -147,3 +148,34 @@ def test_traffic_reset(traffic_):
 
 
 # test remaining traffic functions
+
+
+def test_traffic_environment_cache(traffic_):
+    """
+    Test that atmosphere and wind at the aircraft positions are
+    cached, and only recalculated when the aircraft moves beyond
+    the tolerance, or when the wind field changes.
+    """
+    traffic_.reset()
+    traffic_.wind.addpoint(52.0, 4.0, 270.0, 20.0)
+    traffic_.cre('ENV1', 'B744', 52.0, 4.0, 90, 10000 * ft, 250 * kts)
+    traffic_.update_environment()
+    assert traffic_.windeast[0] == pytest.approx(20.0)
+    assert traffic_.rho[0] == pytest.approx(vdensity(10000 * ft))
+
+    # A displacement within tolerance keeps the cached values
+    traffic_.alt[0] += 0.5 * bluesky.settings.env_tolalt
+    rho = traffic_.rho[0]
+    traffic_.update_environment()
+    assert traffic_.rho[0] == rho
+
+    # A displacement beyond tolerance triggers a recalculation
+    traffic_.alt[0] += 2.0 * bluesky.settings.env_tolalt
+    traffic_.update_environment()
+    assert traffic_.rho[0] == pytest.approx(vdensity(traffic_.alt[0]))
+
+    # A change of the wind field triggers a recalculation
+    traffic_.wind.clear()
+    traffic_.update_environment()
+    assert traffic_.windeast[0] == 0.0
+    traffic_.reset()
@@ -0,0 +1,318 @@
+"""
+Tests wind field interpolation.
+
+Checks that the grid and KD-tree interpolation paths of Windfield.getdata
+give the same results as plain trilinear interpolation (as done with
+scipy's RegularGridInterpolator), and inverse-distance weighting over all
+(or the k nearest) definition points. Also checks the cache of decoded
+wind grids.
+"""
+import os
+import datetime
+import threading
+import pytest
+import numpy as np
+from scipy.interpolate import RegularGridInterpolator
+from bluesky import settings
+from bluesky.tools.aero import ft
+from bluesky.tools.cachefile import ArrayCache
+from bluesky.traffic.windfield import Windfield, unitvec
+
+
+def idw_reference(wf, lat, lon, alt=None, knear=None):
+    """
+    Brute-force inverse-distance weighting over all definition
+    points, or over the knear nearest points when knear is given.
+    """
+    lat, lon = lat[:, np.newaxis], lon[:, np.newaxis]
+    dy = lat - wf.lat
+    dx = np.cos(np.radians(0.5 * (lat + wf.lat))) * (lon - wf.lon)
+    invd2 = 1. / (1e-20 + dx * dx + dy * dy)
+    if knear is not None:
+        chord = np.linalg.norm(unitvec(lat.ravel(), lon.ravel())[:, np.newaxis, :] -
+                               unitvec(wf.lat, wf.lon)[np.newaxis, :, :], axis=2)
+        far = np.argsort(chord, axis=1)[:, knear:]
+        np.put_along_axis(invd2, far, 0.0, axis=1)
+    horfact = invd2 / invd2.sum(axis=1, keepdims=True)
+    if alt is None:
+        return (wf.vnorth[0] * horfact).sum(axis=1), (wf.veast[0] * horfact).sum(axis=1)
+    idxalt = np.maximum(0., np.minimum(wf.altaxis[-1] - 1e-20, alt) / wf.altstep)
+    ialt = np.floor(idxalt).astype(int)
+    falt = (idxalt - ialt)[:, np.newaxis]
+    vn = (1. - falt) * wf.vnorth[ialt] + falt * wf.vnorth[ialt + 1]
+    ve = (1. - falt) * wf.veast[ialt] + falt * wf.veast[ialt + 1]
+    return (vn * horfact).sum(axis=1), (ve * horfact).sum(axis=1)
+
+
+def scattered_field(nvec, rng, profiles=False):
+    """ Create a wind field with randomly placed definition points. """
+    wf = Windfield()
+    for lat, lon in zip(rng.uniform(50., 54., nvec), rng.uniform(2., 7., nvec)):
+        if profiles:
+            wf.addpoint(lat, lon, rng.uniform(0., 360., 3), rng.uniform(5., 50., 3),
+                        np.array([0., 10000., 30000.]) * ft)
+        else:
+            wf.addpoint(lat, lon, rng.uniform(0., 360.), rng.uniform(5., 50.))
+    return wf
+
+
+def test_windfield_idw_parity(monkeypatch):
+    """
+    Small fields interpolate over all definition points,
+    in both 2D and 3D fields.
+    """
+    monkeypatch.setattr(settings, 'wind_knear', 100)
+    rng = np.random.default_rng(1)
+    lat, lon = rng.uniform(50., 54., 200), rng.uniform(2., 7., 200)
+    alt = rng.uniform(0., 12000., 200)
+
+    wf = scattered_field(40, rng)
+    assert wf.winddim == 2
+    np.testing.assert_allclose(wf.getdata(lat, lon, alt), idw_reference(wf, lat, lon))
+
+    wf = scattered_field(40, rng, profiles=True)
+    assert wf.winddim == 3
+    np.testing.assert_allclose(wf.getdata(lat, lon, alt),
+                               idw_reference(wf, lat, lon, alt))
+
+    # Scalar positions return floats
+    vn, ve = wf.getdata(52., 4., 1000.)
+    assert isinstance(vn, float) and isinstance(ve, float)
+
+
+def test_windfield_knear_parity(monkeypatch):
+    """
+    Large fields interpolate over the k nearest definition points.
+    """
+    monkeypatch.setattr(settings, 'wind_knear', 8)
+    rng = np.random.default_rng(2)
+    lat, lon = rng.uniform(50., 54., 200), rng.uniform(2., 7., 200)
+    alt = rng.uniform(0., 12000., 200)
+
+    wf = scattered_field(60, rng, profiles=True)
+    np.testing.assert_allclose(wf.getdata(lat, lon, alt),
+                               idw_reference(wf, lat, lon, alt, knear=8))
+
+
+def test_windfield_grid_parity():
+    """
+    Regular grids are interpolated trilinearly, with zero wind
+    outside of the grid.
+    """
+    rng = np.random.default_rng(3)
+    lats, lons = np.arange(50., 55., 0.25), np.arange(0., 8., 0.5)
+    windalt = np.array([1000., 3000., 6000., 9000., 12000.])
+    vnorth = rng.normal(0., 20., (len(windalt), len(lats) * len(lons)))
+    veast = rng.normal(0., 20., (len(windalt), len(lats) * len(lons)))
+
+    wf = Windfield()
+    wf.addpointvne(lats.repeat(len(lons)), np.tile(lons, len(lats)), vnorth, veast, windalt)
+    assert wf.grid is not None
+
+    lat, lon = rng.uniform(49., 56., 1000), rng.uniform(-1., 9., 1000)
+    alt = rng.uniform(-100., 13000., 1000)
+
+    # Reference: values extended to zero altitude, then trilinear interpolation
+    altaxis = np.concatenate(([0.], windalt))
+    shape = (len(altaxis), len(lats), len(lons))
+    vnref = RegularGridInterpolator((altaxis, lats, lons),
+                                    np.vstack((vnorth[:1], vnorth)).reshape(shape),
+                                    bounds_error=False, fill_value=0.)
+    veref = RegularGridInterpolator((altaxis, lats, lons),
+                                    np.vstack((veast[:1], veast)).reshape(shape),
+                                    bounds_error=False, fill_value=0.)
+    pos = np.column_stack((alt, lat, lon))
+    np.testing.assert_allclose(wf.getdata(lat, lon, alt), (vnref(pos), veref(pos)), atol=1e-9)
+
+
+def test_windfield_large():
+    """
+    Interpolation for many aircraft in large scattered and gridded fields.
+    """
+    rng = np.random.default_rng(4)
+    npos, nvec = 2000, 20000
+    lat, lon = rng.uniform(40., 60., npos), rng.uniform(-10., 20., npos)
+    alt = rng.uniform(0., 12000., npos)
+
+    wf = Windfield()
+    wf.addpointvne(rng.uniform(40., 60., nvec), rng.uniform(-10., 20., nvec),
+                   rng.normal(0., 10., (1, nvec)), rng.normal(0., 10., (1, nvec)))
+    vn, ve = wf.getdata(lat, lon, alt)
+    assert np.all(np.isfinite(vn)) and np.all(np.isfinite(ve))
+
+    lats, lons = np.linspace(40., 60., 100), np.linspace(-10., 20., 200)
+    windalt = np.linspace(300., 12000., 20)
+    wf = Windfield()
+    wf.addpointvne(lats.repeat(len(lons)), np.tile(lons, len(lats)),
+                   rng.normal(0., 10., (len(windalt), nvec)),
+                   rng.normal(0., 10., (len(windalt), nvec)), windalt)
+    assert wf.grid is not None
+    vn, ve = wf.getdata(lat, lon, alt)
+    assert np.all(np.isfinite(vn)) and np.all(np.isfinite(ve))
+
+
+def settime(wf, t):
+    """ Set the time of a wind field, and select its slices again when
+        they are loaded in the background. """
+    wf.settime(t)
+    for s in wf.slices:
+        thread = s.thread
+        if thread is not None:
+            thread.join()
+    wf.settime(t)
+
+
+def test_windfield_time_slices(monkeypatch):
+    """
+    Time-varying fields interpolate between two lazily loaded slices,
+    and unload slices that are no longer needed.
+    """
+    monkeypatch.setattr(settings, 'wind_dt', 0.0)
+    lats, lons = np.array([50., 51.]), np.array([3., 4.])
+    windalt = np.array([1000., 10000.])
+    nloads = []
+
+    def loader(hour):
+        def load():
+            nloads.append(hour)
+            vnorth = np.full((len(windalt), 4), float(hour))
+            return lats.repeat(2), np.tile(lons, 2), vnorth, -vnorth, windalt
+        return load
+
+    t0 = datetime.datetime(2024, 1, 1)
+    wf = Windfield()
+    for hour in range(0, 27, 3):
+        wf.addslice(t0 + datetime.timedelta(hours=hour), loader(hour))
+    assert wf.winddim == 3 and not nloads
+
+    lat, lon, alt = np.array([50.5]), np.array([3.5]), np.array([5000.])
+    settime(wf, t0 + datetime.timedelta(hours=4))
+    vn, ve = wf.getdata(lat, lon, alt)
+    assert vn[0] == pytest.approx(4.) and ve[0] == pytest.approx(-4.)
+    # The next slice is loaded in the background
+    assert nloads == [3, 6, 9]
+    assert wf.slices[3].field is None and wf.slices[3].data is not None
+
+    # Step through a day: each slice is loaded once, and at most
+    # three slices are loaded or prefetched at any time
+    nloads.clear()
+    for minutes in range(0, 24 * 60, 10):
+        settime(wf, t0 + datetime.timedelta(minutes=minutes))
+        vn, _ = wf.getdata(lat, lon, alt)
+        assert vn[0] == pytest.approx(minutes / 60.)
+        assert sum(s.field is not None or s.data is not None for s in wf.slices) <= 3
+    # The slice of 03:00 was kept, the slices after it were unloaded
+    assert nloads == [hour for hour in range(0, 27, 3) if hour != 3]
+
+
+def test_windfield_slice_failure(monkeypatch):
+    """
+    Slices that can't be loaded are replaced by the neighbouring
+    slice, or by zero wind, without failing the interpolation.
+    """
+    monkeypatch.setattr(settings, 'wind_dt', 0.0)
+    lats, lons = np.array([50., 51.]), np.array([3., 4.])
+    windalt = np.array([1000., 10000.])
+    nloads = []
+
+    def loader(hour):
+        def load():
+            nloads.append(hour)
+            if hour >= 6:
+                raise RuntimeError('Download failed')
+            vnorth = np.full((len(windalt), 4), 10. + hour)
+            return lats.repeat(2), np.tile(lons, 2), vnorth, vnorth, windalt
+        return load
+
+    t0 = datetime.datetime(2024, 1, 1)
+    wf = Windfield()
+    for hour in range(0, 12, 3):
+        wf.addslice(t0 + datetime.timedelta(hours=hour), loader(hour))
+
+    lat, lon, alt = np.array([50.5]), np.array([3.5]), np.array([5000.])
+    settime(wf, t0 + datetime.timedelta(hours=4))
+    vn, _ = wf.getdata(lat, lon, alt)
+    # The slice of 06:00 fails: the slice of 03:00 is used
+    assert vn[0] == pytest.approx(13.) and wf.slices[2].failed
+    settime(wf, t0 + datetime.timedelta(hours=7))
+    vn, _ = wf.getdata(lat, lon, alt)
+    assert vn[0] == 0.0 and wf.islice is None
+    # Failed slices are not loaded again
+    settime(wf, t0 + datetime.timedelta(hours=8))
+    assert nloads.count(6) == 1 and nloads.count(9) == 1
+
+
+def test_windfield_slice_loading(monkeypatch):
+    """
+    Setting the time doesn't wait for slices that are still
+    loading: the loaded slices are used until they are available.
+    """
+    monkeypatch.setattr(settings, 'wind_dt', 0.0)
+    lats, lons = np.array([50., 51.]), np.array([3., 4.])
+    windalt = np.array([1000., 10000.])
+    release = threading.Event()
+
+    def loader(hour):
+        def load():
+            if hour == 6:
+                release.wait(10.0)
+            vnorth = np.full((len(windalt), 4), float(hour))
+            return lats.repeat(2), np.tile(lons, 2), vnorth, vnorth, windalt
+        return load
+
+    t0 = datetime.datetime(2024, 1, 1)
+    wf = Windfield()
+    for hour in range(0, 9, 3):
+        wf.addslice(t0 + datetime.timedelta(hours=hour), loader(hour))
+
+    lat, lon, alt = np.array([50.5]), np.array([3.5]), np.array([5000.])
+    wf.settime(t0 + datetime.timedelta(hours=1))
+    for s in wf.slices[:2]:
+        if s.thread is not None:
+            s.thread.join()
+    wf.settime(t0 + datetime.timedelta(hours=1))
+    assert wf.getdata(lat, lon, alt)[0][0] == pytest.approx(1.)
+
+    # The slice of 06:00 is still loading: the slice of 03:00 is used
+    wf.settime(t0 + datetime.timedelta(hours=4))
+    assert wf.slices[2].loading and wf.getdata(lat, lon, alt)[0][0] == pytest.approx(3.)
+    release.set()
+    settime(wf, t0 + datetime.timedelta(hours=4))
+    assert wf.getdata(lat, lon, alt)[0][0] == pytest.approx(4.)
+
+
+def test_wind_cache(tmp_path):
+    """
+    Decoded wind grids are stored in, and evicted from, the
+    size-bounded wind cache in least-recently-used order.
+    """
+    rng = np.random.default_rng(5)
+    cache = ArrayCache('wind', 0)
+    cache.path = tmp_path
+    grids = [dict(lat=np.arange(50., 54.), lon=np.arange(2., 7.), windalt=np.array([1000., 9000.]),
+                  vnorth=rng.normal(0., 20., (2, 20)), veast=rng.normal(0., 20., (2, 20)))
+             for _ in range(3)]
+    keys = [('gfs', '2024010100', pred, 50., 2., 53., 6.) for pred in (0, 3, 6)]
+
+    # Nothing is kept in a cache of size zero
+    cache.save(keys[0], **grids[0])
+    assert cache.load(keys[0]) is None and not any(tmp_path.iterdir())
+
+    cache.maxsize = 1e9
+    for key, grid in zip(keys, grids):
+        cache.save(key, **grid)
+    data = cache.load(keys[1])
+    for name, value in grids[1].items():
+        np.testing.assert_array_equal(data[name], value)
+    assert cache.load(('gfs', '2024010100', 0, 50., 2., 53., 7.)) is None
+
+    # Use the oldest grid, then shrink the cache by one file:
+    # the least recently used grid is removed
+    for i, key in enumerate(keys):
+        os.utime(cache.fname(key), (i, i))
+    cache.load(keys[0])
+    cache.maxsize = sum(cache.fname(key).stat().st_size for key in keys) - \
+        cache.fname(keys[1]).stat().st_size
+    cache.evict()
+    assert cache.load(keys[1]) is None
+    assert cache.load(keys[0]) is not None and cache.load(keys[2]) is not None
@@ -162,32 +162,34 @@ def vvsound(h):
 
 
 # ---------Speed conversions---h in [m]------------------
-def vtas2mach(tas, h):
+def vtas2mach(tas, h, atmos=None):
     """ True airspeed (tas) to mach number conversion for numpy arrays.
 
         Arguments:
         - tas: True airspeed [m/s]
         - h: Altitude [m]
+        - atmos: Optional precomputed (p, rho, T) at h
 
         Returns:
         - M: Mach number [-]
     """
-    a = vvsound(h)
+    a = vvsound(h) if atmos is None else np.sqrt(gamma * R * atmos[2])
     mach = tas / a
     return mach
 
 
-def vmach2tas(mach, h):
+def vmach2tas(mach, h, atmos=None):
     """ Mach number to True airspeed (tas) conversion for numpy arrays.
 
         Arguments:
         - mach: Mach number [-]
         - h: Altitude [m]
+        - atmos: Optional precomputed (p, rho, T) at h
 
         Returns:
         - tas: True airspeed [m/s]
     """
-    a = vvsound(h)
+    a = vvsound(h) if atmos is None else np.sqrt(gamma * R * atmos[2])
     tas = mach * a
     return tas
 
@@ -222,17 +224,18 @@ def vtas2eas(tas, h):
     return eas
 
 
-def vcas2tas(cas, h):
+def vcas2tas(cas, h, atmos=None):
     """ Calibrated to true airspeed conversion for numpy arrays.
 
         Arguments:
         - cas: Calibrated airspeed [m/s]
         - h: Altitude [m]
+        - atmos: Optional precomputed (p, rho, T) at h
 
         Returns:
         - tas: True airspeed [m/s]
     """
-    p, rho, _ = vatmos(h)
+    p, rho, _ = vatmos(h) if atmos is None else atmos
     qdyn = p0 * ((1.0 + rho0 * cas * cas / (7.0 * p0)) ** 3.5 - 1.0)
     tas = np.sqrt(7.0 * p / rho * ((1.0 + qdyn / p) ** (2.0 / 7.0) - 1.0))
 
@@ -241,17 +244,18 @@ def vcas2tas(cas, h):
     return tas
 
 
-def vtas2cas(tas, h):
+def vtas2cas(tas, h, atmos=None):
     """ True to calibrated airspeed conversion for numpy arrays.
 
         Arguments:
         - tas: True airspeed [m/s]
         - h: Altitude [m]
+        - atmos: Optional precomputed (p, rho, T) at h
 
         Returns:
         cas: Calibrated airspeed [m/s]
     """
-    p, rho, _ = vatmos(h)
+    p, rho, _ = vatmos(h) if atmos is None else atmos
     qdyn = p*((1.+rho*tas*tas/(7.*p))**3.5-1.)
     cas = np.sqrt(7.*p0/rho0*((qdyn/p0+1.)**(2./7.)-1.))
 
@@ -309,19 +313,20 @@ def vcasormach(spd, h):
     return tas, cas, mach
 
 
-def vcasormach2tas(spd, h):
+def vcasormach2tas(spd, h, atmos=None):
     """ Interpret input speed as either CAS or a Mach number, and return TAS.
 
         Arguments:
         - spd: Airspeed. Interpreted as Mach number [-] when its value is below the
                CAS/Mach threshold. Otherwise interpreted as CAS [m/s].
         - h: Altitude [m]
+        - atmos: Optional precomputed (p, rho, T) at h
 
         Returns:
         - tas: True airspeed [m/s]
     """
     ismach = np.logical_and(spd > 0.1, spd < casmach_thr)
-    return np.where(ismach, vmach2tas(spd, h), vcas2tas(spd, h))
+    return np.where(ismach, vmach2tas(spd, h, atmos), vcas2tas(spd, h, atmos))
 
 
 def crossoveralt(cas, mach):
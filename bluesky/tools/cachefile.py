@@ -1,4 +1,8 @@
+import os
 import pickle
+import hashlib
+import zipfile
+import numpy as np
 import bluesky as bs
 
 ## Default settings
@@ -57,3 +61,66 @@ class CacheFile():
     def __exit__(self, exc_type, exc_val, exc_tb):
         if self.file:
             self.file.close()
+
+
+class ArrayCache():
+    ''' Directory cache of compressed numpy array files (.npz), with a
+        maximum total size. When the size is exceeded, the least recently
+        used files are removed.
+
+        Arguments:
+        - subdir: Subdirectory of the cache path to store the files in
+        - maxsize: Maximum total size of the cache files [bytes]
+    '''
+    def __init__(self, subdir, maxsize):
+        self.path = bs.resource(bs.settings.cache_path).joinpath(subdir)
+        self.maxsize = maxsize
+
+    def fname(self, key):
+        ''' Return the filename of the cache file for a (tuple) key. '''
+        return self.path.joinpath(hashlib.sha1(repr(key).encode()).hexdigest() + '.npz')
+
+    def load(self, key):
+        ''' Load the dictionary of arrays stored for key.
+            Returns None if the key is not in the cache. '''
+        fname = self.fname(key)
+        if not fname.is_file():
+            return None
+        try:
+            with np.load(fname) as data:
+                if str(data['cachekey']) != repr(key):
+                    return None
+                arrays = {name: data[name] for name in data.files if name != 'cachekey'}
+        except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+            return None
+
+        # Mark as most recently used
+        fname.touch()
+        return arrays
+
+    def save(self, key, **arrays):
+        ''' Store arrays for key, and remove old files when the cache
+            exceeds its maximum size. '''
+        self.path.mkdir(parents=True, exist_ok=True)
+        fname = self.fname(key)
+        # Write to a temporary file first, so that concurrent readers
+        # never see partially written files
+        tmpname = fname.with_name(f'{fname.stem}.{os.getpid()}.tmp')
+        with open(tmpname, 'wb') as f:
+            np.savez_compressed(f, cachekey=repr(key), **arrays)
+        os.replace(tmpname, fname)
+        self.evict()
+
+    def evict(self):
+        ''' Remove least recently used files until the total size of the
+            cache is below its maximum size. '''
+        files = [(f.stat(), f) for f in self.path.glob('*.npz')]
+        total = sum(stat.st_size for stat, _ in files)
+        for stat, f in sorted(files, key=lambda sf: sf[0].st_mtime):
+            if total <= self.maxsize:
+                break
+            try:
+                f.unlink()
+            except FileNotFoundError:
+                pass
+            total -= stat.st_size
@@ -67,6 +67,13 @@ def reset():
         log.reset()
 
 
+def flush():
+    """ Write buffered data of all open logs to file. """
+    for log in allloggers.values():
+        if log.file:
+            log.file.flush()
+
+
 def makeLogfileName(logname, prefix: str = ''):
     timestamp = datetime.now().strftime('%Y%m%d_%H-%M-%S')
     if prefix == '' or prefix.lower() == stack.get_scenname().lower():
@@ -409,8 +409,8 @@ def magdec(latd, lond):
     longitudes in radians, with latitude ranging from 0 to pi and longitude
     ranging from 0 to 2pi.
     In:
-         latd, lond  [deg]  Position at which the magnetic declination is
-                            evaluated (floats)
+         latd, lond  [deg]  Position(s) at which the magnetic declination is
+                            evaluated (floats or arrays)
     Out:
          d_hdg       [deg]  Magnetic declination, the angle of difference
                             between true North and magnetic North. For instance,
@@ -432,6 +432,7 @@ def magdec(latd, lond):
     Difference in methods has been inspected: it is way less than the inaccuracy
     of the actual data. Axes were regularly spaced at one degree. The direct
     manual linear interpolation also 6 x times faster.
+    Vectorised to evaluate arrays of positions in one call.
     """
     global decl_read
     if not decl_read:
@@ -439,20 +440,26 @@ def magdec(latd, lond):
         decl_read = True
 
     # Use fact that whole degrees are used as ticks on both lat & lon axis
-    i_lat = min(max(0,int(90.-latd)),180)
-    f_lat = (90.-latd) - int(90.-latd)
-    i_lon = min(max(0,int(lond + 180)),360)
-    f_lon = lond+180. - int(lond+180)
+    # (truncation towards zero, as with int())
+    ylat = 90. - np.asarray(latd, dtype=float)
+    xlon = np.asarray(lond, dtype=float) + 180.
+    f_lat = ylat - np.trunc(ylat)
+    f_lon = xlon - np.trunc(xlon)
+    i_lat = np.clip(np.trunc(ylat), 0, 180).astype(int)
+    i_lon = np.clip(np.trunc(xlon), 0, 360).astype(int)
+    i_lat1 = np.minimum(180, i_lat + 1)
+    i_lon1 = np.minimum(360, i_lon + 1)
 
     # 2D linear interpolation
-    declon0 = decl_lat_lon[i_lat,i_lon]*(1.-f_lat) + \
-               f_lat*decl_lat_lon[min(180,i_lat+1),i_lon]
-    declon1 = decl_lat_lon[i_lat,i_lon+1]*(1.-f_lat) + \
-               f_lat*decl_lat_lon[min(180,i_lat+1),min(i_lon+1,360)]
+    declon0 = decl_lat_lon[i_lat, i_lon] * (1. - f_lat) + \
+              f_lat * decl_lat_lon[i_lat1, i_lon]
+    declon1 = decl_lat_lon[i_lat, i_lon1] * (1. - f_lat) + \
+              f_lat * decl_lat_lon[i_lat1, i_lon1]
 
-    d_hdg = declon0*(1.-f_lon) + f_lon*declon1
+    d_hdg = declon0 * (1. - f_lon) + f_lon * declon1
 
-    return d_hdg
+    # Return a float for scalar positions
+    return d_hdg if d_hdg.ndim else float(d_hdg)
 
 def initdecl_data():
     """
@@ -494,10 +501,8 @@ def initdecl_data():
     # lat : 89 ... -90
     # Lon: -180 ... 179
     global decl_read, decl_lat_lon
-    dec_table = np.genfromtxt(bs.resource(bs.settings.navdata_path) / 'geo_declination_data.csv',
-                              comments='#',delimiter=",")
-
-    decl = dec_table[:,4]
+    decl = np.loadtxt(bs.resource(bs.settings.navdata_path) / 'geo_declination_data.csv',
+                      comments='#', delimiter=",", usecols=4, dtype=np.float32)
 
     #          <----lon ---->
     #   lat1    ..  ..   ..  ..
@@ -511,7 +516,7 @@ def initdecl_data():
     # Add lon = +180 column
     decl_lat_lon = np.hstack((decl_lat_lon, decl_lat_lon[:,0:1]))
 
-    # Result is table 181 rows x 361 columns table for
+    # Result is table 181 rows x 361 columns table (float32) for
     # lat = 90 ... -90 (rows)
     # lon = -180 ... 180 (columns)
     decl_read = True
@@ -0,0 +1,127 @@
+''' Chunked ring buffer for growing tables of data, such as aircraft trails.
+
+    Rows are stored in fixed-size chunks of numpy arrays per column, so
+    extending the buffer never copies the existing data. The buffer can be
+    bounded to a maximum number of rows, and to a maximum age of the rows
+    when one of the columns contains (increasing) time. Rows are numbered
+    with a global index that keeps increasing when old rows are removed,
+    so users can keep track of the rows they have already processed.
+'''
+import numpy as np
+
+
+class RingBuffer:
+    ''' Chunked ring buffer with named columns.
+
+        Arguments:
+        - maxlen: Maximum number of rows (0 or None for no limit)
+        - maxage: Maximum age of rows, compared to the newest row
+          (0 or None for no limit)
+        - timekey: Name of the column with the time of each row
+        - chunksize: Number of rows per chunk
+    '''
+    def __init__(self, maxlen=None, maxage=None, timekey=None, chunksize=4096):
+        self.maxlen = maxlen
+        self.maxage = maxage
+        self.timekey = timekey
+        self.chunksize = chunksize
+        # List of chunks per column
+        self.chunks = dict()
+        # Global index of the first row in the first chunk
+        self.offset = 0
+        # Global index of the first row, and of the row after the last row
+        self.start = 0
+        self.end = 0
+
+    def __len__(self):
+        return self.end - self.start
+
+    def clear(self):
+        ''' Remove all rows. Row indices keep increasing. '''
+        self.chunks = dict()
+        self.offset = self.start = self.end
+
+    def extend(self, data):
+        ''' Add rows, given as a dict with the values of each column. '''
+        columns = {name: np.asarray(values) for name, values in data.items()}
+        nrows = min((len(values) for values in columns.values()), default=0)
+        if nrows == 0:
+            return
+        if set(columns) != set(self.chunks):
+            # The set of columns can only change when the buffer is empty
+            if self.start != self.end:
+                raise KeyError(f'RingBuffer: expected columns {", ".join(self.chunks)}')
+            self.chunks = {name: [] for name in columns}
+            self.offset = self.start
+        for name, values in columns.items():
+            chunks = self.chunks[name]
+            pos = self.end - self.offset
+            done = 0
+            while done < nrows:
+                ichunk, ipos = divmod(pos + done, self.chunksize)
+                if ichunk == len(chunks):
+                    chunks.append(np.empty((self.chunksize,) + values.shape[1:], dtype=values.dtype))
+                count = min(nrows - done, self.chunksize - ipos)
+                chunks[ichunk][ipos:ipos + count] = values[done:done + count]
+                done += count
+        self.end += nrows
+        self.trim()
+
+    def trim(self):
+        ''' Remove rows beyond the maximum length and age. '''
+        start = self.start
+        if self.maxlen:
+            start = max(start, self.end - self.maxlen)
+        if self.maxage and self.timekey in self.chunks and self.end > start:
+            tnewest = self.row(self.end - 1)[self.timekey]
+            start = max(start, self.search(self.timekey, tnewest - self.maxage, start))
+        self.start = start
+
+        # Remove chunks that only contain removed rows
+        nremove = (self.start - self.offset) // self.chunksize
+        if nremove:
+            for chunks in self.chunks.values():
+                del chunks[:nremove]
+            self.offset += nremove * self.chunksize
+
+    def row(self, index):
+        ''' Return the row with global index as a dict. '''
+        ichunk, ipos = divmod(index - self.offset, self.chunksize)
+        return {name: chunks[ichunk][ipos] for name, chunks in self.chunks.items()}
+
+    def search(self, name, value, start=None):
+        ''' Return the global index of the first row from start with a value
+            of column name that isn't smaller than value. The column should
+            be sorted. '''
+        index = self.start if start is None else start
+        chunks = self.chunks[name]
+        while index < self.end:
+            ichunk, ipos = divmod(index - self.offset, self.chunksize)
+            last = min(self.chunksize, self.end - self.offset - ichunk * self.chunksize)
+            if chunks[ichunk][last - 1] >= value:
+                return index + int(np.searchsorted(chunks[ichunk][ipos:last], value))
+            index += last - ipos
+        return self.end
+
+    def since(self, index=None):
+        ''' Return the rows from global index up to the last row as a dict of
+            column arrays. Only the requested rows are copied. '''
+        index = self.start if index is None else max(index, self.start)
+        return {name: self._gather(chunks, index) for name, chunks in self.chunks.items()}
+
+    def column(self, name):
+        ''' Return all rows of a column as one array. Only this column is copied. '''
+        chunks = self.chunks.get(name)
+        return np.empty(0) if chunks is None else self._gather(chunks, self.start)
+
+    def _gather(self, chunks, index):
+        ''' Return the rows of one column from global index up to the last row. '''
+        parts = []
+        pos = index - self.offset
+        while pos < self.end - self.offset:
+            ichunk, ipos = divmod(pos, self.chunksize)
+            last = min(self.chunksize, self.end - self.offset - ichunk * self.chunksize)
+            parts.append(chunks[ichunk][ipos:last])
+            pos += last - ipos
+        return np.concatenate(parts) if parts else \
+            chunks[0][:0].copy() if chunks else np.empty(0)
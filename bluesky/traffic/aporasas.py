@@ -25,7 +25,7 @@ class APorASAS(TrafficArrays):
         #--------- Input to Autopilot settings to follow: destination or ASAS ----------
         # Convert the ASAS commanded speed from ground speed to TAS
         if bs.traf.wind.winddim > 0:
-            vwn, vwe     = bs.traf.wind.getdata(bs.traf.lat, bs.traf.lon, bs.traf.alt)
+            vwn, vwe     = bs.traf.windnorth, bs.traf.windeast
             asastasnorth = bs.traf.cr.tas * np.cos(np.radians(bs.traf.cr.trk)) - vwn
             asastaseast  = bs.traf.cr.tas * np.sin(np.radians(bs.traf.cr.trk)) - vwe
             asastas      = np.sqrt(asastasnorth**2 + asastaseast**2)
@@ -49,7 +49,7 @@ class APorASAS(TrafficArrays):
         if bs.traf.wind.winddim > 0:
 
             # Calculate wind correction
-            vwn, vwe = bs.traf.wind.getdata(bs.traf.lat, bs.traf.lon, bs.traf.alt)
+            vwn, vwe = bs.traf.windnorth, bs.traf.windeast
             Vw       = np.sqrt(vwn * vwn + vwe * vwe)
             winddir  = np.arctan2(vwe, vwn)
             drift    = np.radians(self.trk) - winddir  # [rad]
@@ -1,4 +1,5 @@
 ''' This module provides the Conflict Detection base class. '''
+from types import SimpleNamespace
 import numpy as np
 
 import bluesky as bs
@@ -10,6 +11,10 @@ from bluesky.stack import command
 bs.settings.set_variable_defaults(asas_pzr=5.0, asas_pzh=1000.0,
                                   asas_dtlookahead=300.0)
 
+# Traffic variables and detection parameters of ghost aircraft
+GHOSTVARS = ('lat', 'lon', 'trk', 'gs', 'alt', 'vs')
+GHOSTPARAMS = ('rpz', 'hpz', 'dtlookahead')
+
 
 class ConflictDetection(Entity, replaceable=True):
     ''' Base class for Conflict Detection implementations. '''
@@ -44,6 +49,11 @@ class ConflictDetection(Entity, replaceable=True):
         self.confpairs_all = list()
         self.lospairs_all = list()
 
+        # Aircraft that are simulated elsewhere (by the other nodes of a
+        # partitioned simulation), but are intruders for conflict detection:
+        # a dict with id, GHOSTVARS and GHOSTPARAMS, or None
+        self.ghosts = None
+
         # Per-aircraft conflict data
         with self.settrafarrays():
             self.inconf = np.array([], dtype=bool)  # In-conflict flag
@@ -83,6 +93,7 @@ class ConflictDetection(Entity, replaceable=True):
         self.clearconfdb()
         self.confpairs_all.clear()
         self.lospairs_all.clear()
+        self.ghosts = None
         self.rpz_def = bs.settings.asas_pzr * nm
         self.hpz_def = bs.settings.asas_pzh * ft
         self.dtlookahead_def = bs.settings.asas_dtlookahead
@@ -208,22 +219,57 @@ class ConflictDetection(Entity, replaceable=True):
 
     def update(self, ownship, intruder):
         ''' Perform an update step of the Conflict Detection implementation. '''
+        if self.ghosts:
+            results, confpairs, lospairs = self.detectghosts(ownship)
+        else:
+            results = self.detect(ownship, intruder, self.rpz, self.hpz, self.dtlookahead)
+            confpairs, lospairs = results[:2]
         self.confpairs, self.lospairs, self.inconf, self.tcpamax, self.qdr, \
-            self.dist, self.dcpa, self.tcpa, self.tLOS = \
-                self.detect(ownship, intruder, self.rpz, self.hpz, self.dtlookahead)
+            self.dist, self.dcpa, self.tcpa, self.tLOS = results
 
         # confpairs has conflicts observed from both sides (a, b) and (b, a)
         # confpairs_unique keeps only one of these
-        confpairs_unique = {frozenset(pair) for pair in self.confpairs}
-        lospairs_unique = {frozenset(pair) for pair in self.lospairs}
+        confpairs_unique = {frozenset(pair) for pair in confpairs}
+        lospairs_unique = {frozenset(pair) for pair in lospairs}
 
-        self.confpairs_all.extend(confpairs_unique - self.confpairs_unique)
-        self.lospairs_all.extend(lospairs_unique - self.lospairs_unique)
+        newconf = confpairs_unique - self.confpairs_unique
+        newlos = lospairs_unique - self.lospairs_unique
+        if self.ghosts:
+            # A conflict with a ghost is also detected by the node that
+            # simulates the ghost: only the node of the lowest id counts it
+            ghostids = set(self.ghosts['id'])
+            newconf = {pair for pair in newconf if min(pair) not in ghostids}
+            newlos = {pair for pair in newlos if min(pair) not in ghostids}
+        self.confpairs_all.extend(newconf)
+        self.lospairs_all.extend(newlos)
 
         # Update confpairs_unique and lospairs_unique
         self.confpairs_unique = confpairs_unique
         self.lospairs_unique = lospairs_unique
 
+    def detectghosts(self, ownship):
+        ''' Conflict detection with the ghost aircraft as additional intruders.
+            Returns the detection results of own aircraft, and all conflict
+            and LoS pairs that involve own aircraft, also those that are only
+            observed from the side of a ghost. '''
+        n = ownship.ntraf
+        ghosts = self.ghosts
+        allac = SimpleNamespace(
+            ntraf=n + len(ghosts['id']), id=list(ownship.id) + list(ghosts['id']),
+            **{name: np.concatenate((getattr(ownship, name), ghosts[name])) for name in GHOSTVARS})
+        rpz, hpz, dtlookahead = (np.concatenate((getattr(self, name), ghosts[name]))
+                                 for name in GHOSTPARAMS)
+        confpairs, lospairs, inconf, tcpamax, qdr, dist, dcpa, tcpa, tLOS = \
+            self.detect(allac, allac, rpz, hpz, dtlookahead)
+
+        ownids = set(ownship.id)
+        own = np.array([pair[0] in ownids for pair in confpairs], dtype=bool)
+        results = [pair for pair in confpairs if pair[0] in ownids], \
+            [pair for pair in lospairs if pair[0] in ownids], inconf[:n], tcpamax[:n], \
+            qdr[own], dist[own], dcpa[own], tcpa[own], tLOS[own]
+        return results, [pair for pair in confpairs if not ownids.isdisjoint(pair)], \
+            [pair for pair in lospairs if not ownids.isdisjoint(pair)]
+
     def detect(self, ownship, intruder, rpz, hpz, dtlookahead):
         ''' Detect any conflicts between ownship and intruder.
             This function should be reimplemented in a subclass for actual
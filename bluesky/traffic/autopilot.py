@@ -315,6 +315,9 @@ class Autopilot(Entity, replaceable=True):
         # Check possible waypoint shift. Note: qdr, dist2wp will be updated accordingly in case of wp switch
         self.wppassingcheck(qdr, self.dist2wp) # Updates self.qdr2wp when necessary
 
+        # Cached atmosphere at the aircraft positions
+        atmos = (bs.traf.p, bs.traf.rho, bs.traf.Temp)
+
         #================= Continuous FMS guidance ========================
 
         # Note that the code below is vectorized, with traffic arrays, so for all aircraft
@@ -376,7 +379,7 @@ class Autopilot(Entity, replaceable=True):
         # use the turn speed
 
         # Is turn speed specified and are we not already slow enough? We only decelerate for turns, not accel.
-        turntas       = np.where(bs.traf.actwp.nextturnspd>0.0, vcas2tas(bs.traf.actwp.nextturnspd, bs.traf.alt),
+        turntas       = np.where(bs.traf.actwp.nextturnspd>0.0, vcas2tas(bs.traf.actwp.nextturnspd, bs.traf.alt, atmos),
                                  -1.0+0.*bs.traf.tas)
         
         # Switch is now whether the aircraft has any turn waypoints
@@ -390,7 +393,7 @@ class Autopilot(Entity, replaceable=True):
         # Note that because nextspd comes from the stack, and can be either a mach number or
         # a calibrated airspeed, it can only be converted from Mach / CAS [kts] to TAS [m/s]
         # once the altitude is known.
-        nexttas = vcasormach2tas(bs.traf.actwp.nextspd, bs.traf.alt)
+        nexttas = vcasormach2tas(bs.traf.actwp.nextspd, bs.traf.alt, atmos)
 #
         dxspdconchg = distaccel(bs.traf.tas, nexttas, bs.traf.perf.axmax)
 
@@ -457,7 +460,7 @@ class Autopilot(Entity, replaceable=True):
         bs.traf.selspd = np.where(usecruisespd, self.cruisespd, bs.traf.selspd)
 
         # Below crossover altitude: CAS=const, above crossover altitude: Mach = const
-        self.tas = vcasormach2tas(bs.traf.selspd, bs.traf.alt)
+        self.tas = vcasormach2tas(bs.traf.selspd, bs.traf.alt, atmos)
 
     def ComputeVNAV(self, idx, toalt, xtoalt, torta, xtorta):
         """
@@ -26,7 +26,8 @@ from .trafficgroups import TrafficGroups
 from .performance.perfbase import PerfBase
 
 # Register settings defaults
-bs.settings.set_variable_defaults(performance_model='openap', asas_dt=1.0)
+bs.settings.set_variable_defaults(performance_model='openap', asas_dt=1.0,
+                                  env_tolpos=50.0, env_tolalt=1.0)
 
 # if bs.settings.performance_model == 'bada':
 #     try:
@@ -78,6 +79,9 @@ class Traffic(Entity):
         # Default commands issued for an aircraft after creation
         self.crecmdlist = []
 
+        # Lookup of aircraft index by id, rebuilt after create/delete
+        self.idmap = None
+
         # Manual timer for CD and CR
         self.asastimer = Timer(name='asas', dt=bs.settings.asas_dt)
 
@@ -116,6 +120,11 @@ class Traffic(Entity):
             self.windnorth = np.array([])  # wind speed north component a/c pos [m/s]
             self.windeast  = np.array([])  # wind speed east component a/c pos [m/s]
 
+            # Positions at which atmosphere and wind were last calculated
+            self.envlat = np.array([])  # latitude [deg]
+            self.envlon = np.array([])  # longitude [deg]
+            self.envalt = np.array([])  # altitude [m]
+
             # Traffic autopilot settings
             self.selspd = np.array([])  # selected spd(CAS or Mach) [m/s or -]
             self.aptas  = np.array([])  # just for initializing
@@ -158,10 +167,14 @@ class Traffic(Entity):
         # Default bank angles per flight phase
         self.bphase = np.deg2rad(np.array([15, 35, 35, 35, 15, 45]))
 
+        # Version of the wind field used for the cached wind values
+        self.envwindver = -1
+
     def reset(self):
         ''' Clear all traffic data upon simulation reset. '''
         # Some child reset functions depend on a correct value of self.ntraf
         self.ntraf = 0
+        self.idmap = None
         # This ensures that the traffic arrays (which size is dynamic)
         # are all reset as well, so all lat,lon,sdp etc but also objects adsb
         super().reset()
@@ -206,7 +219,7 @@ class Traffic(Entity):
 
         if isinstance(acid, str):
             # Check if not already exist
-            if self.id.count(acid.upper()) > 0:
+            if self.id2idx(acid) >= 0:
                 return False, acid + " already exists."  # already exists do nothing
             acid = n * [acid]
 
@@ -232,6 +245,9 @@ class Traffic(Entity):
         # Aircraft Info
         self.id[-n:]   = acid
         self.type[-n:] = actype
+        if self.idmap is not None:
+            for i, acidi in enumerate(acid, self.ntraf - n):
+                self.idmap.setdefault(acidi, i)
 
         # Positions
         self.lat[-n:]  = aclat
@@ -248,21 +264,16 @@ class Traffic(Entity):
         self.gsnorth[-n:] = self.tas[-n:] * np.cos(hdgrad)
         self.gseast[-n:] = self.tas[-n:] * np.sin(hdgrad)
 
-        # Atmosphere
-        self.p[-n:], self.rho[-n:], self.Temp[-n:] = vatmos(acalt)
+        # Atmosphere and wind
+        self.update_environment(np.arange(self.ntraf - n, self.ntraf))
 
-        # Wind
         if self.wind.winddim > 0:
             applywind         = self.alt[-n:]> 50.*ft
-            self.windnorth[-n:], self.windeast[-n:]  = self.wind.getdata(self.lat[-n:], self.lon[-n:], self.alt[-n:])
             self.gsnorth[-n:] = self.gsnorth[-n:] + self.windnorth[-n:]*applywind
             self.gseast[-n:]  = self.gseast[-n:]  + self.windeast[-n:]*applywind
             self.trk[-n:]     = np.logical_not(applywind)*achdg + \
                                 applywind*np.degrees(np.arctan2(self.gseast[-n:], self.gsnorth[-n:]))
             self.gs[-n:]      = np.sqrt(self.gsnorth[-n:]**2 + self.gseast[-n:]**2)
-        else:
-            self.windnorth[-n:] = 0.0
-            self.windeast[-n:]  = 0.0
 
         # Traffic autopilot settings
         self.selspd[-n:] = self.cas[-n:]
@@ -383,6 +394,7 @@ class Traffic(Entity):
 
         # Call the actual delete function
         super().delete(idx)
+        self.idmap = None
 
         # Update number of aircraft
         self.ntraf = len(self.lat)
@@ -393,8 +405,9 @@ class Traffic(Entity):
         if self.ntraf == 0:
             return
 
-        #---------- Atmosphere --------------------------------
-        self.p, self.rho, self.Temp = vatmos(self.alt)
+        #---------- Atmosphere and wind -----------------------
+        # Catches aircraft that were moved by commands since the last step
+        self.update_environment()
 
         #---------- ADSB Update -------------------------------
         self.adsb.update()
@@ -419,6 +432,10 @@ class Traffic(Entity):
         self.update_groundspeed()
         self.update_pos()
 
+        # Refresh atmosphere and wind for the new positions, so that
+        # preupdate functions (e.g., performance) see the current state
+        self.update_environment()
+
         #---------- Simulate Turbulence -----------------------
         self.turbulence.update()
 
@@ -428,6 +445,48 @@ class Traffic(Entity):
         #---------- Aftermath ---------------------------------
         self.trails.update()
 
+    def update_environment(self, idx=None):
+        ''' Update the cached atmosphere (p, rho, Temp) and wind
+            (windnorth, windeast) at the aircraft positions.
+
+            Values are only recalculated for aircraft that moved more than
+            env_tolpos [m] horizontally or env_tolalt [m] vertically since
+            the last calculation, or for all aircraft when the wind field
+            has changed.
+
+            Arguments:
+            - idx: Indices of aircraft to recalculate unconditionally
+                   (e.g., newly created aircraft)
+        '''
+        if idx is None:
+            # Time-varying wind fields change with simulated time
+            self.wind.settime(bs.sim.utc)
+            if self.wind.version != self.envwindver:
+                idx = slice(None)
+                self.envwindver = self.wind.version
+            else:
+                dalt = np.abs(self.alt - self.envalt)
+                dy = self.lat - self.envlat
+                dx = (self.lon - self.envlon) * self.coslat
+                dpos2 = (dx * dx + dy * dy) * (np.radians(Rearth)) ** 2
+                idx = np.where((dalt > bs.settings.env_tolalt) |
+                               (dpos2 > bs.settings.env_tolpos ** 2))[0]
+                if len(idx) == 0:
+                    return
+
+        alt = self.alt[idx]
+        self.p[idx], self.rho[idx], self.Temp[idx] = vatmos(alt)
+        if self.wind.winddim > 0:
+            self.windnorth[idx], self.windeast[idx] = \
+                self.wind.getdata(self.lat[idx], self.lon[idx], alt)
+        else:
+            self.windnorth[idx] = 0.0
+            self.windeast[idx] = 0.0
+
+        self.envlat[idx] = self.lat[idx]
+        self.envlon[idx] = self.lon[idx]
+        self.envalt[idx] = alt
+
     def update_airspeed(self):
         # Compute horizontal acceleration
         delta_spd = self.aporasas.tas - self.tas
@@ -435,8 +494,9 @@ class Traffic(Entity):
         self.ax = need_ax * np.sign(delta_spd) * self.perf.axmax
         # Update velocities
         self.tas = np.where(need_ax, self.tas + self.ax * bs.sim.simdt, self.aporasas.tas)
-        self.cas = vtas2cas(self.tas, self.alt)
-        self.M = vtas2mach(self.tas, self.alt)
+        atmos = (self.p, self.rho, self.Temp)
+        self.cas = vtas2cas(self.tas, self.alt, atmos)
+        self.M = vtas2mach(self.tas, self.alt, atmos)
 
         # Turning bank triangle
         # tan phi = a centrigugal/a grav = omega^2 * R / g = omega * V /g
@@ -476,13 +536,11 @@ class Traffic(Entity):
 
             self.gs  = self.tas
             self.trk = self.hdg
-            self.windnorth[:], self.windeast[:] = 0.0,0.0
 
         else:
             applywind = self.alt>50.*ft # Only apply wind when airborne
 
-            vnwnd,vewnd = self.wind.getdata(self.lat, self.lon, self.alt)
-            self.windnorth[:], self.windeast[:] = vnwnd,vewnd
+            # Wind at aircraft position is cached in windnorth and windeast
             self.gsnorth  = self.tas * np.cos(np.radians(self.hdg)) + self.windnorth*applywind
             self.gseast   = self.tas * np.sin(np.radians(self.hdg)) + self.windeast*applywind
 
@@ -505,20 +563,19 @@ class Traffic(Entity):
 
     def id2idx(self, acid):
         """Find index of aircraft id"""
+        # Dictionary lookup of ids, keeping the first index of duplicate ids
+        if self.idmap is None:
+            self.idmap = dict(zip(reversed(self.id), range(len(self.id) - 1, -1, -1)))
+
         if not isinstance(acid, str):
             # id2idx is called for multiple id's
-            # Fast way of finding indices of all ACID's in a given list
-            tmp = dict((v, i) for i, v in enumerate(self.id))
-            return [tmp.get(acidi, -1) for acidi in acid]
-        else:
-             # Catch last created id (* or # symbol)
-            if acid in ('#', '*'):
-                return self.ntraf - 1
-
-            try:
-                return self.id.index(acid.upper())
-            except:
-                return -1
+            return [self.idmap.get(acidi, -1) for acidi in acid]
+
+        # Catch last created id (* or # symbol)
+        if acid in ('#', '*'):
+            return self.ntraf - 1
+
+        return self.idmap.get(acid.upper(), -1)
 
     def setnoise(self, noise=None):
         """Noise (turbulence, ADBS-transmission noise, ADSB-truncated effect)"""
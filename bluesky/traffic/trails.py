@@ -4,6 +4,16 @@ import numpy as np
 import bluesky as bs
 from bluesky import settings
 from bluesky.core import TrafficArrays
+from bluesky.tools.ringbuffer import RingBuffer
+
+
+# Register settings defaults
+settings.set_variable_defaults(trails_maxlen=1000000, trails_maxage=0.0)
+
+
+def _column(buffer, name):
+    ''' Property for a column of one of the trail buffers. '''
+    return property(lambda self: getattr(self, buffer).column(name))
 
 
 class Trails(TrafficArrays):
@@ -17,6 +27,18 @@ class Trails(TrafficArrays):
 
     Created by  : Jacco M. Hoekstra
     """
+    lat0 = _column('fg', 'lat0')
+    lon0 = _column('fg', 'lon0')
+    lat1 = _column('fg', 'lat1')
+    lon1 = _column('fg', 'lon1')
+    time = _column('fg', 'time')
+    col = _column('fg', 'col')
+    bglat0 = _column('bg', 'lat0')
+    bglon0 = _column('bg', 'lon0')
+    bglat1 = _column('bg', 'lat1')
+    bglon1 = _column('bg', 'lon1')
+    bgtime = _column('bg', 'time')
+    bgcol = _column('bg', 'col')
 
     def __init__(self,dttrail=10.):
         super().__init__()
@@ -34,23 +56,12 @@ class Trails(TrafficArrays):
         # Set default color to Blue
         self.defcolor = self.colorList['CYAN']
 
-        # Foreground data on line pieces
-        self.lat0 = np.array([])
-        self.lon0 = np.array([])
-        self.lat1 = np.array([])
-        self.lon1 = np.array([])
-        self.time = np.array([])
-        self.col  = []
+        # Foreground and background data on line pieces, with
+        # columns lat0, lon0, lat1, lon1, time, and col
+        self.fg = RingBuffer(settings.trails_maxlen, settings.trails_maxage, 'time')
+        self.bg = RingBuffer(settings.trails_maxlen, settings.trails_maxage, 'time')
         self.fcol = np.array([])
 
-        # background copy of data
-        self.bglat0 = np.array([])
-        self.bglon0 = np.array([])
-        self.bglat1 = np.array([])
-        self.bglon1 = np.array([])
-        self.bgtime = np.array([])
-        self.bgcol = []
-
         with self.settrafarrays():
             self.accolor = []
             self.lastlat = np.array([])
@@ -83,6 +94,7 @@ class Trails(TrafficArrays):
         lstlat1 = []
         lstlon1 = []
         lsttime = []
+        lstcol = []
 
         # Check for update
         delta = bs.sim.simt - self.lasttim
@@ -99,15 +111,7 @@ class Trails(TrafficArrays):
             lstlat1.append(bs.traf.lat[i])
             lstlon1.append(bs.traf.lon[i])
             lsttime.append(bs.sim.simt)
-
-            if isinstance(self.col, np.ndarray):
-                # print type(trailcol[i])
-                # print trailcol[i]
-                # print "col type: ",type(self.col)
-                self.col = self.col.tolist()
-
-            type(self.col)
-            self.col.append(self.accolor[i])
+            lstcol.append(self.accolor[i])
 
             # Update aircraft record
             self.lastlat[i] = bs.traf.lat[i]
@@ -118,17 +122,15 @@ class Trails(TrafficArrays):
         # it is no longer a/c data => move to the GUI buffer (send or draw)
         if self.pygame:
             # Pygame: send to drawing buffer
-            self.lat0 = np.concatenate((self.lat0, np.array(lstlat0)))
-            self.lon0 = np.concatenate((self.lon0, np.array(lstlon0)))
-            self.lat1 = np.concatenate((self.lat1, np.array(lstlat1)))
-            self.lon1 = np.concatenate((self.lon1, np.array(lstlon1)))
-            self.time = np.concatenate((self.time, np.array(lsttime)))
+            self.fg.extend(dict(lat0=lstlat0, lon0=lstlon0, lat1=lstlat1,
+                                lon1=lstlon1, time=lsttime, col=lstcol))
         else:
             # QtGL: add to send buffer
             self.newlat0.extend(lstlat0)
             self.newlon0.extend(lstlon0)
             self.newlat1.extend(lstlat1)
             self.newlon1.extend(lstlon1)
+            self.newtime.extend(lsttime)
         # Update colours
         self.fcol = (1. - np.minimum(self.tcol0, np.abs(bs.sim.simt - self.time)) / self.tcol0)
 
@@ -136,22 +138,8 @@ class Trails(TrafficArrays):
 
     def buffer(self):
         """Buffer trails: Move current stack to background """
-
-        self.bglat0 = np.append(self.bglat0, self.lat0)
-        self.bglon0 = np.append(self.bglon0, self.lon0)
-        self.bglat1 = np.append(self.bglat1, self.lat1)
-        self.bglon1 = np.append(self.bglon1, self.lon1)
-        self.bgtime = np.append(self.bgtime, self.time)
-
         # No color saved: Background: always 'old color' self.col0
-        if isinstance(self.bgcol, np.ndarray):
-            self.bgcol = self.bgcol.tolist()
-        if isinstance(self.col, np.ndarray):
-            self.col = self.col.tolist()
-
-        self.bgcol = self.bgcol + self.col
-        self.bgacid = self.bgacid + self.acid
-
+        self.bg.extend(self.fg.since())
         self.clearfg()  # Clear foreground trails
         return
 
@@ -161,26 +149,17 @@ class Trails(TrafficArrays):
         self.newlon0 = []
         self.newlat1 = []
         self.newlon1 = []
+        self.newtime = []
 
 
     def clearfg(self):  # Foreground
         """Clear trails foreground"""
-        self.lat0 = np.array([])
-        self.lon0 = np.array([])
-        self.lat1 = np.array([])
-        self.lon1 = np.array([])
-        self.time = np.array([])
-        self.col = np.array([])
+        self.fg.clear()
         return
 
     def clearbg(self):  # Background
         """Clear trails background"""
-        self.bglat0 = np.array([])
-        self.bglon0 = np.array([])
-        self.bglat1 = np.array([])
-        self.bglon1 = np.array([])
-        self.bgtime = np.array([])
-        self.bgacid = []
+        self.bg.clear()
         return
 
     def clear(self):
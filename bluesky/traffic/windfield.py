@@ -1,10 +1,120 @@
 """ Wind implementation for BlueSky."""
+from bisect import bisect_right, insort
+from threading import Thread, current_thread
 from numpy import array, sin, cos, arange, radians, ones, append, ndarray, \
-                  minimum, repeat, delete, zeros, maximum, floor, interp, \
-                  pi, concatenate, unique
-from scipy.interpolate import interp1d, RegularGridInterpolator
+                  minimum, delete, zeros, maximum, floor, interp, \
+                  pi, concatenate, unique, diff, allclose, searchsorted, \
+                  array_equal, tile, broadcast_to, column_stack, newaxis
+from scipy.interpolate import interp1d
+from scipy.spatial import cKDTree
+from bluesky import settings, stack
 from bluesky.tools.aero import ft
 
+# Register settings defaults
+settings.set_variable_defaults(wind_knear=16, wind_dt=60.0)
+
+
+class GridAxis:
+    """ Sorted interpolation axis of a rectilinear grid. Uniformly spaced axes
+        are indexed with direct arithmetic, other axes with a binary search. """
+    def __init__(self, values):
+        self.values  = values
+        self.n       = len(values)
+        self.step    = values[1] - values[0]
+        self.uniform = allclose(diff(values), self.step)
+
+    def index(self, x):
+        """ Return lower index, interpolation factor for the upper value,
+            and a mask indicating whether x lies within the axis range. """
+        if self.uniform:
+            i = floor((x - self.values[0]) / self.step)
+            i = minimum(self.n - 2, maximum(0, i)).astype(int)
+        else:
+            i = minimum(self.n - 2, maximum(0, searchsorted(self.values, x, side='right') - 1))
+        f = (x - self.values[i]) / (self.values[i + 1] - self.values[i])
+        inside = (x >= self.values[0]) & (x <= self.values[-1])
+        return i, f, inside
+
+
+class GridInterpolator:
+    """ Trilinear interpolation of wind on a regular (alt, lat, lon) grid.
+        Positions outside of the grid get zero wind. """
+    def __init__(self, altaxis, lats, lons, vnorth, veast):
+        self.axes   = (GridAxis(altaxis), GridAxis(lats), GridAxis(lons))
+        self.vnorth = vnorth   # (nalt, nlat, nlon)
+        self.veast  = veast    # (nalt, nlat, nlon)
+
+    def __call__(self, lat, lon, alt):
+        (ialt, falt, inalt), (ilat, flat, inlat), (ilon, flon, inlon) = \
+            (axis.index(x) for axis, x in zip(self.axes, (alt, lat, lon)))
+        inside = inalt & inlat & inlon
+
+        vnorth = zeros(len(lat))
+        veast  = zeros(len(lat))
+        for da, wa in ((0, 1. - falt), (1, falt)):
+            for dy, wy in ((0, 1. - flat), (1, flat)):
+                for dx, wx in ((0, 1. - flon), (1, flon)):
+                    w = wa * wy * wx
+                    vnorth += w * self.vnorth[ialt + da, ilat + dy, ilon + dx]
+                    veast  += w * self.veast[ialt + da, ilat + dy, ilon + dx]
+
+        return vnorth * inside, veast * inside
+
+
+
+class WindSlice:
+    """ One time slice of a time-varying wind field. The wind data is
+        obtained from the loader function in a background thread, and can be
+        unloaded again when the slice is no longer needed. A slice of which
+        the loader fails is marked as failed, and not loaded again. """
+    def __init__(self, t, loader):
+        self.t      = t
+        self.loader = loader  # Returns the arguments for Windfield.addpointvne
+        self.field  = None
+        self.failed = False
+        self.thread = None    # Background loading thread
+        self.data   = None    # Loader result (or exception) of the thread
+
+    def fetch(self):
+        try:
+            data = self.loader()
+        except Exception as e:
+            data = e
+        # Drop the data when the slice was unloaded in the meantime
+        if self.thread is current_thread():
+            self.data = data
+
+    def prefetch(self):
+        """ Start loading the data of this slice in the background. """
+        if self.field is None and self.data is None and self.thread is None \
+                and not self.failed:
+            self.thread = Thread(target=self.fetch, daemon=True)
+            self.thread.start()
+
+    @property
+    def loading(self):
+        """ True while the data of this slice is being loaded. """
+        return self.thread is not None and self.data is None
+
+    def load(self):
+        """ Return the wind field of this slice, or None when its data
+            isn't available (yet). """
+        if self.field is None and self.data is not None:
+            data, self.data, self.thread = self.data, None, None
+            if isinstance(data, Exception):
+                self.failed = True
+                stack.echo(f'No wind data available for {self.t}: {data}')
+                return None
+            self.field = Windfield()
+            self.field.addpointvne(*data)
+        return self.field
+
+    def unload(self):
+        self.field  = None
+        self.data   = None
+        self.thread = None
+
+
 class Windfield():
     """ Windfield class:
         Methods:
@@ -23,6 +133,14 @@ class Windfield():
 
             remove(idx) = remove a defined profile using the index
 
+            addslice(t,loader)
+                       = add a time slice of a time-varying (4D) wind field,
+                         loader is called in the background when the slice
+                         is needed and returns the arguments for addpointvne
+
+            settime(t) = set the time (UTC datetime) for which a time-varying
+                         wind field is interpolated
+
         Members:
             lat(nvec)          = latitudes of wind definitions
             lon(nvec)          = longitudes of wind definitions
@@ -37,6 +155,19 @@ class Windfield():
                           2 = 2D field (no alt profiles),
                           3 = 3D field (alt dependent wind at some points)
 
+            version   = Counter that is incremented on every change of the
+                        field, so that users can detect when cached wind
+                        values need to be recalculated
+
+            slices    = Time slices of a time-varying wind field. Only the
+                        two slices around the current time, and the slice
+                        after them, are kept loaded.
+
+            grid      = Trilinear interpolator used when the field is defined
+                        on a regular lat/lon grid with altitude profiles
+                        (None otherwise). Other fields use inverse-distance
+                        weighting over the wind_knear nearest points.
+
     """
     def __init__(self):
         # For altitude use fixed axis to allow vectorisation later
@@ -51,6 +182,13 @@ class Windfield():
         # List of indices of points with an altitude profile (for 3D check)
         self.iprof   = []
 
+        # Spatial index of definition points for scattered fields
+        self.tree    = None
+        self.treever = -1
+
+        # Change counter of the wind field
+        self.version = 0
+
         # Clear actual field
         self.clear()
         return
@@ -65,10 +203,72 @@ class Windfield():
         self.vnorth  = array([[]])
         self.veast   = array([[]])
         self.nvec    = 0
-        self.fe      = None
-        self.fn      = None
+        self.grid    = None
+        self.slices  = []
+        self.time    = None
+        self.islice  = (0, 0, 0.)  # lower/upper slice index, upper factor, or None for zero wind
+        self.version += 1
         return
 
+    def addslice(self, t, loader):
+        """ Add a time slice to a time-varying wind field.
+
+            Arguments:
+            - t: Time of the slice (UTC datetime)
+            - loader: Function returning the arguments (lat, lon, vnorth,
+              veast, windalt) for addpointvne. It is only called, in a
+              background thread, when the slice is needed for interpolation.
+        """
+        insort(self.slices, WindSlice(t, loader), key=lambda s: s.t)
+        self.winddim = 3
+        self.time    = None  # Force new slice selection
+        self.version += 1
+
+    def settime(self, t):
+        """ Set the time for interpolation in a time-varying wind field.
+            Time changes smaller than wind_dt [s] are ignored. The two slices
+            around t and the slice after them are loaded in the background,
+            other slices are unloaded. Until the slices around t are loaded,
+            the previous slices stay in use. When one of the two slices
+            around t can't be loaded the other is used, and when both fail
+            there is no wind. """
+        if not self.slices or (self.time is not None and
+                               abs((t - self.time).total_seconds()) < settings.wind_dt):
+            return
+
+        self.time = t
+        times = [s.t for s in self.slices]
+        i0 = max(0, bisect_right(times, t) - 1)
+        i1 = min(i0 + 1, len(times) - 1)
+        if i0 == i1 or t <= times[i0]:
+            i1, f = i0, 0.
+        else:
+            f = min(1., (t - times[i0]) / (times[i1] - times[i0]))
+
+        # Load the slices in the background, instead of during interpolation
+        needed = [i0] if f == 0. else [i0, i1]
+        for i in needed + [i1 + 1]:
+            if i < len(self.slices):
+                self.slices[i].prefetch()
+        loaded = [i for i in needed if self.slices[i].load() is not None]
+        loading = any(self.slices[i].loading for i in needed)
+        if len(loaded) == len(needed):
+            self.islice = (i0, i1, f)
+        elif loaded:
+            self.islice = (loaded[0], loaded[0], 0.)
+        elif not loading:
+            self.islice = None
+        if loading:
+            # Select the slices again when their data is available
+            self.time = None
+
+        keep = {i0, i1, i1 + 1}.union(self.islice[:2] if self.islice else ())
+        for i, s in enumerate(self.slices):
+            if i not in keep:
+                s.unload()
+
+        self.version += 1
+
     def addpointvne(self, lat, lon, vnorth, veast, windalt=None):
         """ Add a vector of lat/lon positions (arrays) with a (2D vector of) 
             wind speed [m/s] in north and east component. 
@@ -81,31 +281,25 @@ class Windfield():
             feast  = interp1d(windalt, veast.T, bounds_error=False, 
                               fill_value=(veast[0], veast[-1]), assume_sorted=True)
                        
-            # Assume regular grid and set RGI for interpolation
-            if len(lat) > 3: 
-                try:
-                    # Interpolate along windalt axis
-                    altaxis = concatenate((array([0.]), windalt))
-                    vnaxis = fnorth(altaxis).T
-                    veaxis = feast(altaxis).T
-                    
-                    # Get unique latitudes and longitudes for RGI
-                    lats = unique(lat)
-                    lons = unique(lon)
-                    
-                    # Set RGI interpolation functions
-                    vevalues = veaxis.reshape((len(altaxis), len(lats), len(lons)))
-                    vnvalues = vnaxis.reshape((len(altaxis), len(lats), len(lons)))
-                    self.fe = RegularGridInterpolator((altaxis, lats, lons), 
-                                                      vevalues, bounds_error=False, fill_value=0.)
-                    self.fn = RegularGridInterpolator((altaxis, lats, lons), 
-                                                      vnvalues, bounds_error=False, fill_value=0.) 
-                except:
-                    # Create vn, ve if RGI is not possible
-                    vnaxis = fnorth(self.altaxis).T
-                    veaxis = feast(self.altaxis).T
+            # Get unique latitudes and longitudes to check for a regular grid
+            lats = unique(lat)
+            lons = unique(lon)
+
+            # Use grid interpolation if points form a regular grid,
+            # ordered by latitude, then longitude
+            if len(lats) > 1 and len(lons) > 1 and len(lat) == len(lats) * len(lons) \
+                    and array_equal(lat, lats.repeat(len(lons))) \
+                    and array_equal(lon, tile(lons, len(lats))):
+                # Interpolate along windalt axis
+                altaxis = concatenate((array([0.]), windalt))
+                vnaxis = fnorth(altaxis).T
+                veaxis = feast(altaxis).T
+
+                shape = (len(altaxis), len(lats), len(lons))
+                self.grid = GridInterpolator(altaxis, lats, lons,
+                                             vnaxis.reshape(shape), veaxis.reshape(shape))
             else:
-                # Create vn, ve if less than 4 coords are present
+                # Create vn, ve if points do not form a regular grid
                 vnaxis = fnorth(self.altaxis).T
                 veaxis = feast(self.altaxis).T
         
@@ -130,6 +324,8 @@ class Windfield():
         if self.winddim<3: # No 3D => set dim to 0,1 or 2 dep on nr of points
             self.winddim = min(2,len(self.lat))
 
+        self.version += 1
+
     def addpoint(self,lat,lon,winddir,windspd,windalt=None):
         """ addpoint: adds a lat,lon position with a wind direction [deg]
                                                      and wind speedd [m/s]
@@ -179,6 +375,7 @@ class Windfield():
             self.iprof.append(idx)
 
         self.nvec = self.nvec+1
+        self.version += 1
 
         return idx # return index of added point
     
@@ -204,10 +401,23 @@ class Windfield():
         else:
             alt = zeros(npos)
 
-        # Check if RGI functions are present, if so use them for interpolation
-        if self.fe is not None and self.fn is not None:
-            vnorth = self.fn(concatenate((alt.reshape(1,-1), lat, lon), axis=0).T)
-            veast  = self.fe(concatenate((alt.reshape(1,-1), lat, lon), axis=0).T)
+        # Interpolate in time between slices of a time-varying field
+        if self.slices:
+            i0, i1, f = self.islice or (0, 0, 0.)
+            field = self.slices[i0].load() if self.islice else None
+            if field is None:
+                vnorth = zeros(npos)
+                veast  = zeros(npos)
+            else:
+                vnorth, veast = field.getdata(lat.reshape(npos), lon.reshape(npos), alt)
+            if f > 0.:
+                vn1, ve1 = self.slices[i1].load().getdata(lat.reshape(npos), lon.reshape(npos), alt)
+                vnorth = (1. - f) * vnorth + f * vn1
+                veast  = (1. - f) * veast + f * ve1
+
+        # Check if a regular grid is present, if so use it for interpolation
+        elif self.grid is not None:
+            vnorth, veast = self.grid(lat.reshape(npos), lon.reshape(npos), alt)
         else:
             # Check dimension of wind field
             if self.winddim == 0:   # None = no wind
@@ -220,30 +430,33 @@ class Windfield():
     
             elif self.winddim >= 2: # 2D/3D field = more points defined but no altitude profile
     
-                #---- Get horizontal weight factors
-    
+                #---- Get horizontal weight factors of nearest definition points
+
+                lat = lat.reshape((npos,1))
+                lon = lon.reshape((npos,1))
+                inear = self.nearest(lat, lon) # (npos,k)
+                nlat = self.lat[inear]
+                nlon = self.lon[inear]
+
                 # Average cosine for flat-eartyh approximation
-                cavelat = cos(radians(0.5*(lat+array([self.lat]).transpose())))
+                cavelat = cos(radians(0.5*(lat+nlat)))
     
                 # Lat and lon distance in 60 nm units (1 lat degree)
-                dy = lat - array([self.lat]).transpose() #(nvec,npos)
-                dx = cavelat*(lon - array([self.lon]).transpose())
+                dy = lat - nlat #(npos,k)
+                dx = cavelat*(lon - nlon)
     
                 # Calulate invesre distance squared
                 invd2   = 1./(eps+dx*dx+dy*dy) # inverse of distance squared
     
                 # Normalize weights
-                sumsid2 = ones((1,self.nvec)).dot(invd2) # totals to normalize weights
-                totals = repeat(sumsid2,self.nvec,axis=0) # scale up dims to (nvec,npos)
-                
-                horfact = invd2/totals # rows x col = nvec x npos, weight factors
+                horfact = invd2/invd2.sum(axis=1, keepdims=True) # npos x k, weight factors
     
                 #---- Altitude interpolation
     
                 # No altitude profiles used: do 2D planar interpolation only
                 if self.winddim == 2 or ((type(useralt) not in (list,ndarray)) and useralt==0.0): # 2D field no altitude interpolation
-                    vnorth  = self.vnorth[0,:].dot(horfact)
-                    veast   = self.veast[0,:].dot(horfact)
+                    vnorth  = (self.vnorth[0,inear]*horfact).sum(axis=1)
+                    veast   = (self.veast[0,inear]*horfact).sum(axis=1)
     
                 # 3D interpolation as one or more points contain altitude profile
                 else:
@@ -252,21 +465,18 @@ class Windfield():
                     idxalt = maximum(0., minimum(self.altaxis[-1]-eps, alt) / self.altstep) # find right index
     
                     # Convert to index and factor
-                    ialt   = floor(idxalt).astype(int) # index array for lower altitude
-                    falt   = idxalt-ialt  # factor for upper value
-    
-                    # Altitude interpolation combined with horizontal
-                    nvec   = len(self.lon) # Get number of definition points
+                    ialt   = floor(idxalt).astype(int)[:,newaxis] # index array for lower altitude
+                    falt   = idxalt-ialt[:,0]  # factor for upper value
     
                     # North wind (y-direction ot lat direction)
-                    vn0    = (self.vnorth[ialt,:]*horfact.T).dot(ones((nvec,1))) # hor interpolate lower alt (npos x)
-                    vn1    = (self.vnorth[ialt+1,:]*horfact.T).dot(ones((nvec,1))) # hor interpolate lower alts (npos x)
-                    vnorth = (1.-falt)*(vn0.reshape(npos)) + falt*(vn1.reshape(npos)) # As 1D array
+                    vn0    = (self.vnorth[ialt,inear]*horfact).sum(axis=1) # hor interpolate lower alt
+                    vn1    = (self.vnorth[ialt+1,inear]*horfact).sum(axis=1) # hor interpolate upper alt
+                    vnorth = (1.-falt)*vn0 + falt*vn1
     
                     # East wind (x-direction or lon direction)
-                    ve0    = (self.veast[ialt,:]*horfact.T).dot(ones((nvec,1)))
-                    ve1    = (self.veast[ialt+1,:]*horfact.T).dot(ones((nvec,1)))
-                    veast  = (1.-falt)*(ve0.reshape(npos)) + falt*(ve1.reshape(npos)) # As 1D array
+                    ve0    = (self.veast[ialt,inear]*horfact).sum(axis=1)
+                    ve1    = (self.veast[ialt+1,inear]*horfact).sum(axis=1)
+                    veast  = (1.-falt)*ve0 + falt*ve1
 
         # Return same type as positons were given
         if type(userlat)==ndarray:
@@ -276,7 +486,23 @@ class Windfield():
             return list(vnorth),list(veast)
 
         else:
-            return float(vnorth),float(veast)
+            return float(vnorth[0]),float(veast[0])
+
+    def nearest(self, lat, lon):
+        """ Return the indices of the definition points used to interpolate
+            at the given positions: all points for small fields, and the
+            wind_knear nearest points (using a KD-tree) for larger fields. """
+        nvec = len(self.lat)
+        if nvec <= settings.wind_knear:
+            return broadcast_to(arange(nvec), (len(lat), nvec))
+
+        # (Re)build spatial index on unit sphere when the field has changed
+        if self.treever != self.version:
+            self.tree = cKDTree(unitvec(self.lat, self.lon))
+            self.treever = self.version
+
+        _, inear = self.tree.query(unitvec(lat.ravel(), lon.ravel()), k=settings.wind_knear)
+        return inear
 
     def remove(self,idx): # remove a point using the returned index when it was added
         if idx<len(self.lat):
@@ -292,4 +518,13 @@ class Windfield():
             if self.winddim<3 or len(self.iprof)==0 or len(self.lat)==0:
                 self.winddim = min(2,len(self.lat)) # Check for 0, 1D, 2D or 3D
 
+            self.version += 1
+
         return
+
+
+def unitvec(lat, lon):
+    """ Convert lat/lon [deg] to 3D unit vectors for the spatial index. """
+    rlat = radians(lat)
+    rlon = radians(lon)
+    return column_stack((cos(rlat)*cos(rlon), cos(rlat)*sin(rlon), sin(rlat)))
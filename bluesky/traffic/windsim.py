@@ -1,12 +1,17 @@
 ''' Simulate wind in BlueSky. '''
 from numpy import arctan2,degrees,array,sqrt # to allow arrays, their functions and types
 
+from bluesky import settings
 from bluesky.tools.aero import kts, ft
 from bluesky.core import Entity
 from bluesky.stack import command
 from .windfield import Windfield
 
 
+# Maximum size of the cache of decoded wind grids [MB]
+settings.set_variable_defaults(wind_cachesize=2000.0)
+
+
 class WindSim(Entity, Windfield, replaceable=True):      
     @command(name='WIND')
     def add(self, lat: 'lat', lon: 'lon', *winddata: 'float/alt'):
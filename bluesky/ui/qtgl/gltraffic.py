@@ -9,13 +9,14 @@ from bluesky.ui import palette
 from bluesky.tools.aero import ft, nm, kts
 from bluesky.network import context as ctx
 from bluesky.network.subscriber import subscriber
-from bluesky.network.sharedstate import ActData
+from bluesky.network.sharedstate import ActData, RingStore, addtopic
 
 
 # Register settings defaults
 settings.set_variable_defaults(
     text_size=13, ac_size=16,
-    asas_vmin=200.0, asas_vmax=500.0)
+    asas_vmin=200.0, asas_vmax=500.0,
+    trails_maxlen=1000000, trails_maxage=0.0)
 
 palette.set_default_colours(
     aircraft=(0, 255, 0),
@@ -30,6 +31,10 @@ MAX_ROUTE_LENGTH = 500
 ROUTE_SIZE = 500
 TRAILS_SIZE = 1000000
 
+# Trail segments are stored in a ring buffer with (at most) the size of the GPU buffer
+addtopic('TRAILS', RingStore(min(settings.trails_maxlen or TRAILS_SIZE, TRAILS_SIZE),
+                             settings.trails_maxage, 'trailtime'))
+
 
 class Traffic(glh.RenderObject, layer=100):
     ''' Traffic OpenGL object. '''
@@ -140,6 +145,9 @@ class Traffic(glh.RenderObject, layer=100):
         self.routelbl = glh.Text(settings.text_size, (12, 2))
         self.rwaypoints = glh.VertexArrayObject(glh.gl.GL_LINE_LOOP)
         self.traillines = glh.VertexArrayObject(glh.gl.GL_LINES)
+        # Ring buffer rows of the trail segments in the GPU buffer
+        self.trailstart = 0
+        self.trailend = 0
 
     def create(self):
         ac_size = settings.ac_size
@@ -214,7 +222,7 @@ class Traffic(glh.RenderObject, layer=100):
 
         self.route.draw()
         self.cpalines.draw()
-        self.traillines.draw()
+        self.draw_trails()
 
         # --- DRAW THE INSTANCED AIRCRAFT SHAPES ------------------------------
         # update wrap longitude and direction for the instanced objects
@@ -248,24 +256,43 @@ class Traffic(glh.RenderObject, layer=100):
             self.ssd.draw(vertex_count=self.naircraft,
                           n_instances=self.naircraft)
 
+    def draw_trails(self):
+        ''' Draw the trail segments, which wrap around the end of the GPU buffer. '''
+        first = self.trailstart % TRAILS_SIZE
+        count = self.trailend - self.trailstart
+        nfirst = min(count, TRAILS_SIZE - first)
+        self.traillines.draw(first_vertex=2 * first, vertex_count=2 * nfirst)
+        if count > nfirst:
+            self.traillines.draw(first_vertex=0, vertex_count=2 * (count - nfirst))
+
     @subscriber(topic='TRAILS')
     def update_trails_data(self, data):
-        ''' Update GPU buffers with route data from simulation. '''
+        ''' Update GPU buffers with new trail segments from simulation. '''
         if not self.initialized:
             return
-        if ctx.action == ctx.action.Reset or ctx.action == ctx.action.ActChange:# TODO hack
+        buffer = data.buffer
+        if ctx.action == ctx.action.Reset:
             # Simulation reset: Clear all entries
-            self.traillines.set_vertex_count(0)
+            self.trailstart = self.trailend = buffer.end
             return
-        if len(data.traillat0) > 0:
+        if ctx.action == ctx.action.ActChange:
+            # Upload all trails of the new active node
+            self.trailend = buffer.start
+
+        # Only upload the segments that were added since the previous update
+        first = max(self.trailend, buffer.start)
+        new = buffer.since(first)
+        if first < buffer.end:
+            vertices = np.column_stack((new['traillat0'], new['traillon0'],
+                                        new['traillat1'], new['traillon1'])).astype(np.float32)
             self.glsurface.makeCurrent()
-            self.traillines.set_vertex_count(len(data.traillat0))
-            if len(data.traillat0) > 0:
-                self.traillines.update(vertex=np.array(
-                        list(zip(data.traillat0, data.traillon0,
-                                data.traillat1, data.traillon1)), dtype=np.float32))
-        else:
-            self.traillines.set_vertex_count(0)
+            slot = first % TRAILS_SIZE
+            nfirst = min(len(vertices), TRAILS_SIZE - slot)
+            self.traillines.vertex.update(vertices[:nfirst], offset=16 * slot)
+            if nfirst < len(vertices):
+                self.traillines.vertex.update(vertices[nfirst:], offset=0)
+        self.trailstart = buffer.start
+        self.trailend = buffer.end
 
     @subscriber(topic='ROUTEDATA', actonly=True)
     def update_route_data(self, data):
@@ -19,7 +19,7 @@ from .gltiledmap import TiledMap
 
 
 # Register settings defaults
-bs.settings.set_variable_defaults(gfx_path='graphics')
+bs.settings.set_variable_defaults(gfx_path='graphics', acdata_viewport=False)
 
 
 class RadarShaders(glh.ShaderSet):
@@ -226,6 +226,11 @@ class RadarWidget(glh.RenderWidget):
         self.shaderset.set_wrap(self.wraplon, self.wrapdir)
         self.shaderset.set_pan_and_zoom(self.pan[0], self.pan[1], self.zoom)
 
+        # Only receive aircraft data for the aircraft in view
+        if finished and bs.settings.acdata_viewport:
+            lat1, lon0, lat0, lon1 = self.viewportlatlon()
+            bs.net.viewport(lat0, lat1, lon0, lon1, self.zoom)
+
     def setpanzoom(self, pan=None, zoom=None, origin=None, absolute=True, finished=True):
         # Absolute or relative pan operation
         if pan is not None: